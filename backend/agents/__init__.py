@@ -1,6 +1,12 @@
-# agents/__init__.py
 """AI Agent Workflow Package"""
 
-from .workflow import generate_content, load_models
-
 __all__ = ['generate_content', 'load_models']
+
+
+def __getattr__(name):
+    # Import the local (torch) workflow lazily so the cloud server and the
+    # dev tools can use the package without the local-model dependencies
+    if name in __all__:
+        from . import workflow
+        return getattr(workflow, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,139 @@
+# agents/adapters.py - One shared base model with per-role LoRA adapters
+
+import os
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+ROLES = ("writer", "reviewer", "compliance", "coordinator")
+# peft's name for a row that runs on the base model
+BASE_ADAPTER = "__base__"
+
+# Filled in by the loader: role -> adapter path, plus the model's footprint
+_LOADED = {"base_model": None, "adapters": {}, "footprint_mb": None}
+
+
+def adapter_config() -> dict:
+    """
+    Read shared-model settings from the environment.
+
+    LORA_ADAPTERS maps roles to adapter directories, e.g.
+    "writer=./adapters/writer,compliance=./adapters/compliance";
+    otherwise LORA_ADAPTER_DIR/<role> is used where it exists. Roles without
+    an adapter run on the base model.
+    """
+    explicit = {}
+    for item in os.getenv("LORA_ADAPTERS", "").split(","):
+        if "=" in item:
+            role, path = item.split("=", 1)
+            explicit[role.strip()] = path.strip()
+    return {
+        "base_model": os.getenv("SHARED_BASE_MODEL", "").strip(),
+        "quantization": os.getenv("SHARED_BASE_QUANT", "nf4").strip().lower(),
+        "adapters": explicit,
+        "adapter_dir": os.getenv("LORA_ADAPTER_DIR", "").strip(),
+    }
+
+
+def shared_base_enabled() -> bool:
+    return bool(adapter_config()["base_model"])
+
+
+def adapter_paths(config: dict = None) -> dict:
+    """role -> adapter directory for every role that has one"""
+    config = config or adapter_config()
+    paths = {}
+    for role in ROLES:
+        path = config["adapters"].get(role)
+        if not path and config["adapter_dir"]:
+            candidate = Path(config["adapter_dir"]) / role
+            if (candidate / "adapter_config.json").exists():
+                path = str(candidate)
+        if path:
+            paths[role] = path
+    return paths
+
+
+def attach_adapters(model, paths: dict):
+    """Wrap model with one named LoRA adapter per role (unchanged when there are none)"""
+    if not paths:
+        return model
+    from peft import PeftModel
+
+    items = iter(paths.items())
+    role, path = next(items)
+    print(f"🧩 Adapter {role}: {path}")
+    model = PeftModel.from_pretrained(model, path, adapter_name=role)
+    for role, path in items:
+        print(f"🧩 Adapter {role}: {path}")
+        model.load_adapter(path, adapter_name=role)
+    model.eval()
+    return model
+
+
+class AdapterLLM:
+    """
+    One role's view of the shared model: the same pipeline as every other
+    role, plus the adapter its calls run under (None = base model).
+    """
+
+    def __init__(self, pipeline, adapter: Optional[str] = None):
+        self.pipeline = pipeline
+        self.adapter = adapter
+
+
+def adapter_of(llm) -> Optional[str]:
+    return getattr(llm, "adapter", None)
+
+
+def adapter_kwargs(adapters: list, num_return_sequences: int = 1) -> dict:
+    """
+    generate() / forward() kwargs selecting each row's adapter. Passed per
+    call rather than via set_adapter, so concurrent calls on the shared
+    model never switch each other's adapter. Empty for a plain model.
+    """
+    if not any(adapters):
+        return {}
+    ADAPTER_STATS.record(adapters)
+    # generate() repeats each prompt num_return_sequences times, row by row
+    names = [adapter or BASE_ADAPTER for adapter in adapters for _ in range(num_return_sequences)]
+    return {"adapter_names": names}
+
+
+def record_loaded(base_model: str, paths: dict, model):
+    _LOADED.update(base_model=base_model, adapters=dict(paths))
+    try:
+        _LOADED["footprint_mb"] = round(model.get_memory_footprint() / 2**20, 1)
+    except Exception:
+        _LOADED["footprint_mb"] = None
+
+
+# ========== STATS ========== #
+
+class AdapterStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = Counter()
+        self.calls = 0
+
+    def record(self, adapters: list):
+        with self._lock:
+            self.calls += 1
+            self.rows.update(adapter or BASE_ADAPTER for adapter in adapters)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": shared_base_enabled(),
+                **_LOADED,
+                "calls": self.calls,
+                "rows_per_adapter": dict(self.rows),
+            }
+
+
+ADAPTER_STATS = AdapterStats()
+
+
+def adapter_stats() -> dict:
+    return ADAPTER_STATS.snapshot()
@@ -0,0 +1,145 @@
+# agents/budgets.py - Generation budgets derived from style and agent role
+
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+# Rough tokens-per-unit estimates used to size max_new_tokens
+TOKENS_PER_WORD = 1.6
+TOKENS_PER_HASHTAG = 6
+TOKENS_PER_LINE = 24
+
+_NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+# Whole words only, so "written words" or "phone lines" carry no count
+_NUM = r"\b(\d+|" + "|".join(_NUMBER_WORDS) + r")\b"
+
+_HASHTAG_RE = re.compile(r"#\w+")
+_COMPLETE_HASHTAG_RE = re.compile(r"#\w+(?=\s)")
+_WORD_RE = re.compile(r"\S+")
+
+
+@dataclass(frozen=True)
+class GenerationBudget:
+    """Token cap plus structural limits for one LLM call"""
+    max_new_tokens: int
+    max_lines: Optional[int] = None
+    max_words: Optional[int] = None
+    max_hashtags: Optional[int] = None
+
+    def reached(self, text: str) -> bool:
+        """True once the generated text has hit a structural limit"""
+        if self.max_hashtags is not None:
+            # With a zero limit, stop on the first hashtag and let clip() drop it
+            if len(_COMPLETE_HASHTAG_RE.findall(text)) >= max(self.max_hashtags, 1):
+                return True
+        if self.max_lines is not None:
+            # Count only finished lines so we never stop mid-sentence
+            finished = [l for l in text.split("\n")[:-1] if l.strip()]
+            if len(finished) >= self.max_lines:
+                return True
+        if self.max_words is not None:
+            # A word is finished once whitespace follows it
+            if len(text.split()) > self.max_words or (
+                len(text.split()) == self.max_words and text[-1:].isspace()
+            ):
+                return True
+        return False
+
+    def clip(self, text: str) -> str:
+        """Trim the few trailing characters emitted past a structural limit"""
+        if self.max_hashtags is not None:
+            tags = list(_HASHTAG_RE.finditer(text))
+            if len(tags) > self.max_hashtags:
+                text = text[:tags[self.max_hashtags].start()]
+        if self.max_lines is not None:
+            kept, count = [], 0
+            for line in text.split("\n"):
+                if line.strip():
+                    count += 1
+                if count > self.max_lines:
+                    break
+                kept.append(line)
+            text = "\n".join(kept)
+        if self.max_words is not None:
+            # Same whitespace-delimited words reached() counts
+            words = list(_WORD_RE.finditer(text))
+            if len(words) > self.max_words:
+                text = text[:words[self.max_words - 1].end()] if self.max_words else ""
+        return text.strip()
+
+
+def _to_int(token: str) -> int:
+    return int(token) if token.isdigit() else _NUMBER_WORDS[token]
+
+
+def parse_style(style: str) -> dict:
+    """Extract hashtag, line and word limits from a free-text style string"""
+    style = (style or "").lower()
+    limits = {}
+
+    # "3-4 hashtags", "up to 5 hashtags", "2 hashtags"
+    m = re.search(_NUM + r"\s*(?:-|to|–)\s*" + _NUM + r"\s+hashtags?", style)
+    if m:
+        limits["max_hashtags"] = _to_int(m.group(2))
+    else:
+        m = re.search(_NUM + r"\s+hashtags?", style)
+        if m:
+            limits["max_hashtags"] = _to_int(m.group(1))
+        elif "no hashtag" in style or "without hashtag" in style:
+            limits["max_hashtags"] = 0
+
+    # "under 50 words", "max 30 words", "30-word"
+    m = re.search(_NUM + r"[\s-]+words?", style)
+    if m:
+        limits["max_words"] = _to_int(m.group(1))
+
+    # "2 lines", "3-line"
+    m = re.search(_NUM + r"[\s-]+lines?", style)
+    if m:
+        limits["max_lines"] = _to_int(m.group(1))
+
+    if "short" in style or "brief" in style or "one-liner" in style:
+        limits.setdefault("max_lines", 4)
+        limits.setdefault("max_words", 60)
+
+    return limits
+
+
+# Per-role defaults; the style only tightens the writer/reviewer budgets
+_ROLE_DEFAULTS = {
+    "writer": dict(max_new_tokens=300, max_lines=10),
+    "reviewer": dict(max_new_tokens=300, max_lines=10),
+    "image": dict(max_new_tokens=90, max_words=50, max_lines=3),
+    "compliance": dict(max_new_tokens=60, max_lines=2),
+    "coordinator": dict(max_new_tokens=120, max_lines=4),
+}
+
+
+@lru_cache(maxsize=256)
+def derive_budget(role: str, style: str = "") -> GenerationBudget:
+    """Build the generation budget for an agent role and requested style"""
+    params = dict(_ROLE_DEFAULTS.get(role, _ROLE_DEFAULTS["writer"]))
+
+    if role in ("writer", "reviewer"):
+        limits = parse_style(style)
+        params.update(limits)
+
+        # Size the token cap from the tightest structural limit, with headroom
+        estimates = []
+        if "max_words" in limits:
+            estimates.append(limits["max_words"] * TOKENS_PER_WORD)
+        if "max_lines" in limits:
+            estimates.append(limits["max_lines"] * TOKENS_PER_LINE)
+        if estimates:
+            body = min(estimates)
+            tags = limits.get("max_hashtags") or 0
+            params["max_new_tokens"] = min(
+                params["max_new_tokens"],
+                int(body + tags * TOKENS_PER_HASHTAG + 16),
+            )
+
+    return GenerationBudget(**params)
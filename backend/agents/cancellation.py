@@ -0,0 +1,138 @@
+# agents/cancellation.py - Request deadlines and cooperative cancellation for generation runs
+
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+
+class RequestCancelled(Exception):
+    """Raised at a checkpoint once the request's token has been cancelled"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+
+
+def default_deadline_s() -> Optional[float]:
+    """REQUEST_DEADLINE_S applies when the request does not set deadline_s (0 = none)"""
+    value = float(os.getenv("REQUEST_DEADLINE_S", "0"))
+    return value if value > 0 else None
+
+
+class CancelToken:
+    """
+    Shared by everything working on one generation: the graph loop, HF
+    stopping criteria and streaming cloud calls poll it between steps.
+
+    A coalesced generation serves several clients, so it is attached once
+    per client: the deadline is the latest of theirs, and a disconnect only
+    cancels the run when every attached client has gone.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deadline = None      # monotonic; None = no deadline
+        self._unbounded = False    # some attached client has no deadline
+        self._watchers = 0
+        self._reason = None
+
+    def attach(self, deadline_s: Optional[float] = None):
+        with self._lock:
+            self._watchers += 1
+            if deadline_s is None:
+                self._unbounded = True
+                self._deadline = None
+            elif not self._unbounded:
+                deadline = time.monotonic() + deadline_s
+                self._deadline = max(self._deadline or 0.0, deadline)
+
+    def detach(self):
+        """A client went away; cancel once nobody is left waiting"""
+        with self._lock:
+            self._watchers -= 1
+            if self._watchers <= 0 and self._reason is None:
+                self._reason = "client_disconnected"
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._reason is None:
+                self._reason = reason
+
+    @property
+    def reason(self) -> Optional[str]:
+        if self._reason is None and self._deadline is not None and time.monotonic() >= self._deadline:
+            self._reason = "deadline"
+        return self._reason
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def remaining(self) -> Optional[float]:
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+
+_CURRENT: ContextVar[Optional[CancelToken]] = ContextVar("cancel_token", default=None)
+
+
+def current_token() -> Optional[CancelToken]:
+    return _CURRENT.get()
+
+
+@contextmanager
+def use_token(token: Optional[CancelToken]):
+    """Make token visible to everything called from this context (threads started via copy_context too)"""
+    reset = _CURRENT.set(token)
+    try:
+        yield token
+    finally:
+        _CURRENT.reset(reset)
+
+
+def request_cancelled() -> bool:
+    """True once the current request's deadline passed or its clients disconnected"""
+    token = _CURRENT.get()
+    return token is not None and token.cancelled
+
+
+def check_cancelled():
+    """Raise RequestCancelled if the current request has been cancelled"""
+    token = _CURRENT.get()
+    if token is not None and token.cancelled:
+        raise RequestCancelled(token.reason)
+
+
+# ========== HTTP SIDE ========== #
+
+class FlightTokens:
+    """One token per coalescing key, so every client sharing a generation shares its token"""
+
+    def __init__(self):
+        self._tokens: Dict[str, CancelToken] = {}
+
+    def join(self, key: str, deadline_s: Optional[float]) -> CancelToken:
+        token = self._tokens.get(key)
+        if token is None or token.cancelled:
+            token = self._tokens[key] = CancelToken()
+        token.attach(deadline_s)
+        return token
+
+    def release(self, key: str, token: CancelToken):
+        """Called by the leader when the generation finishes"""
+        if self._tokens.get(key) is token:
+            del self._tokens[key]
+
+
+async def watch_disconnect(http_request, token: CancelToken, poll_s: float = 0.5):
+    """Detach from the token as soon as the client hangs up (run as a task, cancel when done)"""
+    while True:
+        if await http_request.is_disconnected():
+            token.detach()
+            return
+        await asyncio.sleep(poll_s)
@@ -0,0 +1,252 @@
+# agents/capture.py - Record /api/generate traffic and replay it with the recorded model outputs
+
+import atexit
+import hashlib
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from .history import GenerationLog
+
+
+def capture_config() -> dict:
+    """Read traffic capture settings from the environment"""
+    return {
+        "enabled": os.getenv("CAPTURE_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "path": os.getenv("CAPTURE_PATH", "./captures"),
+        "compression": os.getenv("CAPTURE_COMPRESSION", "zstd").strip().lower(),
+        # Fraction of generations recorded (1.0 = all)
+        "sample_rate": float(os.getenv("CAPTURE_SAMPLE_RATE", "1.0")),
+        "segment_bytes": int(float(os.getenv("CAPTURE_SEGMENT_MB", "64")) * 1024 * 1024),
+    }
+
+
+def call_key(*parts: str) -> str:
+    """Identity of one model call: a short hash of its (unfitted) prompts and sampling params"""
+    return hashlib.blake2b("\x1f".join(map(str, parts)).encode("utf-8"), digest_size=8).hexdigest()
+
+
+# The capture or replay session of the request running in this context
+_SESSION: ContextVar = ContextVar("capture_session", default=None)
+
+
+def current_session():
+    return _SESSION.get()
+
+
+# ========== CAPTURE ========== #
+
+class CaptureSession:
+    """The model calls of one generation, in the order they finished"""
+
+    replaying = False
+
+    def __init__(self, started: float):
+        self.started = started  # time.monotonic() at arrival
+        self.calls = []
+        self.result = None
+        self._lock = threading.Lock()  # cloud variants call the endpoint from several threads
+
+    def record(self, role: str, keys: list, outputs: list = None, latency_s: float = 0.0, error: str = None):
+        call = {
+            "role": role,
+            "keys": keys,
+            "at_s": round(time.monotonic() - self.started - latency_s, 4),
+            "latency_s": round(latency_s, 4),
+        }
+        if error is not None:
+            call["error"] = error
+        else:
+            call["outputs"] = outputs
+        with self._lock:
+            self.calls.append(call)
+
+    @property
+    def model_s(self) -> float:
+        return sum(call["latency_s"] for call in self.calls)
+
+
+def result_summary(result: Optional[dict]) -> Optional[dict]:
+    """The parts of a local or cloud result a replay should reproduce exactly"""
+    if result is None:
+        return None
+    metadata = result.get("metadata") or {}
+    return {
+        "text": result.get("reviewed_text", result.get("content")),
+        "image_prompt": result.get("image_prompt"),
+        "compliance_status": result.get("compliance_status"),
+        "iteration": result.get("iteration", metadata.get("iterations")),
+        "variants": len(result.get("variants") or []),
+        "degraded": len(metadata.get("degraded_agents") or []),
+    }
+
+
+@contextmanager
+def capture_request(source: str, request: dict, started: float):
+    """
+    Record every model call made inside the block (worker threads included,
+    since asyncio.to_thread copies the context) and write the generation to
+    the capture log when it exits. Yields the session, or None when this
+    request is not captured; call finish(result) on it before leaving.
+    """
+    log = get_capture_log()
+    if log is None or random.random() >= capture_config()["sample_rate"]:
+        yield None
+        return
+    session = CaptureSession(started)
+    arrived = time.time() - (time.monotonic() - started)
+    reset = _SESSION.set(session)
+    try:
+        yield session
+    finally:
+        _SESSION.reset(reset)
+        log.record({
+            "id": uuid.uuid4().hex,
+            "ts": round(arrived, 4),
+            "source": source,
+            "request": request,
+            "calls": session.calls,
+            "latency_s": round(time.monotonic() - started, 4),
+            "model_s": round(session.model_s, 4),
+            "status": "ok" if session.result is not None and session.result.get("success", True) else "error",
+            "result": result_summary(session.result),
+        })
+        CAPTURE_STATS.count("captured")
+        CAPTURE_STATS.count("calls", len(session.calls))
+
+
+def finish(session: Optional[CaptureSession], result: dict):
+    if session is not None:
+        session.result = result
+
+
+_LOG = None
+_LOG_LOCK = threading.Lock()
+
+
+def get_capture_log() -> Optional[GenerationLog]:
+    """Shared capture log, or None when CAPTURE_ENABLED is off"""
+    global _LOG
+    if _LOG is not None:
+        return _LOG or None
+    with _LOG_LOCK:
+        if _LOG is None:
+            config = capture_config()
+            if not config["enabled"]:
+                _LOG = False
+            else:
+                _LOG = GenerationLog(config["path"], compression=config["compression"],
+                                     segment_bytes=config["segment_bytes"], prefix="capture")
+                atexit.register(_LOG.close)
+        return _LOG or None
+
+
+def read_capture(path: str, source: str = None, limit: int = None) -> list:
+    """Captured generations from a capture directory, oldest arrival first"""
+    log = GenerationLog(path, prefix="capture", readonly=True)
+    records = [record for _, record in log.iter_records() if source is None or record.get("source") == source]
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+
+# ========== REPLAY ========== #
+
+class ReplaySession:
+    """
+    Serves one captured generation's model calls back to the workflow.
+
+    A call is matched by its key first (same role, prompt and params), then
+    by role in capture order, so a build that changes prompt wording still
+    replays; anything left over is answered by `fallback` and counted as a
+    miss. With model_time="recorded" each call also sleeps for its captured
+    latency; the default "zero" leaves pure orchestration time.
+    """
+
+    replaying = True
+
+    def __init__(self, calls: list, fallback: Callable[[str, int], list], model_time: str = "zero"):
+        self.calls = [dict(call, used=False) for call in calls]
+        self.fallback = fallback
+        self.model_time = model_time
+        self.matches = Counter()
+        self.model_s = 0.0
+        self._lock = threading.Lock()
+
+    def _take(self, role: str, keys: list) -> Optional[dict]:
+        with self._lock:
+            for kind, match in (("exact", lambda c: c["keys"] == keys),
+                                ("role", lambda c: c["role"] == role and len(c["keys"]) == len(keys))):
+                for call in self.calls:
+                    if not call["used"] and match(call):
+                        call["used"] = True
+                        self.matches[kind] += 1
+                        return call
+            self.matches["miss"] += 1
+            return None
+
+    def serve(self, role: str, keys: list, count: int) -> list:
+        """Recorded outputs for a call (raises the recorded error for calls that failed)"""
+        call = self._take(role, keys)
+        if call is not None and self.model_time == "recorded":
+            time.sleep(call["latency_s"])
+            with self._lock:
+                self.model_s += call["latency_s"]
+        CAPTURE_STATS.count(f"replay_{'miss' if call is None else 'hit'}")
+        if call is None:
+            return self.fallback(role, count)
+        if "error" in call:
+            raise RuntimeError(f"replayed: {call['error']}")
+        outputs = call["outputs"]
+        if len(outputs) != count:
+            outputs = (outputs * count)[:count] if outputs else self.fallback(role, count)
+        return list(outputs)
+
+    @property
+    def unused(self) -> int:
+        return sum(not call["used"] for call in self.calls)
+
+
+@contextmanager
+def replay_request(session: ReplaySession):
+    """Run the block against a replay session instead of the models"""
+    reset = _SESSION.set(session)
+    try:
+        yield session
+    finally:
+        _SESSION.reset(reset)
+
+
+# ========== STATS ========== #
+
+class CaptureStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def count(self, key: str, n: int = 1):
+        with self._lock:
+            self.counts[key] += n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        log = _LOG or None
+        return {
+            "enabled": log is not None,
+            "sample_rate": capture_config()["sample_rate"],
+            **counts,
+            "log": log.snapshot() if log else None,
+        }
+
+
+CAPTURE_STATS = CaptureStats()
+
+
+def capture_stats() -> dict:
+    return CAPTURE_STATS.snapshot()
@@ -0,0 +1,64 @@
+# agents/coalescing.py - Single-flight deduplication of identical generations
+
+import asyncio
+import re
+from typing import Any, Awaitable, Callable, Dict
+
+
+def normalize_key(*parts) -> str:
+    """Build a request key that ignores case and whitespace differences"""
+    normalized = []
+    for part in parts:
+        text = "" if part is None else str(part)
+        normalized.append(re.sub(r"\s+", " ", text).strip().lower())
+    return "\x1f".join(normalized)
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls that share a key into one execution.
+
+    The first caller for a key (the leader) runs the work; every caller
+    that arrives while it is still in flight awaits the same future and
+    receives the same result (or exception).
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield: a waiter being cancelled must not cancel the leader's work
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.leaders += 1
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.failures += 1
+            future.set_exception(e)
+            # Mark retrieved so a leader-only failure doesn't log "never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.leaders + self.coalesced
+        return {
+            "generations_run": self.leaders,
+            "requests_coalesced": self.coalesced,
+            "in_flight": len(self._inflight),
+            "failures": self.failures,
+            "coalesce_rate": round(self.coalesced / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,170 @@
+# agents/compact_state.py - Allocation-light checkpointing for the workflow graph
+
+import os
+import threading
+from collections import OrderedDict, defaultdict
+
+from langgraph.checkpoint.memory import InMemorySaver
+
+# Serialized values smaller than this are cheaper to copy than to pool
+_MIN_POOLED_BYTES = 64
+
+
+def state_config() -> dict:
+    """Read checkpoint settings from the environment"""
+    return {
+        # compact: pooled blobs, bounded history, threads released after each request
+        # full: plain MemorySaver that keeps every checkpoint of every request
+        "mode": os.getenv("STATE_CHECKPOINTS", "compact").strip().lower(),
+        "max_checkpoints": int(os.getenv("STATE_MAX_CHECKPOINTS", "4")),
+    }
+
+
+class TextPool:
+    """Bounded intern table so repeated agent outputs share one str object"""
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self._texts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def intern(self, text: str) -> str:
+        if not text:
+            return text
+        with self._lock:
+            shared = self._texts.get(text)
+            if shared is not None:
+                self._texts.move_to_end(text)
+                return shared
+            self._texts[text] = text
+            if len(self._texts) > self.capacity:
+                self._texts.popitem(last=False)
+            return text
+
+
+TEXT_POOL = TextPool()
+
+
+def intern_text(text: str) -> str:
+    return TEXT_POOL.intern(text)
+
+
+class _BlobPool:
+    """Reference-counted pool of serialized values shared across checkpoints and threads"""
+
+    def __init__(self):
+        self._refs = {}
+
+    def acquire(self, data: bytes) -> bytes:
+        if len(data) < _MIN_POOLED_BYTES:
+            return data
+        entry = self._refs.get(data)
+        if entry is None:
+            self._refs[data] = entry = [data, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, data: bytes):
+        entry = self._refs.get(data)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._refs[data]
+
+    def __len__(self):
+        return len(self._refs)
+
+
+class CompactMemorySaver(InMemorySaver):
+    """
+    In-memory checkpointer tuned for one-shot request graphs.
+
+    On top of InMemorySaver's per-channel versioned blobs (so each checkpoint
+    only stores the fields a node actually wrote), it:
+      - pools identical serialized values, so echoed prompts, repeated
+        feedback and unchanged text are stored once across iterations/threads
+      - keeps at most max_checkpoints per thread, dropping older checkpoints
+        and the blob versions only they referenced
+      - lets callers release a thread's checkpoints once the request is done
+    """
+
+    def __init__(self, max_checkpoints: int = 4, **kwargs):
+        super().__init__(**kwargs)
+        self.max_checkpoints = max(1, max_checkpoints)
+        self._pool = _BlobPool()
+        self._thread_blobs = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def _pool_value(self, typed):
+        kind, data = typed
+        return (kind, self._pool.acquire(data)) if isinstance(data, bytes) else typed
+
+    def _release_value(self, typed):
+        if isinstance(typed[1], bytes):
+            self._pool.release(typed[1])
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self._lock:
+            result = super().put(config, checkpoint, metadata, new_versions)
+            thread_id = config["configurable"]["thread_id"]
+            checkpoint_ns = config["configurable"]["checkpoint_ns"]
+            keys = self._thread_blobs[(thread_id, checkpoint_ns)]
+            for channel, version in new_versions.items():
+                key = (thread_id, checkpoint_ns, channel, version)
+                if key in keys:
+                    self._release_value(self.blobs[key])
+                self.blobs[key] = self._pool_value(self.blobs[key])
+                keys.add(key)
+            self._prune(thread_id, checkpoint_ns)
+            return result
+
+    def _prune(self, thread_id: str, checkpoint_ns: str):
+        """Drop checkpoints beyond max_checkpoints and blobs nothing retained references"""
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= self.max_checkpoints:
+            return
+        ordered = sorted(checkpoints)
+        for checkpoint_id in ordered[:-self.max_checkpoints]:
+            del checkpoints[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+        # Channel versions only grow, so anything older than what the oldest
+        # retained checkpoint points at is unreachable
+        oldest = self.serde.loads_typed(checkpoints[ordered[-self.max_checkpoints]][0])
+        floor = oldest["channel_versions"]
+        keys = self._thread_blobs[(thread_id, checkpoint_ns)]
+        for key in [k for k in keys if k[2] in floor and k[3] < floor[k[2]]]:
+            self._release_value(self.blobs.pop(key))
+            keys.discard(key)
+
+    def delete_thread(self, thread_id: str):
+        with self._lock:
+            for scope in [s for s in self._thread_blobs if s[0] == thread_id]:
+                for key in self._thread_blobs.pop(scope):
+                    if key in self.blobs:
+                        self._release_value(self.blobs[key])
+            super().delete_thread(thread_id)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "threads": len(self.storage),
+                "checkpoints": sum(len(c) for ns in self.storage.values() for c in ns.values()),
+                "blobs": len(self.blobs),
+                "pooled_values": len(self._pool),
+            }
+
+
+def release_thread(checkpointer, thread_id: str):
+    """Free a finished request's checkpoints (no-op for the full-history saver)"""
+    if isinstance(checkpointer, CompactMemorySaver):
+        checkpointer.delete_thread(thread_id)
+
+
+def make_checkpointer(config: dict = None):
+    """Checkpointer for the workflow graph according to STATE_CHECKPOINTS"""
+    config = config or state_config()
+    if config["mode"] == "full":
+        return InMemorySaver()
+    return CompactMemorySaver(max_checkpoints=config["max_checkpoints"])
@@ -0,0 +1,228 @@
+# agents/context.py - Token-budgeted prompt assembly
+
+import re
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, replace
+from typing import List, Optional
+
+# Joins between sections can merge or split a token; leave room for it
+JOIN_SLACK = 8
+# A shrunk section keeps at least this many tokens (otherwise it is dropped)
+MIN_SECTION_TOKENS = 12
+
+_SENTENCE_RE = re.compile(r"[^.!?\n]+[.!?]*\s*|\n")
+_LIST_MARKER_RE = re.compile(r"\s*(\d+|[a-z])[.)]\s*$", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Section:
+    """One part of a prompt: a label kept verbatim plus a body that may be compressed"""
+    name: str
+    body: str
+    label: str = ""
+    max_tokens: Optional[int] = None  # cap applied even when the prompt fits
+    priority: int = 1                 # lowest priority is shrunk first when over budget
+    fixed: bool = False               # never cut (task suffix)
+    required: bool = False            # may be shrunk but never dropped
+    keep: str = "head"                # which end survives compression: head = oldest text, tail = newest
+
+    def render(self) -> str:
+        return f"{self.label}{self.body}"
+
+
+class Prompt(str):
+    """
+    A prompt string that remembers its sections, so chat() can fit it to the
+    model's input budget section by section. Anywhere a str is expected it
+    is just the full, uncompressed prompt.
+    """
+
+    def __new__(cls, sections: List[Section], sep: str = "\n"):
+        sections = [s for s in sections if s.fixed or s.body.strip()]
+        prompt = super().__new__(cls, sep.join(s.render() for s in sections))
+        prompt.sections = sections
+        prompt.sep = sep
+        return prompt
+
+
+# ========== TOKEN COUNTS ========== #
+
+class TokenCounter:
+    """Bounded cache of token counts per (tokenizer, text); prompt sections repeat across calls"""
+
+    def __init__(self, max_entries: int = 8192):
+        self.max_entries = max_entries
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, tokenizer, text: str) -> int:
+        if not text:
+            return 0
+        key = (id(tokenizer), text)
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return self._counts[key]
+        n = len(tokenizer.encode(text, add_special_tokens=False))
+        with self._lock:
+            self.misses += 1
+            self._counts[key] = n
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return n
+
+
+TOKEN_COUNTS = TokenCounter()
+
+
+# ========== COMPRESSION ========== #
+
+def _sentences(text: str) -> list:
+    sentences = []
+    for match in _SENTENCE_RE.finditer(text):
+        sentence = match.group(0)
+        if sentences and _LIST_MARKER_RE.fullmatch(sentences[-1]):
+            sentences[-1] += sentence  # "1." belongs to the item that follows
+        elif sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+def _dedupe(text: str) -> str:
+    """Drop repeated sentences and collapse whitespace (models echo prompts and repeat feedback)"""
+    seen = set()
+    kept = []
+    for sentence in _sentences(text):
+        key = " ".join(sentence.lower().split())
+        if key and key in seen:
+            continue
+        seen.add(key)
+        kept.append(sentence)
+    text = "".join(kept)
+    text = re.sub(r"[ \t]+", " ", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def compress(tokenizer, text: str, max_tokens: int, keep: str = "head") -> str:
+    """
+    Extractive compression to max_tokens: de-duplicate, then keep whole
+    sentences from the chosen end, cutting mid-sentence only when a single
+    sentence is over budget.
+    """
+    text = _dedupe(text)
+    if TOKEN_COUNTS.count(tokenizer, text) <= max_tokens:
+        return text
+    budget = max_tokens - 1  # room for the ellipsis
+    sentences = _sentences(text)
+    if keep == "tail":
+        sentences.reverse()
+    kept, used = [], 0
+    for sentence in sentences:
+        n = TOKEN_COUNTS.count(tokenizer, sentence)
+        if used + n > budget:
+            break
+        kept.append(sentence)
+        used += n
+    if not kept:
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        ids = ids[:budget] if keep == "head" else ids[-budget:]
+        kept = [tokenizer.decode(ids, skip_special_tokens=True)]
+    if keep == "tail":
+        return "…" + "".join(reversed(kept)).strip()
+    return "".join(kept).strip() + "…"
+
+
+# ========== ASSEMBLY ========== #
+
+def _as_prompt(user_prompt: str) -> Prompt:
+    """A plain string: the last paragraph is the task and stays, the rest may be cut"""
+    if isinstance(user_prompt, Prompt):
+        return user_prompt
+    body, sep, task = user_prompt.rpartition("\n\n")
+    if not sep:
+        return Prompt([Section("body", user_prompt)])
+    return Prompt([Section("body", body), Section("task", task, fixed=True)], sep="\n\n")
+
+
+def fit_prompt(tokenizer, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+    """
+    "system\n\nuser" within max_tokens. Sections over their own cap are
+    compressed first; if the prompt is still too long, sections are shrunk
+    lowest priority first and dropped (unless required) if nothing useful
+    is left. Fixed sections, such as the trailing instruction, are never touched.
+    """
+    prompt = _as_prompt(user_prompt)
+    sections = list(prompt.sections)
+    count = lambda text: TOKEN_COUNTS.count(tokenizer, text)
+
+    for i, section in enumerate(sections):
+        if not section.fixed and section.max_tokens and count(section.body) > section.max_tokens:
+            sections[i] = replace(section, body=compress(tokenizer, section.body, section.max_tokens, section.keep))
+            CONTEXT_STATS.count("capped")
+
+    budget = max_tokens - count(system_prompt) - tokenizer.num_special_tokens_to_add() - JOIN_SLACK
+    over = sum(count(s.render()) for s in sections) + len(sections) - 1 - budget
+    for i in sorted((i for i, s in enumerate(sections) if not s.fixed), key=lambda i: sections[i].priority):
+        if over <= 0:
+            break
+        section = sections[i]
+        size = count(section.body)
+        target = size - over
+        if target >= MIN_SECTION_TOKENS or section.required:
+            sections[i] = replace(section, body=compress(tokenizer, section.body, max(target, 2), section.keep))
+            over -= size - count(sections[i].body)
+            CONTEXT_STATS.count("shrunk")
+        else:
+            # Dropping also frees the label and the separator
+            sections[i] = replace(section, body="")
+            over -= count(section.render()) + 1
+            CONTEXT_STATS.count("dropped")
+
+    fitted = Prompt(sections, prompt.sep)
+    CONTEXT_STATS.record(sum(count(s.render()) for s in prompt.sections),
+                         sum(count(s.render()) for s in fitted.sections))
+    combined = f"{system_prompt}\n\n{fitted}"
+    if over > 0:
+        # Fixed sections alone exceed the budget: cut from the front so the task survives
+        ids = tokenizer.encode(combined, add_special_tokens=False)
+        combined = tokenizer.decode(ids[-(max_tokens - tokenizer.num_special_tokens_to_add()):],
+                                    skip_special_tokens=True)
+        CONTEXT_STATS.count("overflow")
+    return combined
+
+
+# ========== STATS ========== #
+
+class ContextStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def record(self, before: int, after: int):
+        with self._lock:
+            self.counts["prompts"] += 1
+            self.counts["tokens_in"] += before
+            self.counts["tokens_saved"] += before - after
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        return {
+            **counts,
+            "token_count_cache": {"hits": TOKEN_COUNTS.hits, "misses": TOKEN_COUNTS.misses},
+        }
+
+
+CONTEXT_STATS = ContextStats()
+
+
+def context_stats() -> dict:
+    return CONTEXT_STATS.snapshot()
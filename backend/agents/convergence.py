@@ -0,0 +1,135 @@
+# agents/convergence.py - Iteration budgets and early exit for the compliance revision loop
+
+import os
+import threading
+from collections import Counter
+from dataclasses import dataclass, replace
+from difflib import SequenceMatcher
+from typing import Optional
+
+# Stop reasons that end the loop before its iteration budget is spent
+EARLY_EXITS = ("feedback_repeated", "draft_repeated", "no_improvement")
+
+
+@dataclass(frozen=True)
+class IterationPolicy:
+    """How many revision rounds a request may use and when to give up early"""
+    name: str
+    max_iterations: int
+    early_exit: bool = True
+    similarity: float = 0.9   # feedback or draft this close to the previous round counts as a repeat
+    min_gain: float = 0.0     # a revision must beat the best score so far by more than this to reset patience
+    patience: int = 1         # rounds scoring below the best so far tolerated before stopping
+
+
+POLICIES = {
+    "fast": IterationPolicy("fast", max_iterations=1),
+    "balanced": IterationPolicy("balanced", max_iterations=3),
+    "thorough": IterationPolicy("thorough", max_iterations=5, patience=2),
+    # The original loop: up to 3 rounds, no early exit
+    "fixed": IterationPolicy("fixed", max_iterations=3, early_exit=False),
+}
+
+
+def convergence_config() -> dict:
+    """Read the default policy and thresholds from the environment"""
+    return {
+        "policy": os.getenv("ITERATION_POLICY", "balanced").strip().lower(),
+        "similarity": float(os.getenv("CONVERGENCE_SIMILARITY", "0.9")),
+        "min_gain": float(os.getenv("CONVERGENCE_MIN_GAIN", "0")),
+    }
+
+
+def resolve_policy(name: Optional[str] = None, max_iterations: Optional[int] = None) -> IterationPolicy:
+    """Named policy (default ITERATION_POLICY) with the env thresholds and an optional iteration cap"""
+    config = convergence_config()
+    policy = POLICIES.get((name or config["policy"]).lower(), POLICIES["balanced"])
+    policy = replace(policy, similarity=config["similarity"], min_gain=config["min_gain"])
+    if max_iterations:
+        policy = replace(policy, max_iterations=max_iterations)
+    return policy
+
+
+def similarity(a: str, b: str) -> float:
+    """0..1 similarity of two texts, ignoring case and whitespace"""
+    a, b = " ".join(a.lower().split()), " ".join(b.lower().split())
+    if not a or not b:
+        return 0.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def convergence_update(state: dict, text: str, feedback: str, score: float, policy: IterationPolicy,
+                       max_score: float = 1.0) -> dict:
+    """
+    State keys to merge after a NEEDS_CHANGES round. stop_reason is set
+    when another round is not expected to help: the compliance feedback or
+    the draft barely changed since the previous round, or `patience` rounds
+    scored below the best draft so far.
+
+    Only a drop counts against a round: a tie says nothing about the
+    compliance issue, and a draft already at max_score cannot show progress
+    on the score at all, so then only the repeat checks apply.
+    """
+    best = state.get("best_score")
+    stale = state.get("stale_rounds", 0)
+    if best is None or best >= max_score or score > best + policy.min_gain:
+        stale = 0
+    elif score < best:
+        stale += 1
+    update = {
+        "last_feedback": feedback,
+        "last_text": text,
+        "best_score": score if best is None else max(best, score),
+        "stale_rounds": stale,
+    }
+    if not policy.early_exit:
+        return update
+    if state.get("last_feedback") and similarity(feedback, state["last_feedback"]) >= policy.similarity:
+        update["stop_reason"] = "feedback_repeated"
+    elif state.get("last_text") and similarity(text, state["last_text"]) >= policy.similarity:
+        update["stop_reason"] = "draft_repeated"
+    elif stale >= policy.patience:
+        update["stop_reason"] = "no_improvement"
+    return update
+
+
+# ========== STATS ========== #
+
+class ConvergenceStats:
+    """Histograms of revision rounds used and rounds saved by early exit"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.used = Counter()
+        self.saved = Counter()
+        self.reasons = Counter()
+        self.policies = Counter()
+
+    def record(self, policy: IterationPolicy, iterations: int, reason: str):
+        saved = max(0, policy.max_iterations - iterations) if reason in EARLY_EXITS else 0
+        with self._lock:
+            self.used[iterations] += 1
+            self.saved[saved] += 1
+            self.reasons[reason] += 1
+            self.policies[policy.name] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            runs = sum(self.used.values())
+            return {
+                "default_policy": convergence_config()["policy"],
+                "runs": runs,
+                "iterations_used": {str(k): v for k, v in sorted(self.used.items())},
+                "iterations_saved": {str(k): v for k, v in sorted(self.saved.items())},
+                "total_iterations_saved": sum(k * v for k, v in self.saved.items()),
+                "mean_iterations": round(sum(k * v for k, v in self.used.items()) / runs, 3) if runs else None,
+                "stop_reasons": dict(self.reasons),
+                "policies": dict(self.policies),
+            }
+
+
+CONVERGENCE_STATS = ConvergenceStats()
+
+
+def convergence_stats() -> dict:
+    return CONVERGENCE_STATS.snapshot()
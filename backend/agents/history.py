@@ -0,0 +1,374 @@
+# agents/history.py - Append-only, compressed generation log with streaming export and bulk ingest
+
+import atexit
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from pathlib import Path
+from collections import Counter
+from typing import AsyncIterator, Iterable, Iterator, Optional, Tuple
+
+
+def history_config() -> dict:
+    """Read generation log settings from the environment"""
+    return {
+        "enabled": os.getenv("HISTORY_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "path": os.getenv("HISTORY_PATH", "./history"),
+        # zstd needs the optional zstandard package; gzip is always available
+        "compression": os.getenv("HISTORY_COMPRESSION", "zstd").strip().lower(),
+        "segment_bytes": int(float(os.getenv("HISTORY_SEGMENT_MB", "64")) * 1024 * 1024),
+        "queue_size": int(os.getenv("HISTORY_QUEUE_SIZE", "10000")),
+        "flush_every": int(os.getenv("HISTORY_FLUSH_EVERY", "50")),
+        "flush_interval_s": float(os.getenv("HISTORY_FLUSH_INTERVAL_S", "2")),
+    }
+
+
+# ========== FRAMING ========== #
+
+class _Codec:
+    """Each flush is one self-contained gzip member / zstd frame appended to the segment"""
+
+    def __init__(self, name: str):
+        self.name = name
+        if name == "zstd":
+            import zstandard
+            self._zstd = zstandard
+            self.suffix = ".jsonl.zst"
+        else:
+            self.suffix = ".jsonl.gz"
+
+    def compress(self, data: bytes) -> bytes:
+        if self.name == "zstd":
+            return self._zstd.ZstdCompressor(level=3).compress(data)
+        return gzip.compress(data, compresslevel=6)
+
+    @staticmethod
+    def reader(path: Path, size: int) -> io.TextIOBase:
+        """Line reader over the first `size` bytes, so a frame being appended is never read half-written"""
+        raw = _BoundedReader(open(path, "rb"), size)
+        if path.name.endswith(".zst"):
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        else:
+            stream = gzip.GzipFile(fileobj=raw)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+class _BoundedReader(io.RawIOBase):
+    def __init__(self, f, limit: int):
+        self._f = f
+        self._left = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._left <= 0:
+            return 0
+        view = memoryview(buffer)[:self._left]
+        n = self._f.readinto(view)
+        self._left -= n or 0
+        return n or 0
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+
+def _make_codec(name: str) -> _Codec:
+    if name == "zstd":
+        try:
+            return _Codec("zstd")
+        except ImportError:
+            print("⚠️  HISTORY_COMPRESSION=zstd but zstandard is not installed; using gzip")
+    return _Codec("gzip")
+
+
+# ========== LOG ========== #
+
+class GenerationLog:
+    """
+    Segments named <prefix>-NNNNNN.jsonl.{zst,gz} (prefix "history" by
+    default), rotated by compressed size.
+
+    Records are queued by request handlers and written by one background
+    thread in batches, so the request path never touches the disk. A cursor
+    "NNNNNN:K" points at line K of segment NNNNNN.
+    """
+
+    def __init__(self, path: str, compression: str = "zstd", segment_bytes: int = 64 * 1024 * 1024,
+                 queue_size: int = 10000, flush_every: int = 50, flush_interval_s: float = 2.0,
+                 prefix: str = "history", readonly: bool = False):
+        self.path = Path(path)
+        self.prefix = prefix
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.codec = _make_codec(compression)
+        self.segment_bytes = segment_bytes
+        self.flush_every = flush_every
+        self.flush_interval_s = flush_interval_s
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()  # guards segment files and sizes
+        self.stats = {"written": 0, "dropped": 0, "flushes": 0, "write_errors": 0}
+
+        segments = self.segments()
+        self._segment = segments[-1][0] if segments else 1
+        if segments and not segments[-1][1].name.endswith(self.codec.suffix):
+            self._segment += 1  # compression changed since the last run
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{prefix}-writer", daemon=True)
+        if not readonly:  # readers of an existing log (tools) need no writer thread
+            self._thread.start()
+
+    # ----- writing ----- #
+
+    def record(self, entry: dict):
+        """Queue one record; never blocks the caller (drops and counts when the queue is full)"""
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _segment_path(self, seq: int, suffix: str = None) -> Path:
+        return self.path / f"{self.prefix}-{seq:06d}{suffix or self.codec.suffix}"
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval_s
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch.append(self._queue.get(timeout=max(0.05, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            draining = self._stop.is_set() and self._queue.empty()
+            if batch and (len(batch) >= self.flush_every or time.monotonic() >= deadline or draining):
+                self._write(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval_s
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch: list):
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch).encode("utf-8")
+        frame = self.codec.compress(data)
+        try:
+            with self._lock:
+                path = self._segment_path(self._segment)
+                if path.exists() and path.stat().st_size + len(frame) > self.segment_bytes:
+                    self._segment += 1
+                    path = self._segment_path(self._segment)
+                with open(path, "ab") as f:
+                    f.write(frame)
+            self.stats["written"] += len(batch)
+            self.stats["flushes"] += 1
+        except OSError as e:
+            self.stats["write_errors"] += 1
+            print(f"⚠️  {self.prefix.capitalize()} write failed: {e}")
+
+    def close(self, timeout: float = 10.0):
+        """Flush everything queued and stop the writer"""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    # ----- reading ----- #
+
+    def segments(self):
+        """[(seq, path)] in order, whatever codec each segment was written with"""
+        found = []
+        for path in self.path.glob(f"{self.prefix}-*.jsonl.*"):
+            try:
+                found.append((int(path.name[len(self.prefix) + 1:].split(".")[0]), path))
+            except ValueError:
+                continue
+        return sorted(found)
+
+    def iter_records(self, cursor: Optional[str] = None, limit: Optional[int] = None
+                     ) -> Iterator[Tuple[str, dict]]:
+        """
+        Stream (next_cursor, record) pairs starting at cursor, one line at a
+        time; memory stays flat however large the log is.
+        """
+        start_seq, start_line = 0, 0
+        if cursor:
+            seq, _, line = cursor.partition(":")
+            start_seq, start_line = int(seq), int(line or 0)
+        emitted = 0
+        for seq, path in self.segments():
+            if seq < start_seq:
+                continue
+            with self._lock:
+                size = path.stat().st_size  # only complete frames
+            skip = start_line if seq == start_seq else 0
+            with self.codec.reader(path, size) as lines:
+                for index, line in enumerate(lines):
+                    if index < skip or not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    yield f"{seq:06d}:{index + 1}", record
+                    emitted += 1
+                    if limit is not None and emitted >= limit:
+                        return
+
+    def snapshot(self) -> dict:
+        segments = self.segments()
+        return {
+            "enabled": True,
+            "compression": self.codec.name,
+            "path": str(self.path),
+            "segments": len(segments),
+            "bytes": sum(path.stat().st_size for _, path in segments),
+            "queued": self._queue.qsize(),
+            **self.stats,
+        }
+
+
+_LOG = None
+_LOG_LOCK = threading.Lock()
+
+
+def get_history() -> Optional[GenerationLog]:
+    """Shared generation log, or None when HISTORY_ENABLED is off"""
+    global _LOG
+    if _LOG is not None:
+        return _LOG or None
+    with _LOG_LOCK:
+        if _LOG is None:
+            config = history_config()
+            if not config["enabled"]:
+                _LOG = False
+            else:
+                _LOG = GenerationLog(
+                    config["path"],
+                    compression=config["compression"],
+                    segment_bytes=config["segment_bytes"],
+                    queue_size=config["queue_size"],
+                    flush_every=config["flush_every"],
+                    flush_interval_s=config["flush_interval_s"],
+                )
+                atexit.register(_LOG.close)
+        return _LOG or None
+
+
+def valid_cursor(cursor: Optional[str]) -> bool:
+    if not cursor:
+        return True
+    seq, sep, line = cursor.partition(":")
+    return seq.isdigit() and (not sep or line.isdigit())
+
+
+def record_generation(source: str, request: dict, result: dict):
+    """Append one finished generation (no-op when the log is disabled)"""
+    log = get_history()
+    if log is not None:
+        log.record({
+            "id": uuid.uuid4().hex,
+            "ts": time.time(),
+            "source": source,
+            "request": request,
+            "result": result,
+        })
+
+
+def history_stats() -> dict:
+    log = _LOG or None
+    return log.snapshot() if log else {"enabled": False}
+
+
+# ========== BULK INGEST ========== #
+
+def _cache_entry(record: dict) -> Optional[dict]:
+    """The result as the semantic cache stores it, or None if it should not be served again"""
+    request, result = record.get("request") or {}, dict(record.get("result") or {})
+    metadata = dict(result.get("metadata") or {})
+    if request.get("num_variants", 1) != 1 or result.get("compliance_status") != "approved":
+        return None
+    if metadata.get("degraded"):
+        return None
+    for key in ("elapsed_time", "semantic_cache", "variants"):
+        result.pop(key, None)
+    if metadata:
+        metadata.pop("semantic_cache", None)
+        result["metadata"] = metadata
+    return result
+
+
+def rebuild_caches(records: Iterable[dict], source: str) -> dict:
+    """
+    Re-seed the semantic cache from history records written by `source`
+    (local and cloud results have different shapes). Returns counts.
+    """
+    from .semantic_cache import get_semantic_cache, normalize_brief
+
+    counts = {"records": 0, "cached": 0, "skipped": 0}
+    cache = get_semantic_cache()
+    for record in records:
+        counts["records"] += 1
+        entry = _cache_entry(record) if record.get("source") == source else None
+        if cache is None or entry is None:
+            counts["skipped"] += 1
+            continue
+        request = record["request"]
+        cache.add(normalize_brief(request.get("user_instruction"), request.get("tone"), request.get("style")), entry)
+        counts["cached"] += 1
+    if cache is None:
+        counts["note"] = "semantic cache disabled; nothing to rebuild"
+    return counts
+
+
+async def ingest_ndjson(chunks: AsyncIterator[bytes], source: str, append: bool = False,
+                        batch_size: int = 200) -> dict:
+    """
+    Bulk-ingest an NDJSON body chunk by chunk: approved results re-seed the
+    semantic cache, and with append=True records are also added to the log.
+    An empty body replays this server's own log instead.
+    """
+    import asyncio
+
+    totals = Counter()
+    batch = []
+    buffer = b""
+    log = get_history()
+
+    async def flush():
+        counts = await asyncio.to_thread(rebuild_caches, list(batch), source)
+        totals.update({k: v for k, v in counts.items() if isinstance(v, int)})
+        if append and log is not None:
+            for record in batch:
+                log.record(record)
+        batch.clear()
+
+    def take(line: bytes):
+        if not line.strip():
+            return
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            totals["malformed"] += 1
+            return
+        record.pop("cursor", None)  # added by the export endpoint
+        batch.append(record)
+
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            take(line)
+        if len(batch) >= batch_size:
+            await flush()
+    take(buffer)
+    if batch:
+        await flush()
+
+    if not totals["records"] and not totals["malformed"] and log is not None:
+        counts = await asyncio.to_thread(rebuild_caches, (r for _, r in log.iter_records()), source)
+        totals.update({k: v for k, v in counts.items() if isinstance(v, int)})
+        totals["replayed_from_log"] = 1
+    return dict(totals)
@@ -0,0 +1,254 @@
+# agents/kv_cache.py - KV-cache strategies for local generation: dynamic, preallocated static, quantized
+
+import importlib.util
+import math
+import os
+import threading
+import weakref
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+STRATEGIES = ("dynamic", "static", "quantized")
+# transformers' names for the quantized-cache backends
+_QUANT_BACKENDS = {"quanto": ("quanto", "optimum.quanto"), "hqq": ("HQQ", "hqq")}
+
+
+def kv_cache_config() -> dict:
+    """Read KV-cache settings from the environment"""
+    strategy = os.getenv("KV_CACHE", "dynamic").strip().lower()
+    return {
+        "strategy": strategy if strategy in STRATEGIES else "dynamic",
+        # static: caches are sized to prompt + new tokens rounded up to this, so shapes repeat
+        "bucket": max(1, int(os.getenv("KV_CACHE_BUCKET", "256"))),
+        # static: idle caches kept per (batch rows, length) shape for reuse
+        "pool_size": int(os.getenv("KV_CACHE_POOL_SIZE", "2")),
+        # static: idle caches kept across all shapes, least recently used freed first
+        "pool_bytes": int(float(os.getenv("KV_CACHE_POOL_MB", "512")) * 2**20),
+        # quantized: quanto (optimum-quanto) or hqq
+        "quant_backend": os.getenv("KV_CACHE_QUANT_BACKEND", "quanto").strip().lower(),
+        "nbits": int(os.getenv("KV_CACHE_NBITS", "4")),
+        # quantized: most recent tokens kept in full precision
+        "residual_length": int(os.getenv("KV_CACHE_RESIDUAL", "128")),
+    }
+
+
+def static_length(max_tokens: int, bucket: int) -> int:
+    """Static cache length for up to max_tokens (prompt + new), with room for special tokens"""
+    return math.ceil((max_tokens + 16) / bucket) * bucket
+
+
+def _installed(module: str) -> bool:
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ModuleNotFoundError:  # parent package missing
+        return False
+
+
+def _single_device(model) -> bool:
+    device_map = getattr(model, "hf_device_map", None) or {}
+    return len(set(device_map.values())) <= 1
+
+
+# ========== STATIC CACHE POOL ========== #
+
+class StaticCachePool:
+    """
+    Preallocated StaticCaches, checked out for one generate() call at a time
+    (two calls never share a cache) and reset for the next. Memory is fixed
+    per shape instead of growing token by token, so long batched runs stop
+    fragmenting the allocator. Idle caches beyond pool_size per shape, or
+    beyond pool_bytes in total, are freed least recently used first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # model -> {(rows, length, device): [idle caches]}; entries vanish with the model
+        self._idle = weakref.WeakKeyDictionary()
+        # id(cache) -> (model ref, shape key, bytes) of every idle cache, oldest release first
+        self._lru = OrderedDict()
+        self.idle_bytes = 0
+
+    def acquire(self, model, rows: int, length: int):
+        from transformers import StaticCache
+
+        key = (rows, length, str(model.device))
+        with self._lock:
+            idle = self._idle.setdefault(model, {}).get(key)
+            if idle:
+                cache = idle.pop()
+                self.idle_bytes -= self._lru.pop(id(cache))[2]
+                KV_CACHE_STATS.count("static_reuses")
+            else:
+                cache = None
+        if cache is None:
+            cache = StaticCache(config=model.config, max_batch_size=rows, max_cache_len=length,
+                                device=model.device, dtype=model.dtype)
+            KV_CACHE_STATS.allocated(cache_bytes(cache))
+        else:
+            cache.reset()
+        return key, cache
+
+    def release(self, model, key, cache, pool_size: int, pool_bytes: int):
+        nbytes = cache_bytes(cache)
+        freed = []
+        with self._lock:
+            self._forget_collected()
+            idle = self._idle.setdefault(model, {}).setdefault(key, [])
+            if len(idle) >= pool_size or nbytes > pool_bytes:
+                freed.append(nbytes)
+            else:
+                idle.append(cache)
+                self._lru[id(cache)] = (weakref.ref(model), key, nbytes)
+                self.idle_bytes += nbytes
+                while self.idle_bytes > pool_bytes:
+                    freed.append(self._evict_oldest())
+        for n in freed:
+            KV_CACHE_STATS.freed(n)
+
+    def _forget_collected(self):
+        """Drop LRU entries of models that were garbage collected with their caches (caller holds the lock)"""
+        for cache_id, (model_ref, _, nbytes) in list(self._lru.items()):
+            if model_ref() is None:
+                del self._lru[cache_id]
+                self.idle_bytes -= nbytes
+
+    def _evict_oldest(self) -> int:
+        """Forget the least recently released idle cache (caller holds the lock); returns its bytes"""
+        cache_id, (model_ref, key, nbytes) = self._lru.popitem(last=False)
+        self.idle_bytes -= nbytes
+        model = model_ref()
+        idle = self._idle.get(model, {}).get(key, []) if model is not None else []
+        for i, cache in enumerate(idle):
+            if id(cache) == cache_id:
+                del idle[i]
+                break
+        if idle == [] and model is not None:
+            self._idle[model].pop(key, None)
+        KV_CACHE_STATS.count("static_lru_evictions")
+        return nbytes
+
+    def drop(self, model):
+        """Free every idle cache of a model (it is being evicted or moved)"""
+        with self._lock:
+            shapes = self._idle.pop(model, {})
+            freed = []
+            for caches in shapes.values():
+                for cache in caches:
+                    nbytes = self._lru.pop(id(cache))[2]
+                    self.idle_bytes -= nbytes
+                    freed.append(nbytes)
+        for n in freed:
+            KV_CACHE_STATS.freed(n)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            caches = [c for shapes in self._idle.values() for idle in shapes.values() for c in idle]
+        return {"idle_caches": len(caches), "idle_mb": round(sum(map(cache_bytes, caches)) / 2**20, 1),
+                "idle_cap_mb": round(kv_cache_config()["pool_bytes"] / 2**20, 1)}
+
+
+def cache_bytes(cache) -> int:
+    return sum(t.numel() * t.element_size() for t in (*cache.key_cache, *cache.value_cache))
+
+
+KV_CACHE_POOL = StaticCachePool()
+
+
+# ========== PER-CALL KWARGS ========== #
+
+_WARNED = set()
+
+
+def _fallback(reason: str, message: str) -> dict:
+    KV_CACHE_STATS.count(f"fallback_{reason}")
+    if reason not in _WARNED:
+        _WARNED.add(reason)
+        print(f"⚠️  {message}; using the dynamic KV cache")
+    return {}
+
+
+@contextmanager
+def kv_cache(model, rows: int, max_tokens: int, config: dict = None):
+    """
+    generate() kwargs for the configured KV-cache strategy, for a call of
+    `rows` sequences (prompts x num_return_sequences) of up to max_tokens
+    (prompt + new). Empty for the default dynamic cache or when the model
+    cannot use the strategy.
+    """
+    config = config or kv_cache_config()
+    strategy = config["strategy"]
+    if strategy == "static":
+        if not getattr(model, "_supports_static_cache", False):
+            yield _fallback("static_unsupported", f"{type(model).__name__} has no static KV cache support")
+            return
+        if not _single_device(model):
+            yield _fallback("static_multi_device", "Static KV cache needs a single-device model")
+            return
+        key, cache = KV_CACHE_POOL.acquire(model, rows, static_length(max_tokens, config["bucket"]))
+        KV_CACHE_STATS.count("static")
+        try:
+            # cache_implementation=None: a compile-ahead static default must not clash with our cache
+            yield {"past_key_values": cache, "cache_implementation": None}
+        finally:
+            KV_CACHE_POOL.release(model, key, cache, config["pool_size"], config["pool_bytes"])
+        return
+    if strategy == "quantized":
+        backend, module = _QUANT_BACKENDS.get(config["quant_backend"], (None, None))
+        if backend is None or not _installed(module):
+            yield _fallback("quantized_backend", f"KV_CACHE_QUANT_BACKEND={config['quant_backend']} is not installed")
+            return
+        if not getattr(model, "_supports_quantized_cache", False):
+            yield _fallback("quantized_unsupported", f"{type(model).__name__} has no quantized KV cache support")
+            return
+        KV_CACHE_STATS.count("quantized")
+        yield {
+            "cache_implementation": "quantized",
+            "cache_config": {"backend": backend, "nbits": config["nbits"],
+                             "residual_length": config["residual_length"]},
+        }
+        return
+    KV_CACHE_STATS.count("dynamic")
+    yield {}
+
+
+# ========== STATS ========== #
+
+class KVCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.live_bytes = 0
+        self.peak_bytes = 0
+
+    def count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def allocated(self, nbytes: int):
+        with self._lock:
+            self.counts["static_allocations"] += 1
+            self.live_bytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+
+    def freed(self, nbytes: int):
+        with self._lock:
+            self.live_bytes -= nbytes
+
+    def snapshot(self) -> dict:
+        config = kv_cache_config()
+        with self._lock:
+            return {
+                "strategy": config["strategy"],
+                "calls": dict(self.counts),
+                # Static caches allocated and not yet freed (in use or idle in the pool)
+                "static_live_mb": round(self.live_bytes / 2**20, 1),
+                "static_peak_mb": round(self.peak_bytes / 2**20, 1),
+                **KV_CACHE_POOL.snapshot(),
+            }
+
+
+KV_CACHE_STATS = KVCacheStats()
+
+
+def kv_cache_stats() -> dict:
+    return KV_CACHE_STATS.snapshot()
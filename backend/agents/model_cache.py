@@ -0,0 +1,121 @@
+# agents/model_cache.py - Pre-quantized, memory-mapped model artifact cache
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import torch
+
+ARTIFACT_MARKER = "artifact.json"
+
+# model key -> {"source": "cold"|"warm"|"uncached", "load_s": float, ...}
+LOAD_TIMINGS = {}
+
+
+def cache_root():
+    """Directory holding quantized artifacts, or None when caching is disabled"""
+    root = os.getenv("MODEL_CACHE_DIR", "").strip()
+    return Path(root) if root else None
+
+
+def artifact_path(model_id: str, quant_tag: str):
+    root = cache_root()
+    if root is None:
+        return None
+    return root / f"{model_id.replace('/', '--')}--{quant_tag}"
+
+
+def _save_artifact(model, tokenizer, path: Path, model_id: str, quant_tag: str):
+    """Write quantized weights as safetensors, then publish atomically"""
+    tmp = path.with_name(path.name + ".partial")
+    shutil.rmtree(tmp, ignore_errors=True)
+    model.save_pretrained(tmp, safe_serialization=True)
+    tokenizer.save_pretrained(tmp)
+    with open(tmp / ARTIFACT_MARKER, "w") as f:
+        json.dump({
+            "model_id": model_id,
+            "quantization": quant_tag,
+            "created_at": time.time(),
+            "torch": torch.__version__,
+        }, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def load_quantized(model_id: str, quant_tag: str, bnb_config, tokenizer_kwargs: dict):
+    """
+    Load a quantized causal LM, going through the artifact cache when enabled.
+
+    Cold start: download + quantize on the fly, then persist the quantized
+    weights. Warm start: load the persisted safetensors directly; they are
+    memory-mapped, so startup cost is dominated by page-ins rather than
+    conversion and peak RAM stays close to the final footprint.
+
+    Returns:
+        (model, tokenizer)
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    path = artifact_path(model_id, quant_tag)
+    key = f"{model_id}:{quant_tag}"
+    start = time.time()
+
+    if path is not None and (path / ARTIFACT_MARKER).exists():
+        print(f"📦 Loading cached artifact: {path}")
+        tokenizer = AutoTokenizer.from_pretrained(path, **tokenizer_kwargs)
+        # quantization_config is restored from the saved config.json
+        model = AutoModelForCausalLM.from_pretrained(
+            path,
+            device_map="auto",
+            trust_remote_code=True,
+            torch_dtype=torch.float16,
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
+        )
+        LOAD_TIMINGS[key] = {"source": "warm", "load_s": round(time.time() - start, 2)}
+        return model, tokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id, **tokenizer_kwargs)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        quantization_config=bnb_config,
+        device_map="auto",
+        trust_remote_code=True,
+        torch_dtype=torch.float16,
+    )
+    load_s = time.time() - start
+
+    if path is None:
+        LOAD_TIMINGS[key] = {"source": "uncached", "load_s": round(load_s, 2)}
+        return model, tokenizer
+
+    try:
+        save_start = time.time()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _save_artifact(model, tokenizer, path, model_id, quant_tag)
+        print(f"📦 Cached quantized artifact: {path}")
+        LOAD_TIMINGS[key] = {
+            "source": "cold",
+            "load_s": round(load_s, 2),
+            "save_s": round(time.time() - save_start, 2),
+        }
+    except Exception as e:
+        # Serialization support depends on the bitsandbytes version; keep serving
+        print(f"⚠️  Could not cache artifact for {model_id}: {e}")
+        LOAD_TIMINGS[key] = {"source": "uncached", "load_s": round(load_s, 2)}
+
+    return model, tokenizer
+
+
+def load_timings_report() -> dict:
+    """Per-model load timings plus cold vs warm totals"""
+    totals = {}
+    for info in LOAD_TIMINGS.values():
+        totals[info["source"]] = round(totals.get(info["source"], 0.0) + info["load_s"], 2)
+    return {
+        "cache_dir": str(cache_root()) if cache_root() else None,
+        "models": LOAD_TIMINGS,
+        "total_load_s": totals,
+    }
@@ -0,0 +1,312 @@
+# agents/profiling.py - Opt-in profiling of the local inference path
+
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+
+
+def profiling_config() -> dict:
+    """Read profiling settings from the environment"""
+    return {
+        # Profile every request; otherwise only requests sent with X-Profile: 1
+        "enabled": os.getenv("PROFILE_INFERENCE", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "dir": os.getenv("PROFILE_DIR", "./profiles"),
+        "max_sessions": int(os.getenv("PROFILE_MAX_SESSIONS", "20")),
+        "sample_hz": float(os.getenv("PROFILE_SAMPLE_HZ", "100")),
+        "torch_traces": os.getenv("PROFILE_TORCH_TRACES", "true").strip().lower() in ("1", "true", "yes", "on"),
+    }
+
+
+def profiling_requested(header_value: Optional[str] = None) -> bool:
+    """Globally enabled, or asked for by the request's X-Profile header"""
+    if profiling_config()["enabled"]:
+        return True
+    return (header_value or "").strip().lower() in ("1", "true", "yes", "on")
+
+
+# ========== STACK SAMPLING ========== #
+
+class StackSampler(threading.Thread):
+    """
+    Samples the Python stacks of registered threads at a fixed rate and
+    aggregates them as collapsed stacks ("thread;frame;frame count"), the
+    format py-spy --format raw writes and flamegraph.pl / speedscope read.
+    """
+
+    def __init__(self, hz: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = 1.0 / hz
+        self.threads = {}  # ident -> thread name
+        self.counts = Counter()
+        self.samples = 0
+        self._halt = threading.Event()
+
+    def add_thread(self):
+        current = threading.current_thread()
+        self.threads[current.ident] = current.name
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, name in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.counts[";".join([name] + stack[::-1])] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+    def write(self, path: Path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# ========== PER-CALL PHASES ========== #
+
+class PhaseTimer:
+    """
+    Splits one generate() call into tokenize / prefill / decode.
+
+    The model's first forward pass ends tokenization (our truncation plus
+    the pipeline's own encoding); the first logits-processor call ends the
+    prefill; everything after is decode. Passed to generate() as a no-op
+    logits processor.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self.start = time.perf_counter()
+        self.first_forward = None
+        self.first_token = None
+        self.steps = 0
+
+    def on_forward(self):
+        if self.first_forward is None:
+            self.first_forward = time.perf_counter()
+
+    def __call__(self, input_ids, scores):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.steps += 1
+        return scores
+
+    def finish(self) -> dict:
+        end = time.perf_counter()
+        first_forward = self.first_forward or end
+        first_token = self.first_token or end
+        decode_s = end - first_token
+        return {
+            "label": self.label,
+            "total_s": round(end - self.start, 4),
+            "tokenize_s": round(first_forward - self.start, 4),
+            "prefill_s": round(first_token - first_forward, 4),
+            "decode_s": round(decode_s, 4),
+            "new_tokens": self.steps,
+            "decode_tokens_per_s": round(self.steps / decode_s, 1) if decode_s > 0 else None,
+        }
+
+
+_ACTIVE_TIMER: ContextVar[Optional[PhaseTimer]] = ContextVar("phase_timer", default=None)
+
+
+def _forward_pre_hook(module, args):
+    timer = _ACTIVE_TIMER.get()
+    if timer is not None:
+        timer.on_forward()
+
+
+def _install_forward_hook(model):
+    """Once per model; outside a profiled call the hook is a single ContextVar lookup"""
+    if model is not None and not getattr(model, "_profiling_hook", None):
+        model._profiling_hook = model.register_forward_pre_hook(_forward_pre_hook)
+
+
+# ========== SESSIONS ========== #
+
+# torch.profiler cannot run two profiles at once; concurrent calls skip the trace
+_TORCH_LOCK = threading.Lock()
+
+
+class ProfileSession:
+    """Everything captured for one request, written to PROFILE_DIR/<id>/"""
+
+    def __init__(self, root: str, sample_hz: float = 100, torch_traces: bool = True, meta: dict = None):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.root = Path(root)
+        self.path = self.root / self.id
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.meta = meta or {}
+        self.torch_traces = torch_traces
+        self.calls = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.sampler = StackSampler(sample_hz) if sample_hz > 0 else None
+        if self.sampler is not None:
+            self.sampler.add_thread()
+            self.sampler.start()
+
+    def register_thread(self):
+        if self.sampler is not None:
+            self.sampler.add_thread()
+
+    @contextmanager
+    def torch_trace(self, index: int, label: str):
+        """Chrome trace (chrome://tracing, Perfetto) of one call"""
+        if not self.torch_traces or not _TORCH_LOCK.acquire(blocking=False):
+            yield
+            return
+        try:
+            import torch
+            from torch.profiler import ProfilerActivity, profile
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            with profile(activities=activities) as prof:
+                yield
+            prof.export_chrome_trace(str(self.path / f"{index:03d}-{label}.trace.json"))
+        finally:
+            _TORCH_LOCK.release()
+
+    def record_call(self, entry: dict):
+        with self._lock:
+            self.calls.append(entry)
+
+    def close(self, max_sessions: int = 20) -> dict:
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(self.path / "stacks.folded")
+        totals = Counter()
+        for call in self.calls:
+            for key in ("tokenize_s", "prefill_s", "decode_s", "new_tokens"):
+                totals[key] += call[key]
+        summary = {
+            "id": self.id,
+            **self.meta,
+            "elapsed_s": round(time.perf_counter() - self._started, 4),
+            "samples": self.sampler.samples if self.sampler is not None else 0,
+            "totals": {k: round(v, 4) for k, v in totals.items()},
+            "calls": self.calls,
+        }
+        with open(self.path / "summary.json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        rotate_sessions(self.root, max_sessions)
+        return summary
+
+
+_SESSION: ContextVar[Optional[ProfileSession]] = ContextVar("profile_session", default=None)
+
+
+def current_session() -> Optional[ProfileSession]:
+    return _SESSION.get()
+
+
+@contextmanager
+def profile_session(enabled: bool, meta: dict = None):
+    """Profile everything run in this context; yields None when profiling is off"""
+    if not enabled:
+        yield None
+        return
+    config = profiling_config()
+    session = ProfileSession(config["dir"], config["sample_hz"], config["torch_traces"], meta)
+    reset = _SESSION.set(session)
+    try:
+        yield session
+    finally:
+        _SESSION.reset(reset)
+        session.close(config["max_sessions"])
+        print(f"🔬 Profile written: {session.path}")
+
+
+@contextmanager
+def profiled_call(label: str, model=None):
+    """Wrap one chat call: phase timing plus a torch.profiler trace. Yields the PhaseTimer or None."""
+    session = _SESSION.get()
+    if session is None:
+        yield None
+        return
+    session.register_thread()
+    _install_forward_hook(model)
+    index = len(session.calls) + 1
+    entry = None
+    try:
+        with session.torch_trace(index, label):
+            # Timed inside the trace so profiler start-up and export stay out of the phases
+            timer = PhaseTimer(label)
+            reset = _ACTIVE_TIMER.set(timer)
+            try:
+                yield timer
+            finally:
+                _ACTIVE_TIMER.reset(reset)
+                entry = timer.finish()
+    finally:
+        if entry is not None:
+            session.record_call(entry)
+
+
+# ========== TRACE DIRECTORY ========== #
+
+def rotate_sessions(root: Path, max_sessions: int):
+    """Keep the newest max_sessions session directories (ids sort by start time)"""
+    sessions = sorted(p for p in Path(root).iterdir() if p.is_dir())
+    for old in sessions[:max(0, len(sessions) - max_sessions)]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def list_profiles() -> list:
+    """Newest first, with each session's files and phase totals"""
+    root = Path(profiling_config()["dir"])
+    if not root.is_dir():
+        return []
+    profiles = []
+    for path in sorted((p for p in root.iterdir() if p.is_dir()), reverse=True):
+        files = sorted(f for f in path.iterdir() if f.is_file())
+        entry = {
+            "id": path.name,
+            "files": [f.name for f in files],
+            "bytes": sum(f.stat().st_size for f in files),
+        }
+        try:
+            with open(path / "summary.json", encoding="utf-8") as f:
+                summary = json.load(f)
+            entry.update({k: summary.get(k) for k in ("elapsed_s", "samples", "totals")})
+            entry["calls"] = len(summary.get("calls", []))
+        except (OSError, ValueError):
+            entry["in_progress"] = True
+        profiles.append(entry)
+    return profiles
+
+
+def profile_file(profile_id: str, name: str) -> Optional[Path]:
+    """Path of one file in a session, or None (names must not leave the profile directory)"""
+    if any(sep in part for part in (profile_id, name) for sep in ("/", "\\")) or ".." in profile_id + name:
+        return None
+    path = Path(profiling_config()["dir"]) / profile_id / name
+    return path if path.is_file() else None
+
+
+def profiling_stats() -> dict:
+    config = profiling_config()
+    return {
+        "enabled": config["enabled"],
+        "dir": config["dir"],
+        "sessions": len(list_profiles()),
+        "max_sessions": config["max_sessions"],
+    }
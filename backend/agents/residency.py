@@ -0,0 +1,355 @@
+# agents/residency.py - On-demand model loading with LRU eviction under a memory budget
+
+import gc
+import os
+import statistics
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import torch
+
+from .kv_cache import KV_CACHE_POOL
+
+
+def residency_config() -> dict:
+    """Read residency settings from the environment (budgets in MB, 0 = unlimited)"""
+    return {
+        "enabled": os.getenv("RESIDENCY_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "vram_budget_mb": float(os.getenv("RESIDENCY_VRAM_BUDGET_MB", "0")),
+        "ram_budget_mb": float(os.getenv("RESIDENCY_RAM_BUDGET_MB", "0")),
+        # Also evict while the device has less than this much free memory
+        "min_free_mb": float(os.getenv("RESIDENCY_MIN_FREE_MB", "0")),
+        # cpu: move idle GPU models to host memory where possible; unload: drop them
+        "offload": os.getenv("RESIDENCY_OFFLOAD", "cpu").strip().lower(),
+        "pinned": {r.strip() for r in os.getenv("RESIDENCY_PINNED", "writer").split(",") if r.strip()},
+    }
+
+
+def free_mb(pool: str) -> Optional[float]:
+    """Free memory of a pool ("vram" or "ram"), None when unknown"""
+    if pool == "vram":
+        if not torch.cuda.is_available():
+            return None
+        free, _ = torch.cuda.mem_get_info()
+        return free / 2**20
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _movable(model) -> bool:
+    """bitsandbytes-quantized and multi-device dispatched models cannot be moved with .to()"""
+    if getattr(model, "is_loaded_in_4bit", False) or getattr(model, "is_loaded_in_8bit", False):
+        return False
+    device_map = getattr(model, "hf_device_map", None) or {}
+    return len(set(device_map.values())) <= 1
+
+
+class _Slot:
+    """One loaded (or loadable) model and the roles it serves"""
+
+    def __init__(self, key: str, loader: Callable, roles: list):
+        self.key = key
+        self.loader = loader
+        self.roles = roles
+        self.llm = None
+        self.tokenizer = None      # kept across unloads so tokenizer-keyed caches stay valid
+        self.device = None         # where the model runs: "cuda" | "cpu"
+        self.offloaded = False     # parked in host memory, restored to device before use
+        self.footprint_mb = None   # known after the first load
+        self.leases = 0
+        self.swapping = False      # being loaded, restored or evicted (outside the manager lock)
+        self.incoming = None       # pool a load/restore in progress will land in
+        self.last_used = 0.0
+        self.uses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def pool(self) -> Optional[str]:
+        if self.llm is None:
+            return None
+        return "vram" if self.device == "cuda" and not self.offloaded else "ram"
+
+
+class ResidentLLM:
+    """
+    A role's handle on a managed model. .pipeline loads (or restores) the
+    model on first access; wrap calls in resident() so it cannot be evicted
+    mid-generation.
+    """
+
+    def __init__(self, manager: "ResidencyManager", key: str, role: str):
+        self.manager = manager
+        self.key = key
+        self.role = role
+
+    @property
+    def pipeline(self):
+        return self.manager.pipeline(self.key)
+
+
+class ResidencyManager:
+    """
+    Tracks which models are resident, loads them on demand and, when a
+    budget is exceeded, evicts the least recently used idle, unpinned ones:
+    GPU models go to host memory when they can be moved, everything else is
+    unloaded and reloaded from MODEL_CACHE_DIR (or the hub) on next use.
+    """
+
+    def __init__(self, config: dict = None):
+        self.config = config or residency_config()
+        self._slots = {}
+        # Guards bookkeeping only: loads and evictions run outside it, so
+        # resident models and snapshot() never wait behind a slow swap
+        self._lock = threading.Lock()
+        self._swapped = threading.Condition(self._lock)
+
+    def register(self, key: str, loader: Callable, roles: list) -> dict:
+        """Add a model served to roles; returns role -> ResidentLLM"""
+        self._slots[key] = _Slot(key, loader, list(roles))
+        return {role: ResidentLLM(self, key, role) for role in roles}
+
+    def pinned(self, slot: _Slot) -> bool:
+        return any(role in self.config["pinned"] for role in slot.roles)
+
+    def pipeline(self, key: str):
+        return self._ensure(self._slots[key], lease=False)
+
+    def acquire(self, key: str):
+        self._ensure(self._slots[key], lease=True)
+
+    def release(self, key: str):
+        with self._lock:
+            slot = self._slots[key]
+            slot.leases -= 1
+            slot.last_used = time.monotonic()
+        self._make_room()
+
+    def load_pinned(self):
+        """Load every pinned model up front (startup)"""
+        for slot in self._slots.values():
+            if self.pinned(slot):
+                self.pipeline(slot.key)
+
+    # ---------- swaps ---------- #
+
+    def _touch(self, slot: _Slot, lease: bool):
+        if lease:
+            slot.leases += 1
+            slot.uses += 1
+        slot.last_used = time.monotonic()
+
+    def _ensure(self, slot: _Slot, lease: bool):
+        """Make the slot's model resident on its device; concurrent callers wait for one swap instead of racing it"""
+        with self._swapped:
+            while slot.swapping:
+                self._swapped.wait()
+            if slot.llm is not None and not slot.offloaded:
+                self._touch(slot, lease)
+                return slot.llm.pipeline
+            slot.swapping = True
+            if slot.llm is not None:
+                pool_needed = "vram"
+            else:
+                pool_needed = "vram" if torch.cuda.is_available() else "ram"
+        try:
+            # Make room first when we already know how big the model is
+            self._make_room(keep=slot, pool=pool_needed, extra_mb=slot.footprint_mb or 0.0)
+            slot.incoming = pool_needed
+            start = time.perf_counter()
+            if slot.offloaded:
+                slot.llm.pipeline.model.to(slot.device)
+                slot.offloaded = False
+                kind, verb = "restore", "Restored"
+            else:
+                llm = slot.loader()
+                model = llm.pipeline.model
+                if slot.tokenizer is not None:
+                    llm.pipeline.tokenizer = slot.tokenizer
+                slot.device = "cuda" if next(model.parameters()).is_cuda else "cpu"
+                slot.footprint_mb = round(model.get_memory_footprint() / 2**20, 1)
+                slot.llm = llm
+                slot.loads += 1
+                kind, verb = "load", "Loaded"
+            elapsed = time.perf_counter() - start
+        finally:
+            with self._swapped:
+                slot.swapping = False
+                slot.incoming = None
+                if slot.llm is not None and not slot.offloaded:
+                    self._touch(slot, lease)
+                    pipeline = slot.llm.pipeline
+                self._swapped.notify_all()
+        RESIDENCY_STATS.record(kind, elapsed)
+        print(f"📥 {verb} {slot.key} ({slot.footprint_mb} MB) in {elapsed:.2f}s")
+        self._make_room(keep=slot)
+        return pipeline
+
+    def _evict(self, slot: _Slot):
+        start = time.perf_counter()
+        model = slot.llm.pipeline.model
+        KV_CACHE_POOL.drop(model)  # its preallocated KV caches live on the device being freed
+        if self.config["offload"] == "cpu" and slot.pool == "vram" and _movable(model):
+            model.to("cpu")
+            slot.offloaded = True
+            kind = "offload"
+        else:
+            slot.tokenizer = slot.llm.pipeline.tokenizer
+            slot.llm = None
+            slot.offloaded = False
+            del model
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            kind = "unload"
+        slot.evictions += 1
+        elapsed = time.perf_counter() - start
+        RESIDENCY_STATS.record(kind, elapsed)
+        print(f"📤 Evicted {slot.key} ({kind}) in {elapsed:.2f}s")
+
+    def _over(self, pool: str, extra_mb: float = 0.0) -> bool:
+        budget = self.config[f"{pool}_budget_mb"]
+        # Loads in progress count against the pool they are landing in
+        used = sum(s.footprint_mb or 0.0 for s in self._slots.values() if s.pool == pool or s.incoming == pool)
+        if budget and used + extra_mb > budget:
+            return True
+        free = free_mb(pool) if self.config["min_free_mb"] else None
+        return free is not None and free - extra_mb < self.config["min_free_mb"]
+
+    def _victim(self, keep: _Slot = None, pool: str = None, extra_mb: float = 0.0) -> Optional[_Slot]:
+        """The least recently used idle, unpinned model of a pool over budget (caller holds the lock)"""
+        for current in (pool,) if pool else ("vram", "ram"):
+            if not self._over(current, extra_mb if current == pool else 0.0):
+                continue
+            idle = [s for s in self._slots.values()
+                    if s.pool == current and s is not keep and s.leases == 0 and not s.swapping
+                    and not self.pinned(s)]
+            if idle:
+                return min(idle, key=lambda s: s.last_used)
+            RESIDENCY_STATS.count(f"over_budget_{current}")
+        return None
+
+    def _make_room(self, keep: _Slot = None, pool: str = None, extra_mb: float = 0.0):
+        """Evict one model at a time, outside the lock, until every pool is within budget"""
+        while True:
+            with self._swapped:
+                victim = self._victim(keep, pool, extra_mb)
+                if victim is None:
+                    return
+                victim.swapping = True
+            try:
+                self._evict(victim)
+            finally:
+                with self._swapped:
+                    victim.swapping = False
+                    self._swapped.notify_all()
+
+    @staticmethod
+    def _state(slot: _Slot) -> str:
+        if slot.swapping:
+            return "swapping"
+        if slot.llm is None:
+            return "unloaded"
+        return "offloaded" if slot.offloaded else slot.device
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                slot.key: {
+                    "roles": slot.roles,
+                    "state": self._state(slot),
+                    "footprint_mb": slot.footprint_mb,
+                    "pinned": self.pinned(slot),
+                    "in_use": slot.leases,
+                    "uses": slot.uses,
+                    "idle_s": round(now - slot.last_used, 1) if slot.last_used else None,
+                    "loads": slot.loads,
+                    "evictions": slot.evictions,
+                }
+                for slot in self._slots.values()
+            }
+
+
+_MANAGER: Optional[ResidencyManager] = None
+
+
+def set_manager(manager: Optional[ResidencyManager]):
+    global _MANAGER
+    _MANAGER = manager
+
+
+@contextmanager
+def resident(llm):
+    """Keep llm's model loaded for the duration of a call (no-op for unmanaged models)"""
+    if not isinstance(llm, ResidentLLM):
+        yield llm
+        return
+    llm.manager.acquire(llm.key)
+    try:
+        yield llm
+    finally:
+        llm.manager.release(llm.key)
+
+
+# ========== STATS ========== #
+
+class ResidencyStats:
+    """Counts and latency of every swap: load, restore (host -> GPU), offload, unload"""
+
+    def __init__(self, window: int = 100):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.total_s = Counter()
+        self.recent = {}
+        self.window = window
+
+    def record(self, kind: str, seconds: float):
+        with self._lock:
+            self.counts[kind] += 1
+            self.total_s[kind] += seconds
+            self.recent.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            swaps = {
+                kind: {
+                    "count": self.counts[kind],
+                    "total_s": round(self.total_s[kind], 3),
+                    "p50_s": round(statistics.median(samples), 3),
+                    "max_s": round(max(samples), 3),
+                }
+                for kind, samples in self.recent.items()
+            }
+            other = {k: v for k, v in self.counts.items() if k not in self.recent}
+        config = _MANAGER.config if _MANAGER is not None else residency_config()
+        return {
+            "enabled": _MANAGER is not None,
+            "vram_budget_mb": config["vram_budget_mb"],
+            "ram_budget_mb": config["ram_budget_mb"],
+            "offload": config["offload"],
+            "pinned": sorted(config["pinned"]),
+            "swaps": swaps,
+            **other,
+            "models": _MANAGER.snapshot() if _MANAGER is not None else {},
+        }
+
+
+RESIDENCY_STATS = ResidencyStats()
+
+
+def residency_stats() -> dict:
+    return RESIDENCY_STATS.snapshot()
@@ -0,0 +1,276 @@
+# agents/resilience.py - Timeouts, retries, hedging and circuit breaking for remote LLM calls
+
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable
+
+from .cancellation import RequestCancelled, check_cancelled, current_token
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the endpoint while the breaker is open"""
+
+
+class CallTimeoutError(TimeoutError):
+    """Raised when an attempt (including its hedge) exceeds the per-call timeout"""
+
+
+def resilience_config() -> dict:
+    """Read client resilience settings from the environment"""
+    return {
+        "timeout_s": float(os.getenv("CLOUD_TIMEOUT_S", "30")),
+        "max_retries": int(os.getenv("CLOUD_MAX_RETRIES", "2")),
+        "backoff_base_s": float(os.getenv("CLOUD_BACKOFF_BASE_S", "0.5")),
+        "backoff_max_s": float(os.getenv("CLOUD_BACKOFF_MAX_S", "8")),
+        # Launch a duplicate attempt once the primary is slower than this percentile (0 disables)
+        "hedge_percentile": float(os.getenv("CLOUD_HEDGE_PERCENTILE", "95")),
+        "hedge_min_samples": int(os.getenv("CLOUD_HEDGE_MIN_SAMPLES", "20")),
+        "breaker_failures": int(os.getenv("CLOUD_BREAKER_FAILURES", "5")),
+        "breaker_reset_s": float(os.getenv("CLOUD_BREAKER_RESET_S", "30")),
+        # Timed-out or losing attempts still running before new attempts fail fast (of 16 workers)
+        "max_abandoned": int(os.getenv("CLOUD_MAX_ABANDONED", "8")),
+    }
+
+
+class CircuitBreaker:
+    """Closed -> open after N consecutive failures -> half-open trial after a cool-down"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_s: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout_s:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                # Let exactly one probe through; everyone else keeps failing fast
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """The half-open probe ended without a verdict (cancelled): let the next call probe"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "times_opened": self.times_opened,
+            }
+
+
+class ResilientClient:
+    """
+    Wrap a remote LLM so every call gets a timeout, jittered retries,
+    latency-based hedging and a shared circuit breaker.
+    """
+
+    def __init__(self, name: str, llm, config: dict = None):
+        config = config or resilience_config()
+        self.name = name
+        self.llm = llm
+        self.timeout_s = config["timeout_s"]
+        self.max_retries = config["max_retries"]
+        self.backoff_base_s = config["backoff_base_s"]
+        self.backoff_max_s = config["backoff_max_s"]
+        self.hedge_percentile = config["hedge_percentile"]
+        self.hedge_min_samples = config["hedge_min_samples"]
+        self.breaker = CircuitBreaker(config["breaker_failures"], config["breaker_reset_s"])
+        # Abandoned (timed-out or losing hedge) attempts keep a worker until they
+        # return; past max_abandoned no hedges are raced and new attempts wait
+        # for one to return, so a hung endpoint cannot take every worker
+        self.max_abandoned = min(config["max_abandoned"], 15)
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix=f"llm-{name}")
+        self._latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+        self._abandoned = 0
+        self._abandoned_peak = 0
+        self.stats = {
+            "calls": 0, "successes": 0, "failures": 0, "retries": 0, "timeouts": 0, "hedges": 0,
+            "hedge_wins": 0, "fast_fails": 0, "cancelled": 0, "abandoned": 0, "saturated": 0,
+        }
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _hedge_delay(self):
+        """Latency percentile after which a duplicate attempt is launched"""
+        if self.hedge_percentile <= 0:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        idx = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[idx]
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: uniform in [0, min(cap, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+
+    def _submit(self, fn: Callable, *args):
+        # Workers run in a copy of the caller's context so they see its cancel token
+        return self._executor.submit(contextvars.copy_context().run, fn, *args)
+
+    def _can_hedge(self) -> bool:
+        # Both the primary and its duplicate may end up abandoned
+        with self._lock:
+            return self._abandoned + 2 <= self.max_abandoned
+
+    def _abandon(self, futures):
+        """Stop waiting on attempts; queued ones are cancelled, running ones counted until they return"""
+        for future in futures:
+            if future.cancel():
+                continue
+            with self._lock:
+                self._abandoned += 1
+                self._abandoned_peak = max(self._abandoned_peak, self._abandoned)
+                self.stats["abandoned"] += 1
+            future.add_done_callback(self._abandoned_done)
+
+    def _abandoned_done(self, future):
+        with self._returned:
+            self._abandoned -= 1
+            self._returned.notify()
+
+    def _attempt(self, fn: Callable, *args) -> Any:
+        start = time.monotonic()
+        deadline = start + self.timeout_s
+        token = current_token()
+        with self._returned:
+            # Slow losers free up quickly; attempts stuck on a hung endpoint do not
+            if not self._returned.wait_for(lambda: self._abandoned < self.max_abandoned, timeout=self.timeout_s):
+                self.stats["saturated"] += 1
+                raise CallTimeoutError(f"{self.name}: {self.max_abandoned} abandoned attempts still running")
+        pending = {self._submit(fn, *args)}
+        try:
+            return self._await(pending, start, deadline, token, fn, *args)
+        finally:
+            self._abandon(pending)
+
+    def _await(self, pending: set, start: float, deadline: float, token, fn: Callable, *args) -> Any:
+        """Wait for the first successful attempt; `pending` is left holding the ones still running"""
+        hedge_delay = self._hedge_delay()
+        hedged = False
+        first_error = None
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = remaining
+            if hedge_delay is not None and not hedged:
+                wait_for = min(remaining, max(0.0, start + hedge_delay - time.monotonic()))
+            if token is not None and token.remaining() is not None:
+                # Wake up at the request deadline rather than the call timeout
+                wait_for = min(wait_for, token.remaining())
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            pending -= done
+
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    first_error = first_error or e
+                    continue
+                with self._lock:
+                    self._latencies.append(time.monotonic() - start)
+                if hedged and future is not primary:
+                    self._count("hedge_wins")
+                return result
+
+            check_cancelled()
+            if not hedged and hedge_delay is not None and pending and not self._can_hedge():
+                hedge_delay = None  # no worker to spare for a duplicate
+            elif not hedged and hedge_delay is not None and pending:
+                # Primary is slower than the tail we normally see: race a duplicate
+                hedged = True
+                primary = next(iter(pending))
+                self._count("hedges")
+                pending.add(self._submit(fn, *args))
+            elif not pending and first_error is not None:
+                raise first_error
+
+        if first_error is not None and not pending:
+            raise first_error
+        self._count("timeouts")
+        raise CallTimeoutError(f"{self.name}: no response within {self.timeout_s}s")
+
+    def call(self, fn: Callable, *args) -> Any:
+        """Run fn(*args) against the endpoint with the full resilience policy"""
+        self._count("calls")
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            check_cancelled()
+            if not self.breaker.allow():
+                self._count("fast_fails")
+                raise CircuitOpenError(f"{self.name}: circuit open, endpoint marked unhealthy") from last_error
+            try:
+                result = self._attempt(fn, *args)
+            except RequestCancelled:
+                # Not the endpoint's fault: no breaker failure, no retry
+                self.breaker.release_trial()
+                self._count("cancelled")
+                raise
+            except Exception as e:
+                last_error = e
+                self.breaker.record_failure()
+                if attempt < self.max_retries:
+                    self._count("retries")
+                    time.sleep(self._backoff(attempt))
+                continue
+            self.breaker.record_success()
+            self._count("successes")
+            return result
+
+        self._count("failures")
+        raise last_error
+
+    def snapshot(self) -> dict:
+        hedge_delay = self._hedge_delay()
+        with self._lock:
+            stats = dict(self.stats)
+            abandoned, abandoned_peak = self._abandoned, self._abandoned_peak
+        return {
+            **stats,
+            "abandoned_in_flight": abandoned,
+            "abandoned_peak": abandoned_peak,
+            "breaker": self.breaker.snapshot(),
+            "hedge_after_s": round(hedge_delay, 3) if hedge_delay is not None else None,
+        }
@@ -0,0 +1,111 @@
+# agents/routing.py - Two-tier model cascade: cheap checks that decide when to escalate
+
+import os
+import threading
+from collections import Counter, defaultdict, deque
+
+from .budgets import GenerationBudget
+from .variants import fit_score
+
+
+def routing_config() -> dict:
+    """Read cascade settings from the environment"""
+    return {
+        # direct: every role uses its configured model; cascade: small model first
+        "mode": os.getenv("ROUTING_MODE", "direct").strip().lower(),
+        # Minimum variants.fit_score a small-model caption needs to be kept
+        "min_fit": float(os.getenv("ROUTING_MIN_FIT", "1.0")),
+        "min_words": int(os.getenv("ROUTING_MIN_WORDS", "6")),
+        # APPROVED vs NEEDS_CHANGES probability margin below which compliance escalates
+        "min_margin": float(os.getenv("ROUTING_MIN_MARGIN", "0.5")),
+    }
+
+
+def cascade_enabled() -> bool:
+    return routing_config()["mode"] == "cascade"
+
+
+def check_caption(text: str, budget: GenerationBudget, min_fit: float, min_words: int):
+    """Accept a small-model caption when it fits the requested structure; returns (ok, reason)"""
+    if not text or text.startswith("[Generation failed]"):
+        return False, "failed"
+    if len(text.split()) < min_words:
+        return False, "too_short"
+    if budget.max_hashtags and "#" not in text:
+        return False, "no_hashtags"
+    if fit_score(text, budget) < min_fit:
+        return False, "format"
+    return True, "ok"
+
+
+def check_image_prompt(text: str, min_words: int):
+    """Image prompts only need to be a usable, non-echoing description"""
+    if not text or text.startswith("[Generation failed]"):
+        return False, "failed"
+    if len(text.split()) < min_words:
+        return False, "too_short"
+    if "#" in text or text.lower().startswith(("create", "image prompt")):
+        return False, "format"
+    return True, "ok"
+
+
+def check_margin(margin: float, min_margin: float):
+    """Compliance labels are kept only when the small model is clearly decided"""
+    if abs(margin) < min_margin:
+        return False, "low_margin"
+    return True, "ok"
+
+
+class CascadeStats:
+    """Escalation counters per role plus end-to-end request latency under the cascade"""
+
+    def __init__(self, window: int = 500):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.escalations = Counter()
+        self.reasons = defaultdict(Counter)
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+
+    def record_call(self, role: str, escalated: bool, reason: str):
+        with self._lock:
+            self.calls[role] += 1
+            if escalated:
+                self.escalations[role] += 1
+                self.reasons[role][reason] += 1
+
+    def record_request(self, seconds: float):
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            calls = sum(self.calls.values())
+            escalations = sum(self.escalations.values())
+            return {
+                "mode": routing_config()["mode"],
+                "requests": self.requests,
+                "avg_request_latency_s": (
+                    round(sum(self.latencies) / len(self.latencies), 3) if self.latencies else None
+                ),
+                "calls": calls,
+                "escalations": escalations,
+                "escalation_rate": round(escalations / calls, 4) if calls else 0.0,
+                "roles": {
+                    role: {
+                        "calls": n,
+                        "escalations": self.escalations[role],
+                        "escalation_rate": round(self.escalations[role] / n, 4),
+                        "reasons": dict(self.reasons[role]),
+                    }
+                    for role, n in self.calls.items()
+                },
+            }
+
+
+CASCADE_STATS = CascadeStats()
+
+
+def routing_stats() -> dict:
+    return CASCADE_STATS.snapshot()
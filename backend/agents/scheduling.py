@@ -0,0 +1,333 @@
+# agents/scheduling.py - Per-tenant rate limiting, priority lanes and weighted fair queueing for inference
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import os
+import secrets
+import threading
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+# Lanes in dispatch order: every queued interactive request goes before any batch request
+PRIORITIES = ("interactive", "batch")
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a tenant has no tokens left in its bucket"""
+
+    def __init__(self, tenant: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded for {tenant}")
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class TenantPolicy:
+    rate: float    # sustained requests per second
+    burst: int     # bucket size
+    weight: float  # share of inference slots under contention
+
+
+# Salt for tenant IDs derived from API keys; random per process unless pinned
+_DEFAULT_SALT = secrets.token_hex(16)
+
+
+def key_tenant(api_key: str, salt: str) -> str:
+    """Tenant ID of an API key: a short salted hash, so keys never reach stats or logs"""
+    digest = hashlib.blake2b(api_key.encode("utf-8"), key=salt.encode("utf-8")[:64], digest_size=6)
+    return f"key:{digest.hexdigest()}"
+
+
+def scheduling_config(default_concurrency: int = 1) -> dict:
+    """
+    Read limits from the environment.
+
+    TENANT_API_KEYS lists the X-API-Key values honoured as tenants; any other
+    request is its client address. TENANT_LIMITS overrides the defaults per
+    API key or client address, e.g. "key-a=2:10:3,10.0.0.7=0.2:2:0.5"
+    (rate:burst:weight).
+    """
+    default = TenantPolicy(
+        rate=float(os.getenv("RATE_LIMIT_RPS", "2")),
+        burst=int(os.getenv("RATE_LIMIT_BURST", "20")),
+        weight=float(os.getenv("TENANT_DEFAULT_WEIGHT", "1")),
+    )
+    salt = os.getenv("TENANT_ID_SALT") or _DEFAULT_SALT
+    api_keys = {k.strip() for k in os.getenv("TENANT_API_KEYS", "").split(",") if k.strip()}
+
+    def tenant_id(name: str) -> str:
+        return key_tenant(name, salt) if name in api_keys else f"ip:{name}"
+
+    overrides = {}
+    for item in os.getenv("TENANT_LIMITS", "").split(","):
+        if "=" not in item:
+            continue
+        tenant, spec = item.split("=", 1)
+        rate, burst, weight = (spec.split(":") + [None, None])[:3]
+        overrides[tenant_id(tenant.strip())] = TenantPolicy(
+            rate=float(rate),
+            burst=int(burst) if burst else default.burst,
+            weight=float(weight) if weight else default.weight,
+        )
+    return {
+        "enabled": os.getenv("RATE_LIMIT_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "default": default,
+        "tenants": overrides,
+        "concurrency": int(os.getenv("INFERENCE_CONCURRENCY", str(default_concurrency))),
+        "api_keys": api_keys,
+        "salt": salt,
+        # API keys / client addresses whose requests always run in the batch lane
+        "batch_tenants": {tenant_id(t.strip()) for t in os.getenv("BATCH_TENANTS", "").split(",") if t.strip()},
+        # Tenants with nothing queued or running are forgotten after this long
+        "idle_s": float(os.getenv("TENANT_IDLE_S", "600")),
+    }
+
+
+def resolve_tenant(api_key: str = None, client_host: str = None, api_keys: set = frozenset(),
+                   salt: str = _DEFAULT_SALT) -> str:
+    """Hashed API key when it is on the allow-list, otherwise the client address"""
+    if api_key and api_key in api_keys:
+        return key_tenant(api_key, salt)
+    return f"ip:{client_host or 'unknown'}"
+
+
+def resolve_priority(requested: Optional[str], tenant: str, batch_tenants: set) -> str:
+    """
+    Batch for BATCH_TENANTS whatever they ask for; anyone else runs
+    interactive unless the request opts down to batch.
+    """
+    if tenant in batch_tenants:
+        return "batch"
+    return "batch" if requested == "batch" else "interactive"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """Take one token; returns 0 on success or seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class _TenantStats:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.queued = 0
+        self.running = 0
+        self.preempted = 0
+        self.waits = deque(maxlen=500)
+        self.latencies = deque(maxlen=500)
+        self.last_seen = time.monotonic()
+
+    @staticmethod
+    def _pct(values, q):
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 3)
+
+    def snapshot(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "rate_limited": self.rejected,
+            "queued": self.queued,
+            "running": self.running,
+            "preempted": self.preempted,
+            "queue_wait_p50_s": self._pct(self.waits, 0.5),
+            "queue_wait_p95_s": self._pct(self.waits, 0.95),
+            "latency_p50_s": self._pct(self.latencies, 0.5),
+            "latency_p95_s": self._pct(self.latencies, 0.95),
+        }
+
+
+class FairScheduler:
+    """
+    Token-bucket admission plus a weighted fair queue over a fixed number of
+    inference slots.
+
+    Each queued request gets a virtual finish tag
+        max(virtual_time, tenant's last tag) + 1 / weight
+    and free slots go to the smallest tag, so a tenant flooding the queue
+    only delays its own later requests.
+
+    Requests queue in one of two lanes. Interactive requests are always
+    dispatched before batch ones, and a running batch generation is asked
+    (via preempt_check) to hand its slot back between agent steps while
+    interactive requests are waiting.
+    """
+
+    def __init__(self, config: dict):
+        self.enabled = config["enabled"]
+        self.default_policy = config["default"]
+        self.policies = config["tenants"]
+        self.concurrency = max(1, config["concurrency"])
+        self.batch_tenants = config.get("batch_tenants", set())
+        self.api_keys = config.get("api_keys", set())
+        self.salt = config.get("salt", _DEFAULT_SALT)
+        self.idle_s = config.get("idle_s", 600.0)
+        self._next_sweep = time.monotonic() + self.idle_s
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._stats: Dict[str, _TenantStats] = {}
+        self._class_stats = {priority: _TenantStats() for priority in PRIORITIES}
+        self._waiting = Counter()
+        self._last_tag: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = 0
+        # Guards bucket/stat state, which is also touched from worker threads
+        self._lock = threading.Lock()
+
+    def policy(self, tenant: str) -> TenantPolicy:
+        return self.policies.get(tenant, self.default_policy)
+
+    def _tenant_stats(self, tenant: str) -> _TenantStats:
+        if tenant not in self._stats:
+            self._stats[tenant] = _TenantStats()
+        stats = self._stats[tenant]
+        stats.last_seen = time.monotonic()
+        return stats
+
+    def _sweep(self):
+        """Forget idle tenants (caller holds the lock) so per-tenant state stays bounded"""
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.idle_s
+        for tenant, stats in list(self._stats.items()):
+            if stats.queued or stats.running or now - stats.last_seen < self.idle_s:
+                continue
+            del self._stats[tenant]
+            bucket = self._buckets.get(tenant)
+            if bucket is not None and bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity:
+                # A full bucket is the same as a new one
+                del self._buckets[tenant]
+        for tenant, bucket in list(self._buckets.items()):
+            if tenant not in self._stats and bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity:
+                del self._buckets[tenant]
+        # Tags at or behind virtual time change nothing: max(virtual_time, tag)
+        self._last_tag = {t: tag for t, tag in self._last_tag.items() if tag > self._virtual_time}
+
+    def resolve_tenant(self, api_key: str = None, client_host: str = None) -> str:
+        return resolve_tenant(api_key, client_host, self.api_keys, self.salt)
+
+    def check_rate(self, tenant: str):
+        """Consume one token for the tenant or raise RateLimitExceeded"""
+        if not self.enabled:
+            return
+        policy = self.policy(tenant)
+        with self._lock:
+            self._sweep()
+            bucket = self._buckets.get(tenant)
+            if bucket is None:
+                bucket = self._buckets[tenant] = TokenBucket(policy.rate, policy.burst)
+            retry_after = bucket.try_acquire()
+            if retry_after:
+                self._tenant_stats(tenant).rejected += 1
+                raise RateLimitExceeded(tenant, retry_after)
+
+    def resolve_priority(self, requested: Optional[str], tenant: str) -> str:
+        return resolve_priority(requested, tenant, self.batch_tenants)
+
+    def _dispatch(self):
+        while self._heap and self._running < self.concurrency:
+            _, tag, _, priority, future = heapq.heappop(self._heap)
+            if future.done():  # waiter was cancelled
+                continue
+            self._virtual_time = max(self._virtual_time, tag)
+            self._running += 1
+            self._waiting[priority] -= 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, priority: str = "interactive"):
+        """Hold one inference slot, queued in the priority's lane and fairly against other tenants"""
+        policy = self.policy(tenant)
+        with self._lock:
+            self._sweep()
+            stats = self._tenant_stats(tenant)
+            lane = self._class_stats[priority]
+            stats.queued += 1
+            lane.queued += 1
+        tag = max(self._virtual_time, self._last_tag.get(tenant, 0.0)) + 1.0 / max(policy.weight, 1e-6)
+        self._last_tag[tenant] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (PRIORITIES.index(priority), tag, next(self._seq), priority, future))
+        self._waiting[priority] += 1
+        queued_at = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        except BaseException:
+            with self._lock:
+                stats.queued -= 1
+                lane.queued -= 1
+            if future.done() and not future.cancelled():
+                # Slot was granted just as we were cancelled: hand it back
+                self._running -= 1
+                self._dispatch()
+            else:
+                self._waiting[priority] -= 1
+            raise
+
+        wait = time.monotonic() - queued_at
+        with self._lock:
+            for s in (stats, lane):
+                s.queued -= 1
+                s.running += 1
+                s.admitted += 1
+                s.waits.append(wait)
+        try:
+            yield
+        finally:
+            with self._lock:
+                stats.running -= 1
+                lane.running -= 1
+            self._running -= 1
+            self._dispatch()
+
+    def preempt_check(self, priority: str) -> Optional[Callable[[], bool]]:
+        """
+        For batch work: a callable that turns True while interactive requests
+        are queued (polled from the worker thread between agent steps).
+        """
+        if priority == "interactive":
+            return None
+        return lambda: self._waiting["interactive"] > 0
+
+    def record_preemption(self, tenant: str, priority: str):
+        with self._lock:
+            self._tenant_stats(tenant).preempted += 1
+            self._class_stats[priority].preempted += 1
+
+    def record_latency(self, tenant: str, seconds: float, priority: str = "interactive"):
+        with self._lock:
+            self._tenant_stats(tenant).latencies.append(seconds)
+            self._class_stats[priority].latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "concurrency": self.concurrency,
+                "running": self._running,
+                "queued": sum(self._waiting.values()),
+                "classes": {p: s.snapshot() for p, s in self._class_stats.items()},
+                "tenants": {t: s.snapshot() for t, s in self._stats.items()},
+            }
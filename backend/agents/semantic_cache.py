@@ -0,0 +1,215 @@
+# agents/semantic_cache.py - Embedding-based near-duplicate cache for generation results
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+# Upper edges of the similarity histogram buckets
+_SIM_BUCKETS = [0.5, 0.7, 0.8, 0.9, 0.95, 1.0]
+
+
+def normalize_brief(user_instruction: str, tone: str, style: str) -> str:
+    """Canonical text that gets embedded for a request"""
+    def clean(text):
+        return re.sub(r"\s+", " ", (text or "")).strip().lower()
+    return f"{clean(user_instruction)} | tone: {clean(tone)} | style: {clean(style)}"
+
+
+def semantic_cache_config() -> dict:
+    """Read semantic cache settings from the environment"""
+    return {
+        "enabled": os.getenv("SEMANTIC_CACHE_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on"),
+        "model": os.getenv("SEMANTIC_CACHE_MODEL", "sentence-transformers/all-MiniLM-L6-v2"),
+        "threshold": float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+        # serve: return the cached generation; seed: use it as a starting draft
+        "mode": os.getenv("SEMANTIC_CACHE_MODE", "serve").strip().lower(),
+        "capacity": int(os.getenv("SEMANTIC_CACHE_CAPACITY", "5000")),
+        "path": os.getenv("SEMANTIC_CACHE_PATH", "./semantic_cache"),
+        "save_every": int(os.getenv("SEMANTIC_CACHE_SAVE_EVERY", "20")),
+    }
+
+
+class SemanticCache:
+    """
+    In-process vector index over normalized briefs.
+
+    Vectors are unit-normalized and kept in one contiguous NumPy matrix, so
+    a lookup is a single matrix-vector product. Eviction is least-recently-
+    used once capacity is reached.
+    """
+
+    def __init__(self, embed_fn, dim: int, threshold: float = 0.92, capacity: int = 5000,
+                 path: Optional[str] = None, save_every: int = 20, mode: str = "serve"):
+        import numpy as np
+        self._np = np
+        self.embed_fn = embed_fn
+        self.dim = dim
+        self.threshold = threshold
+        self.capacity = capacity
+        self.mode = mode
+        self.path = Path(path) if path else None
+        self.save_every = save_every
+
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._entries = [None] * capacity
+        self._size = 0
+        self._dirty = 0
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "inserts": 0, "evictions": 0, "similarity_sum": 0.0}
+        self.similarity_histogram = [0] * len(_SIM_BUCKETS)
+
+        if self.path is not None:
+            self.load()
+
+    def _embed(self, text: str):
+        vec = self._np.asarray(self.embed_fn(text), dtype=self._np.float32).reshape(-1)
+        norm = self._np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _record_similarity(self, sim: float):
+        self.stats["similarity_sum"] += sim
+        for i, edge in enumerate(_SIM_BUCKETS):
+            if sim <= edge:
+                self.similarity_histogram[i] += 1
+                break
+
+    def lookup(self, brief: str):
+        """Return (entry, similarity) for the closest brief above threshold, else (None, best_sim)"""
+        vec = self._embed(brief)
+        with self._lock:
+            self.stats["lookups"] += 1
+            if self._size == 0:
+                return None, 0.0
+            sims = self._vectors[:self._size] @ vec
+            idx = int(sims.argmax())
+            sim = float(sims[idx])
+            self._record_similarity(sim)
+            if sim < self.threshold:
+                return None, sim
+            entry = self._entries[idx]
+            entry["last_used"] = time.time()
+            entry["hits"] += 1
+            self.stats["hits"] += 1
+            return entry, sim
+
+    def add(self, brief: str, result: dict):
+        vec = self._embed(brief)
+        with self._lock:
+            if self._size < self.capacity:
+                idx = self._size
+                self._size += 1
+            else:
+                # Evict the least recently used entry
+                idx = min(range(self._size), key=lambda i: self._entries[i]["last_used"])
+                self.stats["evictions"] += 1
+            self._vectors[idx] = vec
+            now = time.time()
+            self._entries[idx] = {"brief": brief, "result": result, "created": now, "last_used": now, "hits": 0}
+            self.stats["inserts"] += 1
+            self._dirty += 1
+            should_save = self.path is not None and self._dirty >= self.save_every
+        if should_save:
+            self.save()
+
+    def save(self):
+        """Persist vectors (.npy) and entries (.json) atomically"""
+        if self.path is None:
+            return
+        with self._lock:
+            vectors = self._vectors[:self._size].copy()
+            entries = list(self._entries[:self._size])
+            self._dirty = 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_vec = self.path / "vectors.tmp.npy"
+        tmp_meta = self.path / "entries.tmp.json"
+        self._np.save(tmp_vec, vectors)
+        with open(tmp_meta, "w") as f:
+            json.dump({"dim": self.dim, "entries": entries}, f)
+        os.replace(tmp_vec, self.path / "vectors.npy")
+        os.replace(tmp_meta, self.path / "entries.json")
+
+    def load(self):
+        vec_file, meta_file = self.path / "vectors.npy", self.path / "entries.json"
+        if not (vec_file.exists() and meta_file.exists()):
+            return
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get("dim") != self.dim:
+            print(f"⚠️  Semantic cache at {self.path} has dim {meta.get('dim')}, expected {self.dim}; ignoring")
+            return
+        vectors = self._np.load(vec_file)
+        # Keep the most recently used entries if the stored cache is larger than capacity
+        order = sorted(range(len(meta["entries"])), key=lambda i: meta["entries"][i]["last_used"], reverse=True)
+        order = order[:self.capacity]
+        with self._lock:
+            for slot, i in enumerate(order):
+                self._vectors[slot] = vectors[i]
+                self._entries[slot] = meta["entries"][i]
+            self._size = len(order)
+        print(f"📦 Semantic cache: loaded {self._size} entries from {self.path}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.stats["lookups"]
+            scored = sum(self.similarity_histogram)
+            return {
+                "enabled": True,
+                "mode": self.mode,
+                "size": self._size,
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "lookups": lookups,
+                "hits": self.stats["hits"],
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+                "mean_best_similarity": round(self.stats["similarity_sum"] / scored, 4) if scored else None,
+                "similarity_histogram": dict(zip([f"<={e}" for e in _SIM_BUCKETS], self.similarity_histogram)),
+                "inserts": self.stats["inserts"],
+                "evictions": self.stats["evictions"],
+            }
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """Shared cache instance, or None when disabled / sentence-transformers is missing"""
+    global _CACHE
+    if _CACHE is not None:
+        return _CACHE or None
+    with _CACHE_LOCK:
+        if _CACHE is not None:
+            return _CACHE or None
+        config = semantic_cache_config()
+        if not config["enabled"]:
+            _CACHE = False
+            return None
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            print("⚠️  SEMANTIC_CACHE_ENABLED but sentence-transformers is not installed; cache disabled")
+            _CACHE = False
+            return None
+        print(f"🧠 Loading embedding model: {config['model']}")
+        model = SentenceTransformer(config["model"], device="cpu")
+        _CACHE = SemanticCache(
+            embed_fn=lambda text: model.encode(text, normalize_embeddings=True),
+            dim=model.get_sentence_embedding_dimension(),
+            threshold=config["threshold"],
+            capacity=config["capacity"],
+            path=config["path"],
+            save_every=config["save_every"],
+            mode=config["mode"],
+        )
+        atexit.register(_CACHE.save)
+        return _CACHE
+
+
+def semantic_cache_stats() -> dict:
+    cache = _CACHE or None
+    return cache.snapshot() if cache else {"enabled": False}
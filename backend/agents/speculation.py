@@ -0,0 +1,97 @@
+# agents/speculation.py - Speculative image prompts written from the draft while the reviewer runs
+
+import os
+import threading
+import time
+from typing import Callable
+
+from .convergence import similarity
+
+
+def speculation_config() -> dict:
+    """Read speculative pipelining settings from the environment"""
+    return {
+        "enabled": os.getenv("SPECULATIVE_IMAGE_PROMPT", "false").strip().lower() in ("1", "true", "yes", "on"),
+        # Keep the speculative prompt when the reviewed text is at least this close to the draft
+        "similarity": float(os.getenv("SPECULATION_SIMILARITY", "0.85")),
+    }
+
+
+def speculation_enabled() -> bool:
+    return speculation_config()["enabled"]
+
+
+def timed_node(node: Callable, key: str) -> Callable:
+    """Wrap a graph node so its update also carries its run time (seconds) under key"""
+    def run(state):
+        start = time.perf_counter()
+        update = node(state)
+        return {**update, key: time.perf_counter() - start}
+    return run
+
+
+def resolve_speculation(state: dict, regenerate: Callable[[], str]) -> str:
+    """
+    Join of the speculative branch: the image prompt written from the draft
+    when the review barely changed it, otherwise regenerate() on the
+    reviewed text.
+
+    Critical-path time saved against running the two sequentially: on a hit
+    the shorter of review and speculation; on a miss minus however long the
+    speculation outlasted the review (both wait for the slower branch).
+    """
+    speculative = state.get("speculative_image_prompt") or ""
+    review_s = state.get("review_s") or 0.0
+    speculation_s = state.get("speculative_image_s") or 0.0
+    score = similarity(state.get("draft_text", ""), state.get("reviewed_text", ""))
+    if speculative and score >= speculation_config()["similarity"]:
+        SPECULATION_STATS.record(True, score, saved_s=min(review_s, speculation_s))
+        return speculative
+    SPECULATION_STATS.record(False, score, saved_s=-max(0.0, speculation_s - review_s), wasted_s=speculation_s)
+    return regenerate()
+
+
+# ========== STATS ========== #
+
+class SpeculationStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.similarity_total = 0.0
+        self.saved_s = 0.0
+        self.wasted_s = 0.0
+
+    def record(self, hit: bool, score: float, saved_s: float, wasted_s: float = 0.0):
+        with self._lock:
+            self.hits += hit
+            self.misses += not hit
+            self.similarity_total += score
+            self.saved_s += saved_s
+            self.wasted_s += wasted_s
+
+    def snapshot(self) -> dict:
+        config = speculation_config()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": config["enabled"],
+                "similarity_threshold": config["similarity"],
+                "speculations": total,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+                "mean_similarity": round(self.similarity_total / total, 3) if total else None,
+                # Net critical-path seconds saved (misses that outlast the review count against it)
+                "critical_path_saved_s": round(self.saved_s, 3),
+                "mean_saved_s": round(self.saved_s / total, 3) if total else None,
+                # Model time spent on speculative prompts that were thrown away
+                "wasted_model_s": round(self.wasted_s, 3),
+            }
+
+
+SPECULATION_STATS = SpeculationStats()
+
+
+def speculation_stats() -> dict:
+    return SPECULATION_STATS.snapshot()
@@ -0,0 +1,342 @@
+# agents/structured.py - Schema-constrained JSON output for agent calls
+
+import json
+import os
+import threading
+from collections import Counter
+from typing import Optional
+
+from .budgets import GenerationBudget
+
+# Average characters per token, used to size max_new_tokens for a schema
+CHARS_PER_TOKEN = 3.5
+
+DECISION_SCHEMA = {
+    "decision": {"enum": ["APPROVED", "NEEDS_CHANGES"]},
+    "reasons": {"type": "array", "max_items": 3, "max_chars": 160},
+}
+
+
+def structured_enabled() -> bool:
+    """OUTPUT_MODE=structured switches writer and compliance calls to JSON output"""
+    return os.getenv("OUTPUT_MODE", "text").strip().lower() == "structured"
+
+
+def caption_schema(budget: GenerationBudget) -> dict:
+    """Writer schema sized from the style-derived budget"""
+    if budget.max_words:
+        caption_chars = budget.max_words * 7
+    elif budget.max_lines:
+        caption_chars = budget.max_lines * 80
+    else:
+        caption_chars = 600
+    max_tags = budget.max_hashtags if budget.max_hashtags is not None else 5
+    return {
+        "caption": {"type": "string", "max_chars": min(caption_chars, 600)},
+        "hashtags": {"type": "array", "max_items": max_tags, "max_chars": 30},
+        "image_prompt": {"type": "string", "max_chars": 300},
+    }
+
+
+def fused_schema(budget: GenerationBudget) -> dict:
+    """Writer schema with a first draft ahead of the self-edited caption"""
+    schema = caption_schema(budget)
+    return {"draft": dict(schema["caption"]), **schema}
+
+
+def schema_budget(schema: dict) -> GenerationBudget:
+    """Token cap large enough for every field at its maximum size"""
+    chars = 2
+    for name, spec in schema.items():
+        chars += len(name) + 6
+        if "enum" in spec:
+            chars += max(len(option) for option in spec["enum"]) + 2
+        elif spec["type"] == "array":
+            chars += spec["max_items"] * (spec["max_chars"] + 4) + 2
+        else:
+            chars += spec["max_chars"] + 2
+    return GenerationBudget(max_new_tokens=int(chars / CHARS_PER_TOKEN) + JsonGuide(schema).close_reserve)
+
+
+def schema_hint(schema: dict) -> str:
+    """One-line example of the expected JSON for the prompt"""
+    parts = []
+    for name, spec in schema.items():
+        if "enum" in spec:
+            example = " | ".join(json.dumps(option) for option in spec["enum"])
+        elif spec["type"] == "array":
+            example = '["..."]'
+        else:
+            example = '"..."'
+        parts.append(f'"{name}": {example}')
+    return "{" + ", ".join(parts) + "}"
+
+
+def json_instruction(schema: dict) -> str:
+    """Closing prompt line asking for the schema's JSON"""
+    return f"Reply with JSON only, in this form: {schema_hint(schema)}\n\nJSON:"
+
+
+def to_json_schema(schema: dict) -> dict:
+    """JSON Schema for servers with built-in grammar support (TGI `grammar`)"""
+    properties = {}
+    for name, spec in schema.items():
+        if "enum" in spec:
+            properties[name] = {"type": "string", "enum": spec["enum"]}
+        elif spec["type"] == "array":
+            properties[name] = {
+                "type": "array",
+                "items": {"type": "string", "maxLength": spec["max_chars"]},
+                "maxItems": spec["max_items"],
+            }
+        else:
+            properties[name] = {"type": "string", "maxLength": spec["max_chars"]}
+    return {"type": "object", "properties": properties, "required": list(schema)}
+
+
+def parse_structured(text: str, schema: dict) -> Optional[dict]:
+    """Decode a JSON answer; None unless every schema field is present"""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1], strict=False)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or any(name not in data for name in schema):
+        return None
+    return data
+
+
+def render_caption(data: dict) -> str:
+    """Caption text plus hashtags, as the text-mode writer would produce it"""
+    tags = [t if t.startswith("#") else f"#{t}" for t in (data.get("hashtags") or []) if t.strip()]
+    caption = data.get("caption", "").strip()
+    return f"{caption}\n\n{' '.join(tags)}" if tags else caption
+
+
+# ========== CONSTRAINED DECODING ========== #
+
+_INVALID = ("invalid",)
+
+
+class JsonGuide:
+    """
+    Incremental matcher for a flat JSON object with a fixed key order.
+
+    need(text) scans the text generated so far and reports what may come
+    next: the rest of a literal, one of several enum values, string content
+    (no quotes, escapes or control characters), or the end of the output.
+    Whitespace is accepted wherever JSON allows it, i.e. outside quotes.
+    """
+
+    def __init__(self, schema: dict):
+        self.segments = []
+        for i, (name, spec) in enumerate(schema.items()):
+            self.segments.append(("lit", ("{" if i == 0 else ",") + json.dumps(name) + ":"))
+            if "enum" in spec:
+                self.segments.append(("enum", [json.dumps(option) for option in spec["enum"]]))
+            elif spec["type"] == "array":
+                self.segments.append(("array", spec["max_items"], spec["max_chars"]))
+            else:
+                self.segments.append(("string", spec["max_chars"]))
+        self.segments.append(("lit", "}"))
+        # Worst case (one token per character) to finish the object from anywhere
+        self.close_reserve = sum(len(seg[1]) for seg in self.segments if seg[0] == "lit") + 4 * len(schema)
+
+    @staticmethod
+    def _skip_ws(text: str, pos: int) -> int:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        return pos
+
+    def _string(self, text: str, pos: int, max_chars: int):
+        """Scan a string value starting at its opening quote; returns (pos, need)"""
+        if pos >= len(text):
+            return pos, ("open",)
+        if text[pos] != '"':
+            return pos, _INVALID
+        end = text.find('"', pos + 1)
+        if end == -1:
+            return pos, ("content", len(text) - pos - 1, max_chars)
+        return end + 1, None
+
+    def need(self, text: str, closing: bool = False):
+        """
+        What may follow text. With closing=True (token budget nearly spent)
+        open strings and arrays are ended as soon as possible.
+        """
+        pos = 0
+        for segment in self.segments:
+            kind = segment[0]
+            if kind == "lit":
+                for k, char in enumerate(segment[1]):
+                    ws_ok = segment[1][:k].count('"') % 2 == 0
+                    if ws_ok:
+                        pos = self._skip_ws(text, pos)
+                    if pos >= len(text):
+                        return ("lit", [segment[1][k:]], ws_ok)
+                    if text[pos] != char:
+                        return _INVALID
+                    pos += 1
+            elif kind == "enum":
+                pos = self._skip_ws(text, pos)
+                options = segment[1]
+                matched = ""
+                while matched not in options:
+                    alive = [o for o in options if o.startswith(matched)]
+                    if pos >= len(text):
+                        return ("lit", [o[len(matched):] for o in alive], not matched)
+                    matched += text[pos]
+                    pos += 1
+                    if not any(o.startswith(matched) for o in alive):
+                        return _INVALID
+            elif kind == "string":
+                pos, need = self._string(text, self._skip_ws(text, pos), 0 if closing else segment[1])
+                if need:
+                    return need
+            else:
+                _, max_items, max_chars = segment
+                if closing:
+                    max_items, max_chars = 0, 0
+                pos = self._skip_ws(text, pos)
+                if pos >= len(text):
+                    return ("lit", ["["], True)
+                if text[pos] != "[":
+                    return _INVALID
+                pos += 1
+                count = 0
+                while True:
+                    pos = self._skip_ws(text, pos)
+                    if pos >= len(text):
+                        if count == 0:
+                            return ("lit", ['"', "]"] if max_items else ["]"], True)
+                        return ("lit", [",", "]"] if count < max_items else ["]"], True)
+                    if text[pos] == "]":
+                        pos += 1
+                        break
+                    if count:
+                        if text[pos] != ",":
+                            return _INVALID
+                        pos = self._skip_ws(text, pos + 1)
+                    pos, need = self._string(text, pos, max_chars)
+                    if need:
+                        return need
+                    count += 1
+        pos = self._skip_ws(text, pos)
+        return ("done",) if pos >= len(text) else _INVALID
+
+
+class VocabIndex:
+    """Per-tokenizer lookup tables: token text -> ids, and a mask of string-safe tokens"""
+
+    def __init__(self, tokenizer):
+        import torch
+        self.eos_id = tokenizer.eos_token_id
+        special = set(tokenizer.all_special_ids)
+        size = len(tokenizer)
+        self.by_text = {}
+        self.plain = torch.zeros(size, dtype=torch.bool)
+        # Decode after an anchor token so SentencePiece keeps leading spaces
+        anchor = tokenizer.encode("a", add_special_tokens=False)[-1:]
+        anchor_text = tokenizer.decode(anchor)
+        for token_id in range(size):
+            if token_id in special:
+                continue
+            text = tokenizer.decode(anchor + [token_id])[len(anchor_text):]
+            if not text:
+                continue
+            self.by_text.setdefault(text, []).append(token_id)
+            if not any(c in text for c in '"\\') and all(c >= " " for c in text):
+                self.plain[token_id] = True
+        self.quote = self.by_text.get('"', [])
+
+    def allowed(self, need, vocab_size: int):
+        import torch
+        mask = torch.zeros(vocab_size, dtype=torch.bool)
+        kind = need[0]
+        if kind == "lit":
+            _, options, ws_ok = need
+            for remaining in options:
+                for j in range(1, len(remaining) + 1):
+                    mask[self.by_text.get(remaining[:j], [])] = True
+                    if ws_ok:
+                        mask[self.by_text.get(" " + remaining[:j], [])] = True
+        elif kind == "open":
+            mask[self.quote] = True
+        elif kind == "content":
+            _, length, max_chars = need
+            if length < max_chars:
+                mask[:len(self.plain)] = self.plain[:vocab_size]
+            if length > 0 or max_chars == 0:
+                mask[self.quote] = True
+        if not mask.any() and self.eos_id is not None:
+            mask[self.eos_id] = True
+        return mask
+
+
+_VOCAB_INDEX = {}
+_VOCAB_LOCK = threading.Lock()
+
+
+def vocab_index(tokenizer) -> VocabIndex:
+    """Built once per tokenizer (one pass over the vocabulary)"""
+    key = id(tokenizer)
+    with _VOCAB_LOCK:
+        if key not in _VOCAB_INDEX:
+            _VOCAB_INDEX[key] = VocabIndex(tokenizer)
+        return _VOCAB_INDEX[key]
+
+
+def json_logits_processor(tokenizer, schema: dict, max_new_tokens: int):
+    """LogitsProcessor that masks every token that would break the schema"""
+    import torch
+    from transformers import LogitsProcessor
+
+    class JsonSchemaLogitsProcessor(LogitsProcessor):
+        def __init__(self):
+            self.guide = JsonGuide(schema)
+            self.index = vocab_index(tokenizer)
+            self.prompt_len = None
+
+        def __call__(self, input_ids, scores):
+            # First call happens before any token is generated
+            if self.prompt_len is None:
+                self.prompt_len = input_ids.shape[1]
+            closing = max_new_tokens - (input_ids.shape[1] - self.prompt_len) <= self.guide.close_reserve
+            mask = torch.zeros_like(scores, dtype=torch.bool)
+            for row, ids in enumerate(input_ids):
+                text = tokenizer.decode(ids[self.prompt_len:], skip_special_tokens=True)
+                need = self.guide.need(text, closing)
+                mask[row] = self.index.allowed(need, scores.shape[-1]).to(scores.device)
+            return scores.masked_fill(~mask, float("-inf"))
+
+    return JsonSchemaLogitsProcessor()
+
+
+# ========== STATS ========== #
+
+class StructuredStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def record(self, schema_name: str, parsed: bool):
+        with self._lock:
+            self.counts[f"{schema_name}_calls"] += 1
+            self.counts[f"{schema_name}_parse_failures"] += 0 if parsed else 1
+
+    def count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"enabled": structured_enabled(), **self.counts}
+
+
+STRUCTURED_STATS = StructuredStats()
+
+
+def structured_stats() -> dict:
+    return STRUCTURED_STATS.snapshot()
@@ -0,0 +1,56 @@
+# agents/variants.py - Scoring and ranking of multiple caption candidates
+
+import re
+from difflib import SequenceMatcher
+from typing import List
+
+from .budgets import GenerationBudget
+
+_HASHTAG_RE = re.compile(r"#\w+")
+
+
+def fit_score(text: str, budget: GenerationBudget) -> float:
+    """0..1 score for how well a caption respects the requested structure"""
+    if not text or text.startswith("[Generation failed]"):
+        return 0.0
+    score = 1.0
+    if budget.max_hashtags is not None:
+        tags = len(_HASHTAG_RE.findall(text))
+        if budget.max_hashtags == 0:
+            score -= 0.3 if tags else 0.0
+        elif tags == 0 or tags > budget.max_hashtags:
+            score -= 0.3
+    if budget.max_words is not None and len(text.split()) > budget.max_words:
+        score -= 0.3
+    if budget.max_lines is not None:
+        lines = [l for l in text.split("\n") if l.strip()]
+        if len(lines) > budget.max_lines:
+            score -= 0.2
+    # Very short outputs are usually truncated or degenerate
+    if len(text.split()) < 4:
+        score -= 0.4
+    return max(score, 0.0)
+
+
+def rank_variants(variants: List[dict], budget: GenerationBudget) -> List[dict]:
+    """
+    Order candidates: approved first, then structural fit, then diversity.
+
+    Each variant dict needs "text" and "compliance_status"; "score" and
+    "rank" are added in place.
+    """
+    for v in variants:
+        approved = 1.0 if v.get("compliance_status") == "approved" else 0.0
+        v["score"] = round(approved + fit_score(v["text"], budget), 3)
+
+    ranked = []
+    for v in sorted(variants, key=lambda v: v["score"], reverse=True):
+        # Push near-duplicates of an already-ranked caption to the back
+        if any(SequenceMatcher(None, v["text"], r["text"]).ratio() > 0.9 for r in ranked):
+            v["score"] = round(v["score"] - 1.0, 3)
+        ranked.append(v)
+    ranked.sort(key=lambda v: v["score"], reverse=True)
+
+    for i, v in enumerate(ranked, start=1):
+        v["rank"] = i
+    return ranked
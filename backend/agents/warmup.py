@@ -0,0 +1,185 @@
+# agents/warmup.py - Startup warmup, compile-ahead and cold/steady latency tracking
+
+import os
+import statistics
+import threading
+import time
+from collections import deque
+
+import torch
+
+_SAMPLE_TEXT = (
+    "Create an engaging Instagram caption for an eco-friendly reusable water bottle "
+    "with a fun, friendly tone, a short call to action and three relevant hashtags. "
+)
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+def warmup_config() -> dict:
+    """Read warmup settings from the environment"""
+    lengths = os.getenv("WARMUP_PROMPT_TOKENS", "16,128,512")
+    return {
+        "enabled": _env_flag("WARMUP_ENABLED", "true"),
+        "prompt_tokens": [int(n) for n in lengths.split(",") if n.strip()],
+        "new_tokens": int(os.getenv("WARMUP_NEW_TOKENS", "8")),
+        "rounds": int(os.getenv("WARMUP_ROUNDS", "3")),
+        # none | static_cache | torch_compile
+        "compile": os.getenv("WARMUP_COMPILE", "none").strip().lower(),
+    }
+
+
+class LatencyTracker:
+    """Keep the first observed latency apart from a rolling steady-state window"""
+
+    def __init__(self, window: int = 50):
+        self.first = None
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            if self.first is None:
+                self.first = seconds
+            else:
+                self.recent.append(seconds)
+
+    def report(self) -> dict:
+        with self._lock:
+            steady = statistics.median(self.recent) if self.recent else None
+            return {
+                "first_s": round(self.first, 3) if self.first is not None else None,
+                "steady_state_p50_s": round(steady, 3) if steady is not None else None,
+                "gap_s": round(self.first - steady, 3) if steady is not None else None,
+                "samples": len(self.recent) + (self.first is not None),
+            }
+
+
+# Request-level latency (generate_content) and warmup results for the status endpoint
+REQUEST_LATENCY = LatencyTracker()
+WARMUP_STATUS = {"state": "pending", "roles": {}, "compile": None, "elapsed_s": None}
+
+
+def _prompt_of_length(tokenizer, n_tokens: int) -> str:
+    """Repeat the sample brief and cut it to roughly n_tokens"""
+    ids = tokenizer.encode(_SAMPLE_TEXT, add_special_tokens=False)
+    reps = n_tokens // max(len(ids), 1) + 1
+    ids = tokenizer.encode(_SAMPLE_TEXT * reps, add_special_tokens=False)[:n_tokens]
+    return tokenizer.decode(ids, skip_special_tokens=True)
+
+
+def _compile_ahead(pipe, mode: str):
+    """
+    Fix KV-cache shapes and optionally torch.compile the forward pass.
+    Returns the mode applied and a function that undoes it.
+    """
+    if mode not in ("static_cache", "torch_compile"):
+        return "none", lambda: None
+    model = pipe.model
+    # The pipeline deep-copies the model's generation config when it is built,
+    # so only its own copy reaches pipe() calls
+    previous_cache = pipe.generation_config.cache_implementation
+    own_forward = "forward" in model.__dict__  # e.g. an accelerate hook
+    previous_forward = model.forward
+
+    def undo():
+        pipe.generation_config.cache_implementation = previous_cache
+        if own_forward:
+            model.forward = previous_forward
+        else:
+            model.__dict__.pop("forward", None)
+
+    try:
+        # Static cache keeps tensor shapes constant across calls, which is
+        # what lets compiled graphs be reused instead of recompiled
+        pipe.generation_config.cache_implementation = "static"
+        if mode == "torch_compile":
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+        return mode, undo
+    except Exception as e:
+        print(f"⚠️  Compile-ahead ({mode}) unavailable: {e}")
+        undo()
+        return "none", lambda: None
+
+
+def _warm_call(pipe, prompt: str, new_tokens: int):
+    with torch.inference_mode():
+        pipe(prompt, max_new_tokens=new_tokens, do_sample=False, return_full_text=False)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def warmup_models(roles: dict, config: dict = None) -> dict:
+    """
+    Run representative prompts through every loaded role before serving.
+
+    Args:
+        roles: mapping of role name -> HuggingFacePipeline LLM
+        config: overrides for warmup_config()
+
+    Returns:
+        dict with per-role first-call vs steady-state latency
+    """
+    config = config or warmup_config()
+    if not config["enabled"]:
+        WARMUP_STATUS["state"] = "skipped"
+        return WARMUP_STATUS
+
+    WARMUP_STATUS["state"] = "warming"
+    WARMUP_STATUS["compile"] = config["compile"]
+    start = time.time()
+    warmed = {}
+
+    for role, llm in roles.items():
+        if llm is None:
+            continue
+        pipe = llm.pipeline
+        # Roles backed by the same pipeline only need warming once
+        if id(pipe) in warmed:
+            WARMUP_STATUS["roles"][role] = WARMUP_STATUS["roles"][warmed[id(pipe)]]
+            continue
+        warmed[id(pipe)] = role
+
+        print(f"🔥 Warming up {role}...")
+        compiled, undo = _compile_ahead(pipe, config["compile"])
+        fallback = None
+        # One tracker per prompt length so first vs steady compares like with like
+        trackers = {n: LatencyTracker() for n in config["prompt_tokens"]}
+        for _ in range(max(config["rounds"], 1)):
+            for n, tracker in trackers.items():
+                prompt = _prompt_of_length(pipe.tokenizer, n)
+                t0 = time.time()
+                try:
+                    _warm_call(pipe, prompt, config["new_tokens"])
+                except Exception as e:
+                    # torch.compile and static caches fail lazily, on the first
+                    # call: serve uncompiled rather than fail startup
+                    if compiled == "none":
+                        raise
+                    print(f"⚠️  Compile-ahead ({compiled}) failed for {role}, serving uncompiled: {e}")
+                    undo()
+                    compiled, fallback = "none", f"{type(e).__name__}: {e}"[:200]
+                    t0 = time.time()
+                    _warm_call(pipe, prompt, config["new_tokens"])
+                tracker.record(time.time() - t0)
+
+        WARMUP_STATUS["roles"][role] = {
+            "compile": compiled,
+            "compile_fallback": fallback,
+            "prompt_tokens": {n: t.report() for n, t in trackers.items()},
+        }
+
+    WARMUP_STATUS["elapsed_s"] = round(time.time() - start, 2)
+    WARMUP_STATUS["state"] = "done"
+    print(f"🔥 Warmup finished in {WARMUP_STATUS['elapsed_s']}s")
+    return WARMUP_STATUS
+
+
+def warmup_report() -> dict:
+    """Warmup results plus the live first-request vs steady-state gap"""
+    return {
+        "warmup": WARMUP_STATUS,
+        "request_latency": REQUEST_LATENCY.report(),
+    }
@@ -1,12 +1,35 @@
 # agents/workflow.py - AI Agent Workflow System
 
 import os
-from typing import TypedDict, Literal
+from typing import Callable, TypedDict, Literal
 from langchain_core.messages import SystemMessage, HumanMessage
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
+from transformers import LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
 import torch
 import time
+import uuid
+
+from .budgets import GenerationBudget, derive_budget
+from .warmup import REQUEST_LATENCY, warmup_models
+from .model_cache import load_quantized
+from .variants import fit_score, rank_variants
+from .semantic_cache import get_semantic_cache, normalize_brief
+from .cancellation import CancelToken, current_token, request_cancelled, use_token
+from .profiling import profile_session, profiled_call, profiling_config
+from .context import Prompt, Section, fit_prompt
+from .residency import ResidencyManager, resident, residency_config, set_manager
+from .adapters import (BASE_ADAPTER, ROLES, AdapterLLM, adapter_config, adapter_kwargs, adapter_of, adapter_paths,
+                       attach_adapters, record_loaded)
+from .convergence import CONVERGENCE_STATS, convergence_update, resolve_policy
+from .capture import call_key, current_session
+from .kv_cache import kv_cache
+from .speculation import resolve_speculation, speculation_enabled, timed_node
+from .compact_state import intern_text, make_checkpointer, release_thread
+from .routing import (CASCADE_STATS, cascade_enabled, check_caption, check_image_prompt,
+                      check_margin, routing_config)
+from .structured import (DECISION_SCHEMA, STRUCTURED_STATS, caption_schema, fused_schema, json_logits_processor,
+                         json_instruction, parse_structured, render_caption, schema_budget, structured_enabled,
+                         vocab_index)
 
 print("🔧 System Check...")
 print(f"PyTorch: {torch.__version__}")
@@ -28,57 +51,47 @@ class WorkflowState(TypedDict, total=False):
     compliance_status: Literal["pending", "approved", "needs_changes"]
     compliance_feedback: str
     revision_notes: str
+    seed_draft: str
+    draft_image_prompt: str
+    # Speculative image prompt written from the draft alongside the review
+    speculative_image_prompt: str
+    speculative_image_s: float
+    review_s: float
+    # Iteration budget and convergence tracking
+    policy: str
+    max_iterations: int
+    last_feedback: str
+    last_text: str
+    best_score: float
+    stale_rounds: int
+    stop_reason: str
 
 # ========== OPTIMIZED LLM SETUP ========== #
 
-def make_llm_quantized(model_id: str, use_4bit: bool = True):
-    """Create optimized LLM with quantization"""
-    from langchain_huggingface import HuggingFacePipeline
-    from transformers import (
-        AutoModelForCausalLM, 
-        AutoTokenizer, 
-        pipeline, 
-        BitsAndBytesConfig
-    )
-    
-    print(f"🚀 Loading: {model_id}")
-    
-    # Quantization config
+def _bnb_config(use_4bit: bool):
+    from transformers import BitsAndBytesConfig
     if use_4bit:
         print("⚡ Applying: 4-bit quantization")
-        bnb_config = BitsAndBytesConfig(
+        return BitsAndBytesConfig(
             load_in_4bit=True,
             bnb_4bit_compute_dtype=torch.float16,
             bnb_4bit_use_double_quant=True,
             bnb_4bit_quant_type="nf4",
         )
-    else:
-        print("⚡ Applying: 8-bit quantization")
-        bnb_config = BitsAndBytesConfig(
-            load_in_8bit=True,
-            llm_int8_threshold=6.0,
-        )
-    
-    # Load tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_id,
-        use_fast=True,
-        padding_side='left',
-        trust_remote_code=True
+    print("⚡ Applying: 8-bit quantization")
+    return BitsAndBytesConfig(
+        load_in_8bit=True,
+        llm_int8_threshold=6.0,
     )
+
+
+def _text_pipeline(model, tokenizer, model_id: str):
+    """Text-generation pipeline with our sampling defaults"""
+    from transformers import pipeline
     
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
     
-    # Load model with optimizations
-    model = AutoModelForCausalLM.from_pretrained(
-        model_id,
-        quantization_config=bnb_config,
-        device_map="auto",
-        trust_remote_code=True,
-        torch_dtype=torch.float16,
-    )
-    
     # Determine max tokens based on model size
     if "7b" in model_id.lower():
         max_tokens = 400
@@ -106,9 +119,58 @@ def make_llm_quantized(model_id: str, use_4bit: bool = True):
     # Ensure chat template exists
     if not getattr(tokenizer, "chat_template", None):
         tokenizer.chat_template = "{% for m in messages %}{{ m['role'] }}: {{ m['content'] }}{% endfor %}"
+    return pipe
+
+
+def make_llm_quantized(model_id: str, use_4bit: bool = True):
+    """Create optimized LLM with quantization"""
+    from langchain_huggingface import HuggingFacePipeline
+    
+    print(f"🚀 Loading: {model_id}")
+    
+    # Load tokenizer + quantized model (through MODEL_CACHE_DIR when set)
+    model, tokenizer = load_quantized(
+        model_id,
+        "nf4" if use_4bit else "int8",
+        _bnb_config(use_4bit),
+        tokenizer_kwargs=dict(use_fast=True, padding_side='left', trust_remote_code=True),
+    )
+    
+    return HuggingFacePipeline(pipeline=_text_pipeline(model, tokenizer, model_id))
+
+
+def make_llm_shared(model_id: str, quantization: str = "nf4") -> dict:
+    """
+    One base model for every role, each role with its own LoRA adapter.
+    quantization is nf4, int8 or none; none (or no GPU) loads the plain
+    checkpoint, so any small local model works on CPU.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    
+    print(f"🚀 Loading shared base: {model_id}")
+    tokenizer_kwargs = dict(use_fast=True, padding_side='left', trust_remote_code=True)
+    if quantization != "none" and not torch.cuda.is_available():
+        print("⚠️  No GPU for bitsandbytes; loading the base model unquantized")
+        quantization = "none"
+    if quantization == "none":
+        tokenizer = AutoTokenizer.from_pretrained(model_id, **tokenizer_kwargs)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            trust_remote_code=True,
+            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+            device_map="auto" if torch.cuda.is_available() else None,
+        )
+    else:
+        model, tokenizer = load_quantized(model_id, quantization, _bnb_config(quantization == "nf4"),
+                                          tokenizer_kwargs=tokenizer_kwargs)
     
-    llm = HuggingFacePipeline(pipeline=pipe)
-    return llm
+    paths = adapter_paths()
+    model = attach_adapters(model, paths)
+    record_loaded(model_id, paths, model)
+    pipe = _text_pipeline(model, tokenizer, model_id)
+    # Once wrapped, a call without adapter names would run under the active adapter
+    fallback = BASE_ADAPTER if paths else None
+    return {role: AdapterLLM(pipe, role if role in paths else fallback) for role in ROLES}
 
 
 # Initialize models globally (lazy loading)
@@ -118,6 +180,29 @@ REVIEWER_LLM = None
 COMPLIANCE_LLM = None
 COORDINATOR_LLM = None
 
+ROLE_MODELS = {
+    "writer": "HuggingFaceH4/zephyr-7b-beta",
+    "reviewer": "microsoft/phi-2",
+    "compliance": "HuggingFaceH4/zephyr-7b-beta",
+    "coordinator": "microsoft/phi-2",
+}
+
+
+def make_resident_llms(config: dict) -> dict:
+    """
+    Role handles over a ResidencyManager: each model loads on first use and
+    may be evicted when idle. Roles on the same checkpoint share one copy.
+    """
+    manager = ResidencyManager(config)
+    roles = {}
+    for model_id in dict.fromkeys(ROLE_MODELS.values()):
+        served = [role for role, mid in ROLE_MODELS.items() if mid == model_id]
+        roles.update(manager.register(f"{model_id}:nf4", lambda mid=model_id: make_llm_quantized(mid, True), served))
+    set_manager(manager)
+    manager.load_pinned()
+    return roles
+
+
 def load_models():
     """Load all models (call this once at startup)"""
     global _MODELS_LOADED, WRITER_LLM, REVIEWER_LLM, COMPLIANCE_LLM, COORDINATOR_LLM
@@ -125,48 +210,266 @@ def load_models():
     if _MODELS_LOADED:
         return
     
-    print("🚀 Loading Specialized Models...")
-    print("\n📝 Writer Model (Zephyr-7B)...")
-    WRITER_LLM = make_llm_quantized("HuggingFaceH4/zephyr-7b-beta", use_4bit=True)
-    
-    print("\n🔍 Reviewer Model (Phi-2)...")
-    REVIEWER_LLM = make_llm_quantized("microsoft/phi-2", use_4bit=True)
+    load_start = time.time()
+    config = adapter_config()
+    residency = residency_config()
+    if config["base_model"]:
+        print("🚀 Loading Shared Base Model with Role Adapters...")
+        roles = make_llm_shared(config["base_model"], config["quantization"])
+        WRITER_LLM, REVIEWER_LLM = roles["writer"], roles["reviewer"]
+        COMPLIANCE_LLM, COORDINATOR_LLM = roles["compliance"], roles["coordinator"]
+    elif residency["enabled"]:
+        print(f"🚀 Loading Pinned Models ({', '.join(sorted(residency['pinned'])) or 'none'}); others on demand...")
+        roles = make_resident_llms(residency)
+        WRITER_LLM, REVIEWER_LLM = roles["writer"], roles["reviewer"]
+        COMPLIANCE_LLM, COORDINATOR_LLM = roles["compliance"], roles["coordinator"]
+    else:
+        print("🚀 Loading Specialized Models...")
+        print("\n📝 Writer Model (Zephyr-7B)...")
+        WRITER_LLM = make_llm_quantized("HuggingFaceH4/zephyr-7b-beta", use_4bit=True)
+        
+        print("\n🔍 Reviewer Model (Phi-2)...")
+        REVIEWER_LLM = make_llm_quantized("microsoft/phi-2", use_4bit=True)
+        
+        print("\n✅ Compliance Model (Zephyr-7B)...")
+        COMPLIANCE_LLM = make_llm_quantized("HuggingFaceH4/zephyr-7b-beta", use_4bit=True)
+        
+        print("\n🎯 Coordinator Model (Phi-2)...")
+        COORDINATOR_LLM = make_llm_quantized("microsoft/phi-2", use_4bit=True)
+    
+    print(f"\n⏱️  Models loaded in {time.time() - load_start:.1f}s")
+    
+    roles = {
+        "writer": WRITER_LLM,
+        "reviewer": REVIEWER_LLM,
+        "compliance": COMPLIANCE_LLM,
+        "coordinator": COORDINATOR_LLM,
+    }
+    if residency["enabled"] and not config["base_model"]:
+        # Only warm what is resident; the rest warms on first use
+        roles = {role: llm for role, llm in roles.items() if role in residency["pinned"]}
     
-    print("\n✅ Compliance Model (Zephyr-7B)...")
-    COMPLIANCE_LLM = make_llm_quantized("HuggingFaceH4/zephyr-7b-beta", use_4bit=True)
+    if structured_enabled():
+        # One pass over each vocabulary so the first JSON request doesn't pay for it
+        for role in ("writer", "reviewer", "compliance"):
+            if role in roles:
+                vocab_index(roles[role].pipeline.tokenizer)
     
-    print("\n🎯 Coordinator Model (Phi-2)...")
-    COORDINATOR_LLM = make_llm_quantized("microsoft/phi-2", use_4bit=True)
+    # Pay kernel init / allocator growth / compilation before we report ready
+    warmup_models(roles)
     
     print("\n✅ All Models Ready!\n")
     _MODELS_LOADED = True
 
 
-def chat(llm, system_prompt: str, user_prompt: str, max_input_tokens: int = 1500) -> str:
+class BudgetStoppingCriteria(StoppingCriteria):
+    """Stop decoding once the generated text reaches its structural budget"""
+
+    def __init__(self, tokenizer, budget: GenerationBudget):
+        self.tokenizer = tokenizer
+        self.budget = budget
+        self.prompt_len = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # First call happens after one new token, so the prompt is everything before it
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1] - 1
+        done = [
+            self.budget.reached(self.tokenizer.decode(row[self.prompt_len:], skip_special_tokens=True))
+            for row in input_ids
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancelStoppingCriteria(StoppingCriteria):
+    """Stop every sequence as soon as the request's cancel token fires (deadline or disconnect)"""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.token.cancelled, dtype=torch.bool, device=input_ids.device)
+
+
+def chat(llm, system_prompt: str, user_prompt: str, max_input_tokens: int = 1500,
+         budget: GenerationBudget = None, schema: dict = None) -> str:
     """Optimized LLM call with strict token limits"""
-    combined = f"{system_prompt}\n\n{user_prompt}"
-    tokenizer = llm.pipeline.tokenizer
+    return chat_batch(llm, system_prompt, [user_prompt], max_input_tokens, budget, schema=schema)[0]
+
+
+def chat_batch(llm, system_prompt: str, user_prompts: list, max_input_tokens: int = 1500,
+               budget: GenerationBudget = None, num_return_sequences: int = 1,
+               schema: dict = None) -> list:
+    """
+    Batched LLM call: one generate() over all prompts, optionally sampling
+    several sequences per prompt. Returns a flat list of
+    len(user_prompts) * num_return_sequences completions.
     
-    # Truncate input
-    tokens = tokenizer.encode(combined, max_length=max_input_tokens, truncation=True)
-    combined = tokenizer.decode(tokens, skip_special_tokens=True)
+    With a schema, decoding is constrained to that JSON object.
+    """
+    calls = [(llm, system_prompt, user_prompt) for user_prompt in user_prompts]
+    with resident(llm), profiled_call(call_label(llm, system_prompt), llm.pipeline.model) as timer:
+        return _generate_batch(llm.pipeline, calls, max_input_tokens, budget, num_return_sequences, schema, timer)
+
+
+def _generate_batch(pipe, calls, max_input_tokens, budget, num_return_sequences, schema, timer) -> list:
+    tokenizer = pipe.tokenizer
+    budget = budget or derive_budget("writer")
+    
+    # Fit each prompt to the input budget section by section (the instruction is never cut)
+    prompts = [fit_prompt(tokenizer, system_prompt, user_prompt, max_input_tokens)
+               for _, system_prompt, user_prompt in calls]
+    
+    # Traffic capture: record this call, or serve it from the capture when replaying
+    capture = current_session()
+    if capture is not None:
+        role = call_role(calls[0][1])
+        keys = [call_key(system_prompt, user_prompt, num_return_sequences)
+                for _, system_prompt, user_prompt in calls]
+        if capture.replaying:
+            return capture.serve(role, keys, len(prompts) * num_return_sequences)
+        started = time.perf_counter()
+    
+    # Shared base model: every row picks its role's LoRA adapter
+    extra = adapter_kwargs([adapter_of(llm) for llm, _, _ in calls], num_return_sequences)
+    processors = []
+    if schema is not None:
+        processors.append(json_logits_processor(tokenizer, schema, budget.max_new_tokens))
+    if timer is not None:
+        processors.append(timer)
+    if processors:
+        extra["logits_processor"] = LogitsProcessorList(processors)
+    stopping = [BudgetStoppingCriteria(tokenizer, budget)]
+    token = current_token()
+    if token is not None:
+        stopping.append(CancelStoppingCriteria(token))
     
     try:
-        output = llm.pipeline(
-            combined,
-            max_new_tokens=300,
-            do_sample=True,
-            top_p=0.9,
-            top_k=50,
-            temperature=0.7,
-        )
-        if isinstance(output, list) and "generated_text" in output[0]:
-            return output[0]["generated_text"].strip()
-        else:
-            return str(output).strip()
+        # KV_CACHE: preallocated static or quantized cache instead of the default dynamic one
+        with kv_cache(pipe.model, len(prompts) * num_return_sequences,
+                      max_input_tokens + budget.max_new_tokens) as cache_kwargs:
+            outputs = pipe(
+                prompts if len(prompts) > 1 else prompts[0],
+                batch_size=len(prompts),
+                num_return_sequences=num_return_sequences,
+                max_new_tokens=budget.max_new_tokens,
+                stopping_criteria=StoppingCriteriaList(stopping),
+                return_full_text=False,
+                do_sample=True,
+                top_p=0.9,
+                top_k=50,
+                temperature=0.7,
+                **extra,
+                **cache_kwargs,
+            )
+        if len(prompts) == 1:
+            outputs = [outputs]
+        results = []
+        for per_prompt in outputs:
+            for out in per_prompt:
+                if isinstance(out, dict) and "generated_text" in out:
+                    results.append(budget.clip(out["generated_text"].strip()))
+                else:
+                    results.append(str(out).strip())
     except Exception as e:
         print(f"⚠️  Error: {e}")
-        return "[Generation failed]"
+        results = ["[Generation failed]"] * (len(prompts) * num_return_sequences)
+    if capture is not None:
+        capture.record(role, keys, results, time.perf_counter() - started)
+    return results
+
+
+def label_margin(llm, system_prompt: str, user_prompt: str, labels=("APPROVED", "NEEDS"),
+                 max_input_tokens: int = 2000) -> float:
+    """
+    Score the first token of two competing labels with a single forward pass.
+    Returns a margin in [-1, 1]; positive favours labels[0].
+    """
+    capture = current_session()
+    if capture is not None:
+        keys = [call_key("margin", system_prompt, user_prompt, *labels)]
+        if capture.replaying:
+            return capture.serve("margin", keys, 1)[0]
+        started = time.perf_counter()
+    with resident(llm):
+        tokenizer = llm.pipeline.tokenizer
+        model = llm.pipeline.model
+        input_ids = tokenizer.encode(fit_prompt(tokenizer, system_prompt, user_prompt, max_input_tokens),
+                                     return_tensors="pt").to(model.device)
+        with torch.inference_mode():
+            # One forward pass: no KV cache to build
+            logits = model(input_ids, use_cache=False, **adapter_kwargs([adapter_of(llm)])).logits[0, -1]
+    probs = torch.softmax(logits.float(), dim=-1)
+    
+    scores = []
+    for label in labels:
+        first_ids = {tokenizer.encode(v, add_special_tokens=False)[0] for v in (label, " " + label)}
+        scores.append(float(probs[list(first_ids)].sum()))
+    total = sum(scores)
+    margin = (scores[0] - scores[1]) / total if total else 0.0
+    if capture is not None:
+        capture.record("margin", keys, [margin], time.perf_counter() - started)
+    return margin
+
+
+def cascade_chat(role: str, llm, system_prompt: str, user_prompt: str, max_input_tokens: int,
+                 budget: GenerationBudget, check, schema: dict = None) -> str:
+    """
+    In cascade mode try the small model (Phi-2) first and only call llm when
+    check(text) -> (ok, reason) rejects the small model's output.
+    """
+    if not cascade_enabled() or llm is REVIEWER_LLM:
+        return chat(llm, system_prompt, user_prompt, max_input_tokens=max_input_tokens, budget=budget,
+                    schema=schema)
+    
+    text = chat(REVIEWER_LLM, system_prompt, user_prompt, max_input_tokens=max_input_tokens, budget=budget,
+                schema=schema)
+    ok, reason = check(text)
+    CASCADE_STATS.record_call(role, not ok, reason)
+    if ok:
+        return text
+    return chat(llm, system_prompt, user_prompt, max_input_tokens=max_input_tokens, budget=budget,
+                schema=schema)
+
+
+def compliance_call(llm, text: str, img: str) -> str:
+    """One compliance generation, as schema-constrained JSON in structured mode"""
+    if structured_enabled():
+        prompt = compliance_prompt(text, img, json_instruction(DECISION_SCHEMA))
+        raw = chat(llm, COMPLIANCE_SYSTEM, prompt, max_input_tokens=2000,
+                   budget=schema_budget(DECISION_SCHEMA), schema=DECISION_SCHEMA)
+        STRUCTURED_STATS.record("decision", parse_structured(raw, DECISION_SCHEMA) is not None)
+        return raw
+    return chat(llm, COMPLIANCE_SYSTEM, compliance_prompt(text, img), max_input_tokens=2000,
+                budget=derive_budget("compliance"))
+
+
+def compliance_decision(text: str, img: str) -> str:
+    """
+    Raw compliance answer. In cascade mode Phi-2's label margin decides;
+    unclear or contradictory cases escalate to the compliance model.
+    """
+    if not cascade_enabled():
+        return compliance_call(COMPLIANCE_LLM, text, img)
+    
+    try:
+        margin = label_margin(REVIEWER_LLM, COMPLIANCE_SYSTEM, compliance_prompt(text, img))
+    except Exception as e:
+        print(f"⚠️  Label scoring failed: {e}")
+        margin = 0.0
+    ok, reason = check_margin(margin, routing_config()["min_margin"])
+    if ok and margin > 0:
+        CASCADE_STATS.record_call("compliance", False, reason)
+        return "APPROVED"
+    if ok:
+        # Clearly rejected: let the small model explain why
+        raw = compliance_call(REVIEWER_LLM, text, img)
+        if parse_compliance(raw)["compliance_status"] == "needs_changes":
+            CASCADE_STATS.record_call("compliance", False, reason)
+            return raw
+        reason = "disagreement"
+    CASCADE_STATS.record_call("compliance", True, reason)
+    return compliance_call(COMPLIANCE_LLM, text, img)
 
 
 # ========== SPECIALIZED AGENTS ========== #
@@ -179,57 +482,24 @@ def coordinator_agent(state: WorkflowState) -> dict:
         return {"iteration": 1, "revision_notes": ""}
     
     feedback = state.get("compliance_feedback", "")
-    prompt = f"Based on this compliance feedback, list 3 key changes needed:\n{feedback}\n\nChanges:"
-    revision_notes = chat(COORDINATOR_LLM, "You create concise revision lists.", prompt)
+    prompt = Prompt([
+        Section("intro", "Based on this compliance feedback, list 3 key changes needed:", fixed=True),
+        Section("feedback", feedback, max_tokens=200),
+        Section("task", "Changes:", label="\n", fixed=True),
+    ])
+    revision_notes = chat(COORDINATOR_LLM, "You create concise revision lists.", prompt,
+                          budget=derive_budget("coordinator"))
     
     return {
         "iteration": iteration + 1,
-        "revision_notes": revision_notes,
+        "revision_notes": intern_text(revision_notes),
     }
 
 
-def text_generator_agent(state: WorkflowState) -> dict:
-    """Generate text using Zephyr-7B (best writer)"""
-    sys = "You are an expert social media copywriter. Create engaging, creative, and compelling social media content."
-    
-    revisions = state.get('revision_notes', '')
-    prompt = f"""Create an Instagram post:
-Product: {state.get("user_instruction", "")}
-Tone: {state.get("tone", "")}
-Style: {state.get("style", "")}
-{f'Apply these revisions: {revisions}' if revisions else ''}
-
-Write the caption:"""
-    
-    draft = chat(WRITER_LLM, sys, prompt, max_input_tokens=2000)
-    return {"draft_text": draft}
-
-
-def reviewer_agent(state: WorkflowState) -> dict:
-    """Review and polish using Phi-2"""
-    sys = "You are an expert editor. Review and improve the text for grammar, clarity, and engagement. Output only the edited text."
-    prompt = f"Edit and improve this social media caption:\n\n{state.get('draft_text', '')}\n\nEdited version:"
-    
-    refined = chat(REVIEWER_LLM, sys, prompt, max_input_tokens=1800)
-    return {"reviewed_text": refined}
-
-
-def image_generator_agent(state: WorkflowState) -> dict:
-    """Generate image prompt using Zephyr-7B"""
-    sys = "You are an expert at creating detailed, vivid image prompts for AI image generation."
-    prompt = f"""Create a detailed image generation prompt for this social media post:
-
-{state.get('reviewed_text', '')}
-
-Image prompt:"""
-    
-    img_prompt = chat(WRITER_LLM, sys, prompt, max_input_tokens=1500)
-    return {"image_prompt": img_prompt}
-
-
-def compliance_agent(state: WorkflowState) -> dict:
-    """Compliance check using Zephyr-7B"""
-    sys = """You are a content compliance officer. Check content for:
+WRITER_SYSTEM = "You are an expert social media copywriter. Create engaging, creative, and compelling social media content."
+REVIEWER_SYSTEM = "You are an expert editor. Review and improve the text for grammar, clarity, and engagement. Output only the edited text."
+IMAGE_SYSTEM = "You are an expert at creating detailed, vivid image prompts for AI image generation."
+COMPLIANCE_SYSTEM = """You are a content compliance officer. Check content for:
 - Inappropriate language
 - False claims
 - Harmful content
@@ -238,21 +508,78 @@ def compliance_agent(state: WorkflowState) -> dict:
 Reply with either:
 - "APPROVED" if content is safe
 - "NEEDS_CHANGES: [specific reason]" if issues found"""
-    
-    text = state.get('reviewed_text', '')
-    img = state.get('image_prompt', '')
-    
-    prompt = f"""Review this content for compliance:
-
-TEXT:
-{text}
 
-IMAGE PROMPT:
-{img}
 
-Decision:"""
-    
-    raw = chat(COMPLIANCE_LLM, sys, prompt, max_input_tokens=2000)
+def call_role(system_prompt: str) -> str:
+    return {
+        WRITER_SYSTEM: "writer",
+        REVIEWER_SYSTEM: "reviewer",
+        IMAGE_SYSTEM: "image",
+        COMPLIANCE_SYSTEM: "compliance",
+    }.get(system_prompt, "chat")
+
+
+def call_label(llm, system_prompt: str) -> str:
+    """Role and model of a chat call, e.g. "writer.phi-2" or "writer.tiny+writer" (names profiling traces)"""
+    role = call_role(system_prompt)
+    model = str(getattr(llm.pipeline.model, "name_or_path", "") or "model").rstrip("/").split("/")[-1]
+    adapter = adapter_of(llm)
+    return f"{role}.{model}+{adapter}" if adapter and adapter != BASE_ADAPTER else f"{role}.{model}"
+
+
+# Prompts are built from sections so chat() can fit them to the input budget
+# without ever cutting the trailing instruction; lowest priority shrinks first
+
+def writer_prompt(state: WorkflowState, instruction: str = "Write the caption:") -> Prompt:
+    brief = (f'Product: {state.get("user_instruction", "")}\n'
+             f'Tone: {state.get("tone", "")}\n'
+             f'Style: {state.get("style", "")}')
+    return Prompt([
+        Section("brief", brief, label="Create an Instagram post:\n", priority=3, required=True),
+        Section("seed", state.get("seed_draft", ""), label="Adapt this approved caption from a similar brief: ",
+                max_tokens=160, priority=1),
+        Section("revisions", state.get("revision_notes", ""), label="Apply these revisions: ",
+                max_tokens=120, priority=2),
+        Section("task", instruction, label="\n", fixed=True),
+    ])
+
+
+def review_prompt(draft: str) -> Prompt:
+    return Prompt([
+        Section("intro", "Edit and improve this social media caption:", fixed=True),
+        Section("draft", draft, label="\n", max_tokens=400, priority=2, required=True),
+        Section("task", "Edited version:", label="\n", fixed=True),
+    ])
+
+
+def image_prompt_for(text: str) -> Prompt:
+    return Prompt([
+        Section("intro", "Create a detailed image generation prompt for this social media post:", fixed=True),
+        Section("post", text, label="\n", max_tokens=300, priority=2, required=True),
+        Section("task", "Image prompt:", label="\n", fixed=True),
+    ])
+
+
+def compliance_prompt(text: str, img: str, instruction: str = "Decision:") -> Prompt:
+    return Prompt([
+        Section("intro", "Review this content for compliance:", fixed=True),
+        Section("text", text, label="\nTEXT:\n", max_tokens=400, priority=3, required=True),
+        Section("image_prompt", img, label="\nIMAGE PROMPT:\n", max_tokens=150, priority=1),
+        Section("task", instruction, label="\n", fixed=True),
+    ])
+
+
+def parse_compliance(raw: str) -> dict:
+    """Map the compliance model's answer (JSON decision or free text) to status + feedback"""
+    data = parse_structured(raw, DECISION_SCHEMA) if raw.lstrip().startswith("{") else None
+    if data is not None:
+        if data["decision"] == "APPROVED":
+            return {"compliance_status": "approved", "compliance_feedback": "Content approved"}
+        reasons = "; ".join(r.strip() for r in data.get("reasons") or [] if r.strip())
+        return {
+            "compliance_status": "needs_changes",
+            "compliance_feedback": intern_text(reasons or "NEEDS_CHANGES")
+        }
     
     lower = raw.lower()
     if "approved" in lower and "needs" not in lower:
@@ -263,59 +590,269 @@ Decision:"""
     else:
         return {
             "compliance_status": "needs_changes",
-            "compliance_feedback": raw
+            "compliance_feedback": intern_text(raw)
         }
 
 
+def text_generator_agent(state: WorkflowState) -> dict:
+    """Generate text using Zephyr-7B (best writer), or Phi-2 first in cascade mode"""
+    budget = derive_budget("writer", state.get("style", ""))
+    config = routing_config()
+    
+    if structured_enabled():
+        # One call yields caption, hashtags and the image prompt
+        schema = caption_schema(budget)
+        
+        def check(raw):
+            data = parse_structured(raw, schema)
+            if data is None:
+                return False, "parse"
+            return check_caption(render_caption(data), budget, config["min_fit"], config["min_words"])
+        
+        raw = cascade_chat("writer", WRITER_LLM, WRITER_SYSTEM, writer_prompt(state, json_instruction(schema)),
+                           2000, schema_budget(schema), check, schema=schema)
+        data = parse_structured(raw, schema)
+        STRUCTURED_STATS.record("caption", data is not None)
+        if data is not None:
+            return {"draft_text": render_caption(data), "draft_image_prompt": data["image_prompt"].strip()}
+        # Truncated JSON: fall back to a plain caption
+    
+    draft = cascade_chat("writer", WRITER_LLM, WRITER_SYSTEM, writer_prompt(state), 2000, budget,
+                         lambda text: check_caption(text, budget, config["min_fit"], config["min_words"]))
+    return {"draft_text": draft, "draft_image_prompt": ""}
+
+
+FUSED_INSTRUCTION = ("First write a draft caption, then edit that draft for grammar, clarity and "
+                     "engagement; the edited version is the final caption.")
+
+
+def pipeline_mode() -> str:
+    """two_stage: Zephyr writes, Phi-2 reviews; fused: one Zephyr call drafts and self-edits"""
+    return os.getenv("PIPELINE_MODE", "two_stage").strip().lower()
+
+
+def fused_writer_agent(state: WorkflowState) -> dict:
+    """Draft, self-edit and image prompt in one constrained Zephyr-7B call; Phi-2 only as fallback"""
+    budget = derive_budget("writer", state.get("style", ""))
+    config = routing_config()
+    schema = fused_schema(budget)
+    
+    def check(raw):
+        data = parse_structured(raw, schema)
+        if data is None:
+            return False, "parse"
+        return check_caption(render_caption(data), budget, config["min_fit"], config["min_words"])
+    
+    prompt = writer_prompt(state, f"{FUSED_INSTRUCTION}\n{json_instruction(schema)}")
+    raw = cascade_chat("writer", WRITER_LLM, WRITER_SYSTEM, prompt, 2000, schema_budget(schema), check,
+                       schema=schema)
+    data = parse_structured(raw, schema)
+    STRUCTURED_STATS.record("fused", data is not None)
+    if data is None:
+        STRUCTURED_STATS.count("fused_two_stage_fallbacks")
+        drafted = text_generator_agent(state)
+        return {**drafted, **reviewer_agent({**state, **drafted})}
+    
+    draft = render_caption({**data, "caption": data["draft"]})
+    result = {
+        "draft_text": draft,
+        "reviewed_text": render_caption(data),
+        "draft_image_prompt": data["image_prompt"].strip(),
+    }
+    # An empty or degenerate self-edit gets a regular Phi-2 review of the draft
+    ok, _ = check_caption(result["reviewed_text"], budget, 0.0, config["min_words"])
+    if not ok:
+        STRUCTURED_STATS.count("fused_review_fallbacks")
+        result.update(reviewer_agent({**state, "draft_text": draft}))
+    return result
+
+
+def reviewer_agent(state: WorkflowState) -> dict:
+    """Review and polish using Phi-2"""
+    prompt = review_prompt(state.get('draft_text', ''))
+    
+    refined = chat(REVIEWER_LLM, REVIEWER_SYSTEM, prompt, max_input_tokens=1800,
+                   budget=derive_budget("reviewer", state.get("style", "")))
+    return {"reviewed_text": refined}
+
+
+def write_image_prompt(text: str) -> str:
+    """Image prompt for a caption using Zephyr-7B, or Phi-2 first in cascade mode"""
+    min_words = routing_config()["min_words"]
+    return cascade_chat("image", WRITER_LLM, IMAGE_SYSTEM, image_prompt_for(text), 1500, derive_budget("image"),
+                        lambda prompt: check_image_prompt(prompt, min_words))
+
+
+def image_generator_agent(state: WorkflowState) -> dict:
+    """Generate image prompt using Zephyr-7B, or Phi-2 first in cascade mode"""
+    # Structured writer already produced one alongside the caption
+    if state.get("draft_image_prompt"):
+        return {"image_prompt": state["draft_image_prompt"]}
+    
+    reviewed = state.get('reviewed_text', '')
+    if "speculative_image_prompt" in state:
+        # Speculative mode: keep the prompt written from the draft if the review barely changed it
+        return {"image_prompt": resolve_speculation(state, lambda: write_image_prompt(reviewed))}
+    return {"image_prompt": write_image_prompt(reviewed)}
+
+
+def speculative_image_agent(state: WorkflowState) -> dict:
+    """Image prompt from the draft, written while the reviewer polishes it"""
+    if state.get("draft_image_prompt"):
+        return {"speculative_image_prompt": "", "speculative_image_s": 0.0}
+    start = time.perf_counter()
+    prompt = write_image_prompt(state.get("draft_text", ""))
+    return {"speculative_image_prompt": prompt, "speculative_image_s": time.perf_counter() - start}
+
+
+def compliance_agent(state: WorkflowState) -> dict:
+    """Compliance check using Zephyr-7B (Phi-2 label margin first in cascade mode)"""
+    text = state.get('reviewed_text', '')
+    raw = compliance_decision(text, state.get('image_prompt', ''))
+    verdict = parse_compliance(raw)
+    if verdict["compliance_status"] == "approved":
+        return verdict
+    
+    # Decide now whether another revision round can still help
+    policy = resolve_policy(state.get("policy"), state.get("max_iterations"))
+    score = fit_score(text, derive_budget("writer", state.get("style", "")))
+    return {**verdict, **convergence_update(state, text, verdict["compliance_feedback"], score, policy, max_score=1.0)}
+
+
 # ========== GRAPH SETUP ========== #
 
 def should_continue(state: WorkflowState) -> Literal["coordinator", "end"]:
-    """Stop after approval or max iterations"""
+    """Stop after approval, the request's iteration budget, or once revisions have converged"""
     iteration = state.get("iteration", 0)
     status = state.get("compliance_status", "pending")
     
-    if status == "approved" or iteration >= 3:
+    if status == "approved" or iteration >= state.get("max_iterations", 3):
+        return "end"
+    if state.get("stop_reason") or request_cancelled():
         return "end"
     return "coordinator"
 
 
 # Build the workflow graph
-def build_workflow():
+def build_workflow(mode: str = "two_stage"):
     """Build and return the workflow graph"""
+    # Only the two-stage graph has a separate reviewer to overlap with
+    speculative = mode != "fused" and speculation_enabled()
     graph = StateGraph(WorkflowState)
     
     # Add nodes
     graph.add_node("coordinator", coordinator_agent)
-    graph.add_node("text_generator", text_generator_agent)
-    graph.add_node("reviewer", reviewer_agent)
+    if mode == "fused":
+        graph.add_node("writer_reviewer", fused_writer_agent)
+    else:
+        graph.add_node("text_generator", text_generator_agent)
+        graph.add_node("reviewer", timed_node(reviewer_agent, "review_s") if speculative else reviewer_agent)
+    if speculative:
+        graph.add_node("speculative_image", speculative_image_agent)
     graph.add_node("image_generator", image_generator_agent)
     graph.add_node("compliance", compliance_agent)
     
     # Flow
     graph.set_entry_point("coordinator")
-    graph.add_edge("coordinator", "text_generator")
-    graph.add_edge("text_generator", "reviewer")
-    graph.add_edge("reviewer", "image_generator")
+    if mode == "fused":
+        graph.add_edge("coordinator", "writer_reviewer")
+        graph.add_edge("writer_reviewer", "image_generator")
+    else:
+        graph.add_edge("coordinator", "text_generator")
+        graph.add_edge("text_generator", "reviewer")
+        if speculative:
+            # The image prompt is drafted in the same step as the review; image_generator joins both
+            graph.add_edge("text_generator", "speculative_image")
+            graph.add_edge(["reviewer", "speculative_image"], "image_generator")
+        else:
+            graph.add_edge("reviewer", "image_generator")
     graph.add_edge("image_generator", "compliance")
     graph.add_conditional_edges("compliance", should_continue, 
                                {"coordinator": "coordinator", "end": END})
     
-    memory = MemorySaver()
-    return graph.compile(checkpointer=memory)
+    # Compact checkpoints by default; STATE_CHECKPOINTS=full keeps every step
+    return graph.compile(checkpointer=make_checkpointer())
 
 
-# Global workflow instance
-_workflow = None
+# Global workflow instances, one per pipeline mode
+_workflows = {}
 
-def get_workflow():
+def get_workflow(mode: str = None):
     """Get or create the workflow"""
-    global _workflow
-    if _workflow is None:
-        _workflow = build_workflow()
-    return _workflow
+    mode = mode or pipeline_mode()
+    if mode not in _workflows:
+        _workflows[mode] = build_workflow(mode)
+    return _workflows[mode]
+
+
+def generate_variants(user_instruction: str, tone: str, style: str, num_variants: int) -> dict:
+    """
+    Produce num_variants ranked captions in a single pass.
+    
+    The writer samples all candidates in one generate() call, the reviewer
+    and compliance models each process them as one batch, and the image
+    prompt is only written for the top-ranked caption.
+    """
+    state: WorkflowState = {"user_instruction": user_instruction, "tone": tone, "style": style}
+    writer_budget = derive_budget("writer", style)
+    
+    drafts = chat_batch(WRITER_LLM, WRITER_SYSTEM, [writer_prompt(state)], max_input_tokens=2000,
+                        budget=writer_budget, num_return_sequences=num_variants)
+    # On cancellation, stop before the next stage and keep the last complete one
+    texts = drafts
+    if not request_cancelled():
+        reviewed = chat_batch(REVIEWER_LLM, REVIEWER_SYSTEM, [review_prompt(d) for d in drafts],
+                              max_input_tokens=1800, budget=derive_budget("reviewer", style))
+        if not request_cancelled():
+            # Fall back to the draft when the reviewer produced nothing usable
+            texts = [r if len(r.split()) >= 4 else d for r, d in zip(reviewed, drafts)]
+    decisions = None
+    if not request_cancelled():
+        decisions = chat_batch(COMPLIANCE_LLM, COMPLIANCE_SYSTEM, [compliance_prompt(t, "") for t in texts],
+                               max_input_tokens=2000, budget=derive_budget("compliance"))
+        if request_cancelled():
+            decisions = None
+    
+    variants = []
+    for i, text in enumerate(texts):
+        if decisions is None:
+            verdict = {"compliance_status": "pending", "compliance_feedback": ""}
+        else:
+            verdict = parse_compliance(decisions[i])
+        variants.append({"text": text, **verdict})
+    ranked = rank_variants(variants, writer_budget)
+    
+    best = ranked[0]
+    img_prompt = ""
+    if not request_cancelled():
+        img_prompt = chat(WRITER_LLM, IMAGE_SYSTEM, image_prompt_for(best["text"]), max_input_tokens=1500,
+                          budget=derive_budget("image"))
+        if request_cancelled():
+            img_prompt = ""
+    
+    return {
+        "reviewed_text": best["text"],
+        "image_prompt": img_prompt,
+        "compliance_status": best["compliance_status"],
+        "compliance_feedback": best["compliance_feedback"],
+        "iteration": 1,
+        "variants": [
+            {
+                "rank": v["rank"],
+                "text": v["text"],
+                "compliance_status": v["compliance_status"],
+                "compliance_feedback": v["compliance_feedback"],
+                "score": v["score"],
+            }
+            for v in ranked
+        ],
+    }
 
 
-def generate_content(user_instruction: str, tone: str, style: str) -> dict:
+def generate_content(user_instruction: str, tone: str, style: str, num_variants: int = 1,
+                     cancel_token: CancelToken = None, profile: bool = False,
+                     iteration_policy: str = None, max_iterations: int = None,
+                     preempt: Callable[[], bool] = None, resume: dict = None) -> dict:
     """
     Main function to generate social media content
     
@@ -323,36 +860,136 @@ def generate_content(user_instruction: str, tone: str, style: str) -> dict:
         user_instruction: Description of the product/campaign
         tone: Desired tone (e.g., "fun, friendly, eco-conscious")
         style: Desired style (e.g., "short caption with 3-4 hashtags")
+        num_variants: Number of ranked caption options to return (1 = classic loop)
+        cancel_token: Deadline / disconnect token; when it fires the best text so far is returned
+        profile: Capture a profile of this request (always on with PROFILE_INFERENCE)
+        iteration_policy: fast | balanced | thorough | fixed (default ITERATION_POLICY)
+        max_iterations: Overrides the policy's revision-round budget
+        preempt: Polled between agent steps; when it returns True the run stops early with
+            preempted=True and a resume handle (batch work yielding its slot)
+        resume: Resume handle of a preempted run; continues from its LangGraph checkpoint
     
     Returns:
-        dict with keys: reviewed_text, image_prompt, compliance_status, iteration, elapsed_time
+        dict with keys: reviewed_text, image_prompt, compliance_status, iteration, stop_reason,
+        elapsed_time (plus variants when num_variants > 1, partial/cancelled_reason when cut
+        short, and profile_id when profiled); or preempted=True and resume when preempted
     """
     # Ensure models are loaded
     if not _MODELS_LOADED:
         load_models()
     
-    initial_state: WorkflowState = {
-        "user_instruction": user_instruction,
-        "tone": tone,
-        "style": style,
-        "iteration": 0,
-    }
+    meta = {"user_instruction": user_instruction[:80], "style": style, "num_variants": num_variants}
+    with use_token(cancel_token), \
+            profile_session(profile or profiling_config()["enabled"], meta) as session:
+        result = _generate(user_instruction, tone, style, num_variants,
+                           resolve_policy(iteration_policy, max_iterations), preempt, resume)
+    if result.get("preempted"):
+        return result
+    if cancel_token is not None and cancel_token.cancelled:
+        result.update(partial=True, cancelled_reason=cancel_token.reason)
+    if session is not None:
+        result["profile_id"] = session.id
+    return result
+
+
+def _generate(user_instruction: str, tone: str, style: str, num_variants: int, policy,
+              preempt: Callable[[], bool] = None, resume: dict = None) -> dict:
+    if num_variants > 1:
+        # Batched stages without a graph checkpoint: variants always run to completion
+        start = time.time()
+        result = generate_variants(user_instruction, tone, style, num_variants)
+        elapsed = time.time() - start
+        REQUEST_LATENCY.record(elapsed)
+        return {**result, "elapsed_time": round(elapsed, 2)}
     
     start = time.time()
-    workflow = get_workflow()
-    
-    final_state = workflow.invoke(
-        initial_state,
-        config={"configurable": {"thread_id": f"thread-{int(time.time())}"}}
-    )
+    cache = get_semantic_cache()
+    brief = normalize_brief(user_instruction, tone, style)
+    if resume is not None:
+        # A preempted run continues from its checkpoint
+        start = resume["started_at"]
+        mode, thread_id = resume["mode"], resume["thread_id"]
+        stream_input, final_state = None, resume["state"]
+    else:
+        initial_state: WorkflowState = {
+            "user_instruction": user_instruction,
+            "tone": tone,
+            "style": style,
+            "iteration": 0,
+            "policy": policy.name,
+            "max_iterations": policy.max_iterations,
+        }
+        
+        # Near-duplicate briefs: serve the cached generation or start from it
+        if cache is not None:
+            entry, similarity = cache.lookup(brief)
+            if entry is not None and cache.mode == "serve":
+                elapsed = time.time() - start
+                REQUEST_LATENCY.record(elapsed)
+                return {
+                    **entry["result"],
+                    "elapsed_time": round(elapsed, 2),
+                    "semantic_cache": {"hit": True, "similarity": round(similarity, 4)},
+                }
+            if entry is not None:
+                initial_state["seed_draft"] = entry["result"]["reviewed_text"]
+        
+        mode, thread_id = pipeline_mode(), f"thread-{uuid.uuid4().hex}"
+        stream_input = final_state = initial_state
+    
+    workflow = get_workflow(mode)
+    config = {"configurable": {"thread_id": thread_id}}
+    
+    # Stream so a cancelled run can stop between nodes and keep the last complete state;
+    # the node that was running when the token fired may be truncated, so it is dropped.
+    # Preempted runs stop between nodes too, but keep their checkpoint for resume().
+    preempted = False
+    try:
+        if not request_cancelled():
+            # The first value is the state before any node ran in this slot
+            for step, state in enumerate(workflow.stream(stream_input, config=config, stream_mode="values")):
+                if request_cancelled():
+                    break
+                final_state = state
+                if preempt is not None and step > 0 and preempt():
+                    preempted = True
+                    break
+        preempted = preempted and bool(workflow.get_state(config).next)
+    finally:
+        if not preempted:
+            release_thread(workflow.checkpointer, thread_id)
+    
+    if preempted:
+        return {
+            "preempted": True,
+            "resume": {"mode": mode, "thread_id": thread_id, "state": final_state, "started_at": start},
+        }
     
     elapsed = time.time() - start
+    REQUEST_LATENCY.record(elapsed)
+    if cascade_enabled():
+        CASCADE_STATS.record_request(elapsed)
     
-    return {
-        "reviewed_text": final_state.get("reviewed_text", ""),
+    result = {
+        "reviewed_text": final_state.get("reviewed_text") or final_state.get("draft_text", ""),
         "image_prompt": final_state.get("image_prompt", ""),
         "compliance_status": final_state.get("compliance_status", "pending"),
         "compliance_feedback": final_state.get("compliance_feedback", ""),
         "iteration": final_state.get("iteration", 0),
-        "elapsed_time": round(elapsed, 2)
     }
+    if result["compliance_status"] == "approved":
+        stop_reason = "approved"
+    elif request_cancelled():
+        stop_reason = "cancelled"
+    else:
+        stop_reason = final_state.get("stop_reason") or "max_iterations"
+    CONVERGENCE_STATS.record(policy, result["iteration"], stop_reason)
+    if cache is not None and result["compliance_status"] == "approved" and not request_cancelled():
+        cache.add(brief, result)
+    
+    return {**result, "stop_reason": stop_reason, "elapsed_time": round(elapsed, 2)}
+
+
+def discard_resume(resume: dict):
+    """Free the checkpoint of a preempted run that will not be resumed"""
+    release_thread(get_workflow(resume["mode"]).checkpointer, resume["thread_id"])
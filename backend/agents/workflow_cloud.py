@@ -1,7 +1,10 @@
 # agents/workflow_cloud.py - Cloud-Based AI Agent Workflow System
 # Uses Hugging Face Inference API instead of local models
 
+import contextvars
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import TypedDict, Literal
 from langchain_core.messages import SystemMessage, HumanMessage
 from langgraph.graph import StateGraph, END
@@ -9,6 +12,16 @@ from langgraph.checkpoint.memory import MemorySaver
 from langchain_huggingface import HuggingFaceEndpoint
 import time
 
+from .budgets import GenerationBudget, derive_budget
+from .resilience import ResilientClient
+from .capture import call_key, current_session
+from .speculation import resolve_speculation, speculation_enabled, timed_node
+from .cancellation import CancelToken, RequestCancelled, current_token, request_cancelled, use_token
+from .variants import rank_variants
+from .semantic_cache import get_semantic_cache, normalize_brief
+from .structured import (DECISION_SCHEMA, STRUCTURED_STATS, caption_schema, json_instruction,
+                         parse_structured, render_caption, schema_budget, structured_enabled, to_json_schema)
+
 print("☁️ Cloud-Based AI System")
 print("Using Hugging Face Inference API")
 print()
@@ -26,9 +39,20 @@ class WorkflowState(TypedDict, total=False):
     compliance_status: Literal["pending", "approved", "needs_changes"]
     compliance_feedback: str
     revision_notes: str
+    seed_draft: str
+    draft_image_prompt: str
+    degraded: list
+    # Speculative image prompt written from the draft alongside the review
+    speculative_image_prompt: str
+    speculative_image_s: float
+    review_s: float
 
 # ========== CLOUD LLM SETUP ========== #
 
+# Use smaller, faster models for cloud inference
+WRITER_MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.2"    # Fast and good quality
+REVIEWER_MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.2"  # Same model for consistency
+
 def make_cloud_llm(model_id: str, hf_token: str = None):
     """Create LLM using Hugging Face Inference API (cloud-based)"""
     
@@ -43,20 +67,89 @@ def make_cloud_llm(model_id: str, hf_token: str = None):
             "and set HUGGINGFACE_API_TOKEN environment variable"
         )
     
-    print(f"☁️ Connecting to: {model_id}")
+    # Point at a dedicated/local TGI-compatible endpoint instead of the hub model
+    endpoint_url = os.getenv("HF_ENDPOINT_URL")
+    target = {"endpoint_url": endpoint_url} if endpoint_url else {"repo_id": model_id}
+    
+    print(f"☁️ Connecting to: {endpoint_url or model_id}")
     
     llm = HuggingFaceEndpoint(
-        repo_id=model_id,
+        **target,
         huggingfacehub_api_token=hf_token,
         max_new_tokens=400,
         temperature=0.7,
         top_p=0.9,
         repetition_penalty=1.1,
+        timeout=float(os.getenv("CLOUD_TIMEOUT_S", "30")),
     )
     
     print(f"✅ Connected to {model_id}")
     return llm
 
+
+def generate_with_budget(llm, prompt: str, budget: GenerationBudget, **params) -> str:
+    """Stream a completion and hang up as soon as the structural budget is reached"""
+    text = ""
+    token = current_token()
+    stream = llm.stream(prompt, max_new_tokens=budget.max_new_tokens, **params)
+    try:
+        for chunk in stream:
+            if token is not None and token.cancelled:
+                raise RequestCancelled(token.reason)
+            text += chunk if isinstance(chunk, str) else getattr(chunk, "content", str(chunk))
+            if budget.reached(text.lstrip()):
+                break
+    finally:
+        # Closing the stream drops the connection so the endpoint stops decoding
+        stream.close()
+    return budget.clip(text.strip())
+
+
+# Clients are shared across requests so the circuit breaker and latency
+# history reflect the endpoint, not a single request
+_CLIENTS = {}
+
+
+def get_client(role: str, model_id: str, hf_token: str = None) -> ResilientClient:
+    """Get or create the resilient client for an agent role"""
+    key = (role, model_id, hf_token)
+    if key not in _CLIENTS:
+        _CLIENTS[key] = ResilientClient(role, make_cloud_llm(model_id, hf_token))
+    return _CLIENTS[key]
+
+
+def complete(client: ResilientClient, prompt: str, budget: GenerationBudget, **params) -> str:
+    """Budgeted generation under the client's timeout/retry/hedge/breaker policy"""
+    capture = current_session()
+    if capture is None:
+        return client.call(lambda: generate_with_budget(client.llm, prompt, budget, **params))
+    # Traffic capture: record the call (failures too), or serve it from the capture when replaying
+    keys = [call_key(client.name, prompt, sorted(params.items()))]
+    if capture.replaying:
+        return capture.serve(client.name, keys, 1)[0]
+    started = time.perf_counter()
+    try:
+        text = client.call(lambda: generate_with_budget(client.llm, prompt, budget, **params))
+    except RequestCancelled:
+        raise
+    except Exception as e:
+        capture.record(client.name, keys, latency_s=time.perf_counter() - started, error=f"{type(e).__name__}: {e}")
+        raise
+    capture.record(client.name, keys, [text], time.perf_counter() - started)
+    return text
+
+
+def mark_degraded(state: WorkflowState, agent: str, error: Exception):
+    """Record that an agent served fallback output instead of a model response"""
+    state["degraded"] = state.get("degraded", []) + [
+        {"agent": agent, "reason": f"{type(error).__name__}: {error}"}
+    ]
+
+
+def resilience_stats() -> dict:
+    """Per-client call, retry, hedge and breaker counters"""
+    return {client.name: client.snapshot() for client in _CLIENTS.values()}
+
 # ========== AGENT FUNCTIONS ========== #
 
 def coordinator_agent(state: WorkflowState) -> WorkflowState:
@@ -79,45 +172,89 @@ def coordinator_agent(state: WorkflowState) -> WorkflowState:
     print("✅ Coordinator: Requirements understood")
     return state
 
-def text_generator_agent(state: WorkflowState, llm) -> WorkflowState:
-    """Generate social media content"""
-    print("✍️ Writer generating content...")
-    
-    try:
-        prompt = f"""Create engaging social media content based on this request:
+def writer_prompt(state: WorkflowState, instruction: str = "Social Media Post:") -> str:
+    return f"""Create engaging social media content based on this request:
 
 User Request: {state['user_instruction']}
 Tone: {state['tone']}
 Style: {state['style']}
 {state.get('revision_notes', '')}
+{f"Adapt this approved post from a similar request: {state['seed_draft']}" if state.get('seed_draft') else ''}
 
 Generate ONLY the social media post content. Be creative, engaging, and match the requested tone and style.
 
-Social Media Post:"""
+{instruction}"""
 
-        response = llm.invoke(prompt)
-        
-        # Extract text from response
-        if hasattr(response, 'content'):
-            draft = response.content
-        elif isinstance(response, str):
-            draft = response
+
+def review_prompt(state: WorkflowState, draft: str) -> str:
+    return f"""Review this social media content and improve it:
+
+Original Content:
+{draft}
+
+Requirements:
+- Tone: {state['tone']}
+- Style: {state['style']}
+
+Provide an improved version that better matches the tone and style. Be concise.
+
+Improved Content:"""
+
+
+def image_prompt_for(content: str) -> str:
+    return f"""Based on this social media content, create a brief image prompt for DALL-E or Stable Diffusion:
+
+Content:
+{content}
+
+Generate a concise image prompt (max 50 words):
+
+Image Prompt:"""
+
+
+def compliance_prompt(content: str,
+                      instruction: str = 'Respond with "APPROVED" or "NEEDS_CHANGES: [reason]"\n\nCompliance Check:') -> str:
+    return f"""Check if this social media content is appropriate and compliant:
+
+Content:
+{content}
+
+Is it:
+- Professional and appropriate?
+- Free from offensive language?
+- Suitable for public posting?
+
+{instruction}"""
+
+
+def text_generator_agent(state: WorkflowState, llm) -> WorkflowState:
+    """Generate social media content"""
+    print("✍️ Writer generating content...")
+    
+    try:
+        budget = derive_budget("writer", state["style"])
+        state["draft_image_prompt"] = ""
+        data = None
+        if structured_enabled():
+            # Endpoint-side grammar: caption, hashtags and image prompt in one call
+            schema = caption_schema(budget)
+            raw = complete(llm, writer_prompt(state, json_instruction(schema)), schema_budget(schema),
+                           grammar={"type": "json", "value": to_json_schema(schema)})
+            data = parse_structured(raw, schema)
+            STRUCTURED_STATS.record("caption", data is not None)
+        
+        if data is not None:
+            draft = render_caption(data)
+            state["draft_image_prompt"] = data["image_prompt"].strip()
         else:
-            draft = str(response)
-        
-        # Clean up the response
-        draft = draft.strip()
-        
-        # If response is too long, take first few lines
-        lines = draft.split('\n')
-        if len(lines) > 10:
-            draft = '\n'.join(lines[:10])
+            draft = complete(llm, writer_prompt(state), budget)
         
         state["draft_text"] = draft
         print(f"✅ Writer: Generated {len(draft)} characters")
         
     except Exception as e:
         print(f"⚠️ Writer error: {e}")
+        mark_degraded(state, "writer", e)
         # Fallback to simple generation
         state["draft_text"] = f"🌟 {state['user_instruction']}\n\nCreated with {state['tone']} tone in {state['style']} style."
     
@@ -128,30 +265,8 @@ def reviewer_agent(state: WorkflowState, llm) -> WorkflowState:
     print("🔍 Reviewer analyzing content...")
     
     try:
-        prompt = f"""Review this social media content and improve it:
-
-Original Content:
-{state['draft_text']}
-
-Requirements:
-- Tone: {state['tone']}
-- Style: {state['style']}
-
-Provide an improved version that better matches the tone and style. Be concise.
-
-Improved Content:"""
-
-        response = llm.invoke(prompt)
-        
-        # Extract text from response
-        if hasattr(response, 'content'):
-            reviewed = response.content
-        elif isinstance(response, str):
-            reviewed = response
-        else:
-            reviewed = str(response)
-        
-        reviewed = reviewed.strip()
+        prompt = review_prompt(state, state['draft_text'])
+        reviewed = complete(llm, prompt, derive_budget("reviewer", state["style"]))
         
         # Use reviewed version if it's reasonable, otherwise keep draft
         if len(reviewed) > 10 and len(reviewed) < 1000:
@@ -163,6 +278,7 @@ Improved Content:"""
         
     except Exception as e:
         print(f"⚠️ Reviewer error: {e}")
+        mark_degraded(state, "reviewer", e)
         # Fallback to original draft
         state["reviewed_text"] = state["draft_text"]
     
@@ -172,44 +288,46 @@ def image_generator_agent(state: WorkflowState, llm) -> WorkflowState:
     """Generate image prompt"""
     print("🎨 Image Agent creating prompt...")
     
+    if state.get("draft_image_prompt"):
+        state["image_prompt"] = state["draft_image_prompt"]
+        print("✅ Image Agent: Using the writer's prompt")
+        return state
+    
     try:
         content = state.get("reviewed_text", state.get("draft_text", ""))
         
-        prompt = f"""Based on this social media content, create a brief image prompt for DALL-E or Stable Diffusion:
-
-Content:
-{content}
-
-Generate a concise image prompt (max 50 words):
-
-Image Prompt:"""
-
-        response = llm.invoke(prompt)
+        def regenerate():
+            return complete(llm, image_prompt_for(content), derive_budget("image"))
         
-        # Extract text from response
-        if hasattr(response, 'content'):
-            image_prompt = response.content
-        elif isinstance(response, str):
-            image_prompt = response
+        # Speculative mode: keep the prompt written from the draft if the review barely changed it
+        if "speculative_image_prompt" in state:
+            image_prompt = resolve_speculation(state, regenerate)
         else:
-            image_prompt = str(response)
-        
-        image_prompt = image_prompt.strip()
-        
-        # Limit length
-        if len(image_prompt) > 200:
-            image_prompt = image_prompt[:200] + "..."
+            image_prompt = regenerate()
         
         state["image_prompt"] = image_prompt
         print(f"✅ Image Agent: Prompt created")
         
     except Exception as e:
         print(f"⚠️ Image Agent error: {e}")
+        mark_degraded(state, "image_generator", e)
         # Fallback prompt
         state["image_prompt"] = f"Professional image for: {state['user_instruction'][:50]}"
     
     return state
 
+def speculative_image_agent(state: WorkflowState, llm) -> dict:
+    """Image prompt from the draft, written while the reviewer runs (a failure only costs a miss)"""
+    if state.get("draft_image_prompt"):
+        return {"speculative_image_prompt": "", "speculative_image_s": 0.0}
+    start = time.perf_counter()
+    try:
+        prompt = complete(llm, image_prompt_for(state["draft_text"]), derive_budget("image"))
+    except Exception as e:
+        print(f"⚠️ Speculative image prompt failed: {e}")
+        prompt = ""
+    return {"speculative_image_prompt": prompt, "speculative_image_s": time.perf_counter() - start}
+
 def compliance_agent(state: WorkflowState, llm) -> WorkflowState:
     """Check content compliance"""
     print("✅ Compliance checking content...")
@@ -217,50 +335,150 @@ def compliance_agent(state: WorkflowState, llm) -> WorkflowState:
     try:
         content = state.get("reviewed_text", state.get("draft_text", ""))
         
-        prompt = f"""Check if this social media content is appropriate and compliant:
-
-Content:
-{content}
-
-Is it:
-- Professional and appropriate?
-- Free from offensive language?
-- Suitable for public posting?
-
-Respond with "APPROVED" or "NEEDS_CHANGES: [reason]"
-
-Compliance Check:"""
-
-        response = llm.invoke(prompt)
-        
-        # Extract text from response
-        if hasattr(response, 'content'):
-            result = response.content
-        elif isinstance(response, str):
-            result = response
+        if structured_enabled():
+            raw = complete(llm, compliance_prompt(content, json_instruction(DECISION_SCHEMA)),
+                           schema_budget(DECISION_SCHEMA),
+                           grammar={"type": "json", "value": to_json_schema(DECISION_SCHEMA)})
+            data = parse_structured(raw, DECISION_SCHEMA)
+            STRUCTURED_STATS.record("decision", data is not None)
         else:
-            result = str(response)
+            raw = complete(llm, compliance_prompt(content), derive_budget("compliance"))
+            data = None
         
-        result = result.strip().upper()
+        if data is not None:
+            approved = data["decision"] == "APPROVED"
+            reasons = "; ".join(r.strip() for r in data.get("reasons") or [] if r.strip())
+        else:
+            # Free text: only an explicit NEEDS_CHANGES blocks, anything unclear stays lenient for demo
+            result = raw.upper()
+            approved = "NEEDS_CHANGES" not in result
+            reasons = raw.split(":", 1)[1].strip() if ":" in raw else ""
         
-        # Parse compliance result
-        if "APPROVED" in result or "APPROPRIATE" in result or "SUITABLE" in result:
+        if approved:
             state["compliance_status"] = "approved"
             state["compliance_feedback"] = "Content approved for publication"
         else:
-            state["compliance_status"] = "approved"  # Be lenient for demo
-            state["compliance_feedback"] = "Content reviewed and approved"
+            state["compliance_status"] = "needs_changes"
+            state["compliance_feedback"] = reasons or "Content needs changes before publication"
         
         print(f"✅ Compliance: {state['compliance_status']}")
         
     except Exception as e:
         print(f"⚠️ Compliance error: {e}")
+        mark_degraded(state, "compliance", e)
         # Default to approved for demo
         state["compliance_status"] = "approved"
         state["compliance_feedback"] = "Content approved for publication"
     
     return state
 
+# ========== MULTI-VARIANT GENERATION ========== #
+
+_DECISION_RE = re.compile(r"^[ \t]*\[?(\d+)\]?[ \t]*[:.)-][ \t]*(APPROVED|NEEDS_CHANGES)[ \t]*:?[ \t]*(.*)$", re.IGNORECASE | re.MULTILINE)
+
+
+def batch_compliance(llm, texts: list) -> list:
+    """Check every candidate in one call; returns one (status, feedback) per text"""
+    numbered = "\n\n".join(f"[{i}]\n{t}" for i, t in enumerate(texts, start=1))
+    prompt = f"""Check if each numbered social media post is appropriate and compliant
+(professional, free from offensive language, suitable for public posting):
+
+{numbered}
+
+Answer with one line per post, e.g. "1: APPROVED" or "2: NEEDS_CHANGES: [reason]"
+
+Compliance Check:"""
+    budget = GenerationBudget(max_new_tokens=24 * len(texts), max_lines=len(texts))
+    raw = complete(llm, prompt, budget)
+    
+    verdicts = [("pending", "No decision returned")] * len(texts)
+    for match in _DECISION_RE.finditer(raw):
+        idx = int(match.group(1)) - 1
+        if 0 <= idx < len(texts):
+            if match.group(2).upper() == "APPROVED":
+                verdicts[idx] = ("approved", "Content approved for publication")
+            else:
+                verdicts[idx] = ("needs_changes", match.group(3).strip() or "Needs changes")
+    return verdicts
+
+
+def generate_variants(state: WorkflowState, num_variants: int, hf_token: str = None) -> dict:
+    """
+    Produce num_variants ranked captions in one pass.
+    
+    Writer and reviewer calls for all candidates run concurrently, and a
+    single compliance call scores the whole batch; the image prompt is only
+    written for the winner. That is 2N + 2 endpoint calls instead of 4N.
+    """
+    writer = get_client("writer", WRITER_MODEL_ID, hf_token)
+    reviewer = get_client("reviewer", REVIEWER_MODEL_ID, hf_token)
+    writer_budget = derive_budget("writer", state["style"])
+    reviewer_budget = derive_budget("reviewer", state["style"])
+    degraded = []
+    token = current_token()
+    
+    def write_and_review(seed: int) -> str:
+        try:
+            draft = complete(writer, writer_prompt(state), writer_budget, seed=seed)
+        except RequestCancelled:
+            return ""
+        except Exception as e:
+            degraded.append({"agent": "writer", "reason": f"{type(e).__name__}: {e}"})
+            return ""
+        try:
+            reviewed = complete(reviewer, review_prompt(state, draft), reviewer_budget)
+        except RequestCancelled:
+            return draft
+        except Exception as e:
+            degraded.append({"agent": "reviewer", "reason": f"{type(e).__name__}: {e}"})
+            return draft
+        return reviewed if 10 < len(reviewed) < 1000 else draft
+    
+    # Each worker runs in a copy of this context, so it sees the cancel token and capture session
+    with ThreadPoolExecutor(max_workers=num_variants) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, write_and_review, seed) for seed in range(num_variants)]
+        texts = [t for t in (f.result() for f in futures) if t]
+    if not texts and request_cancelled():
+        raise RequestCancelled(token.reason)
+    if not texts:
+        raise RuntimeError("All variant generations failed")
+    
+    # Once cancelled, skip the remaining calls and return what is ranked so far
+    verdicts = [("pending", "Skipped: request cancelled")] * len(texts)
+    if not request_cancelled():
+        try:
+            verdicts = batch_compliance(reviewer, texts)
+        except RequestCancelled:
+            pass
+        except Exception as e:
+            degraded.append({"agent": "compliance", "reason": f"{type(e).__name__}: {e}"})
+            verdicts = [("pending", "Compliance check unavailable")] * len(texts)
+    
+    ranked = rank_variants(
+        [{"text": t, "compliance_status": st, "compliance_feedback": fb} for t, (st, fb) in zip(texts, verdicts)],
+        writer_budget,
+    )
+    best = ranked[0]
+    
+    image_prompt = f"Professional image for: {state['user_instruction'][:50]}"
+    if not request_cancelled():
+        try:
+            image_prompt = complete(reviewer, image_prompt_for(best["text"]), derive_budget("image"))
+        except RequestCancelled:
+            pass
+        except Exception as e:
+            degraded.append({"agent": "image_generator", "reason": f"{type(e).__name__}: {e}"})
+    
+    return {
+        "reviewed_text": best["text"],
+        "image_prompt": image_prompt,
+        "compliance_status": best["compliance_status"],
+        "compliance_feedback": best["compliance_feedback"],
+        "iteration": 1,
+        "degraded": degraded,
+        "variants": ranked,
+    }
+
 # ========== WORKFLOW BUILDER ========== #
 
 def build_workflow(hf_token: str = None):
@@ -272,14 +490,8 @@ def build_workflow(hf_token: str = None):
     # Create cloud-based LLMs
     try:
         # Use smaller, faster models for cloud inference
-        writer_llm = make_cloud_llm(
-            "mistralai/Mistral-7B-Instruct-v0.2",  # Fast and good quality
-            hf_token
-        )
-        reviewer_llm = make_cloud_llm(
-            "mistralai/Mistral-7B-Instruct-v0.2",  # Same model for consistency
-            hf_token
-        )
+        writer_llm = get_client("writer", WRITER_MODEL_ID, hf_token)
+        reviewer_llm = get_client("reviewer", REVIEWER_MODEL_ID, hf_token)
         
         print("=" * 60)
         print("✅ All cloud models connected!")
@@ -295,7 +507,16 @@ def build_workflow(hf_token: str = None):
     # Add nodes with cloud LLMs
     workflow.add_node("coordinator", coordinator_agent)
     workflow.add_node("text_generator", lambda s: text_generator_agent(s, writer_llm))
-    workflow.add_node("reviewer", lambda s: reviewer_agent(s, reviewer_llm))
+    speculative = speculation_enabled()
+    if speculative:
+        # Parallel branches may only write their own keys, not the whole state
+        def review(s):
+            reviewed = reviewer_agent(dict(s), reviewer_llm)
+            return {"reviewed_text": reviewed["reviewed_text"], "degraded": reviewed.get("degraded", [])}
+        workflow.add_node("reviewer", timed_node(review, "review_s"))
+        workflow.add_node("speculative_image", lambda s: speculative_image_agent(s, reviewer_llm))
+    else:
+        workflow.add_node("reviewer", lambda s: reviewer_agent(s, reviewer_llm))
     workflow.add_node("image_generator", lambda s: image_generator_agent(s, reviewer_llm))
     workflow.add_node("compliance", lambda s: compliance_agent(s, reviewer_llm))
     
@@ -303,7 +524,12 @@ def build_workflow(hf_token: str = None):
     workflow.set_entry_point("coordinator")
     workflow.add_edge("coordinator", "text_generator")
     workflow.add_edge("text_generator", "reviewer")
-    workflow.add_edge("reviewer", "image_generator")
+    if speculative:
+        # The image prompt is drafted in the same step as the review; image_generator joins both
+        workflow.add_edge("text_generator", "speculative_image")
+        workflow.add_edge(["reviewer", "speculative_image"], "image_generator")
+    else:
+        workflow.add_edge("reviewer", "image_generator")
     workflow.add_edge("image_generator", "compliance")
     workflow.add_edge("compliance", END)
     
@@ -320,7 +546,9 @@ def generate_content(
     user_instruction: str,
     tone: str = "Professional",
     style: str = "Informative",
-    hf_token: str = None
+    hf_token: str = None,
+    num_variants: int = 1,
+    cancel_token: CancelToken = None
 ) -> dict:
     """
     Generate social media content using cloud-based AI agents
@@ -330,11 +558,20 @@ def generate_content(
         tone: Desired tone (e.g., "Professional", "Casual", "Fun")
         style: Content style (e.g., "Short caption", "Story format")
         hf_token: Hugging Face API token
+        num_variants: Number of ranked caption options to return (1 = single run)
+        cancel_token: Deadline / disconnect token; when it fires the best content so far is returned
     
     Returns:
-        dict with generated content and metadata
+        dict with generated content and metadata (metadata.partial when cut short)
     """
-    
+    with use_token(cancel_token):
+        response = _generate(user_instruction, tone, style, hf_token, num_variants)
+    if response.get("success") and cancel_token is not None and cancel_token.cancelled:
+        response["metadata"] = {**response["metadata"], "partial": True, "cancelled_reason": cancel_token.reason}
+    return response
+
+
+def _generate(user_instruction: str, tone: str, style: str, hf_token: str, num_variants: int) -> dict:
     print("\n" + "=" * 60)
     print("🚀 STARTING CLOUD-BASED CONTENT GENERATION")
     print("=" * 60)
@@ -346,9 +583,6 @@ def generate_content(
     start_time = time.time()
     
     try:
-        # Build workflow
-        app = build_workflow(hf_token)
-        
         # Create initial state
         initial_state = {
             "user_instruction": user_instruction,
@@ -356,11 +590,44 @@ def generate_content(
             "style": style,
         }
         
-        # Run workflow
-        print("\n🔄 Running multi-agent workflow...\n")
-        
-        config = {"configurable": {"thread_id": "content_gen_1"}}
-        result = app.invoke(initial_state, config)
+        # Near-duplicate briefs: serve the cached generation or start from it
+        cache = get_semantic_cache() if num_variants == 1 else None
+        brief = normalize_brief(user_instruction, tone, style)
+        if cache is not None:
+            entry, similarity = cache.lookup(brief)
+            if entry is not None and cache.mode == "serve":
+                print(f"🧠 Semantic cache hit (similarity {similarity:.3f})")
+                cached = entry["result"]
+                return {
+                    **cached,
+                    "metadata": {
+                        **cached["metadata"],
+                        "processing_time": f"{time.time() - start_time:.2f}s",
+                        "semantic_cache": {"hit": True, "similarity": round(similarity, 4)},
+                    },
+                }
+            if entry is not None:
+                initial_state["seed_draft"] = entry["result"]["content"]
+        
+        if num_variants > 1:
+            print(f"\n🔄 Generating {num_variants} ranked variants...\n")
+            result = generate_variants(initial_state, num_variants, hf_token)
+        else:
+            # Build workflow
+            app = build_workflow(hf_token)
+            
+            # Run workflow
+            print("\n🔄 Running multi-agent workflow...\n")
+            
+            config = {"configurable": {"thread_id": "content_gen_1"}}
+            # Stream so a cancelled run stops between agents with the last complete state;
+            # the agent running when the token fired may have fallen back, so it is dropped
+            result = initial_state
+            if not request_cancelled():
+                for state in app.stream(initial_state, config, stream_mode="values"):
+                    if request_cancelled():
+                        break
+                    result = state
         
         # Extract results
         final_content = result.get("reviewed_text", result.get("draft_text", ""))
@@ -377,7 +644,7 @@ def generate_content(
         print(f"📊 Status: {compliance}")
         print("=" * 60)
         
-        return {
+        response = {
             "success": True,
             "content": final_content,
             "image_prompt": image_prompt,
@@ -388,10 +655,22 @@ def generate_content(
                 "style": style,
                 "processing_time": f"{elapsed_time:.2f}s",
                 "model_type": "cloud",
-                "iterations": result.get("iteration", 1)
-            }
+                "iterations": result.get("iteration", 1),
+                "degraded": bool(result.get("degraded")),
+                "degraded_agents": result.get("degraded", [])
+            },
+            "variants": [
+                {k: v[k] for k in ("rank", "text", "compliance_status", "compliance_feedback", "score")}
+                for v in result.get("variants", [])
+            ] or None
         }
         
+        # Degraded (fallback) output must not be served to future look-alike briefs
+        if cache is not None and compliance == "approved" and not result.get("degraded") and not request_cancelled():
+            cache.add(brief, response)
+        
+        return response
+        
     except Exception as e:
         elapsed_time = time.time() - start_time
         error_msg = str(e)
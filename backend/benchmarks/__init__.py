@@ -0,0 +1 @@
+"""Offline benchmarks for the generation pipeline (run with python -m benchmarks.<name>)"""
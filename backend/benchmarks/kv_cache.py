@@ -0,0 +1,173 @@
+# benchmarks/kv_cache.py - Peak memory and tokens/s per KV-cache strategy versus batch size
+#
+# Generates a fixed number of tokens for every row of a batch with each
+# KV_CACHE strategy (dynamic, static, quantized) through the same
+# agents.kv_cache helper the local workflow uses, and reports the peak memory
+# added by generation and the decode throughput. Every (strategy, batch)
+# point runs in a fresh process so earlier runs cannot hide their peaks in
+# the allocator. By default the model is a small random Llama built from a
+# config (no download); --model takes a local checkpoint instead.
+#
+# Usage:
+#   python -m benchmarks.kv_cache
+#   python -m benchmarks.kv_cache --batch-sizes 1,8,32 --prompt-tokens 512 --new-tokens 256
+#   python -m benchmarks.kv_cache --model ./tiny-llama --strategies dynamic,static --json kv.json
+
+import argparse
+import gc
+import json
+import subprocess
+import sys
+import time
+
+
+def _model(args):
+    import torch
+    from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+    dtype = getattr(torch, args.dtype)
+    if args.model:
+        model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=dtype)
+    else:
+        torch.manual_seed(0)
+        config = LlamaConfig(hidden_size=args.hidden, intermediate_size=args.hidden * 8 // 3,
+                             num_hidden_layers=args.layers, num_attention_heads=args.hidden // 64,
+                             num_key_value_heads=args.hidden // 64, vocab_size=32000,
+                             max_position_embeddings=args.prompt_tokens + args.new_tokens + 512)
+        model = LlamaForCausalLM(config).to(dtype)
+    return model.to(args.device).eval()
+
+
+def _rss_mb(field: str) -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _reset_peak(device: str):
+    import torch
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        return torch.cuda.memory_allocated() / 2**20
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")  # resets VmHWM (peak RSS) to the current RSS
+    return _rss_mb("VmRSS:")
+
+
+def _peak(device: str) -> float:
+    import torch
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() / 2**20
+    return _rss_mb("VmHWM:")
+
+
+def worker(args) -> dict:
+    """One (strategy, batch) point; runs in its own process"""
+    import torch
+    from agents.kv_cache import KV_CACHE_POOL, KV_CACHE_STATS, kv_cache, kv_cache_config
+
+    model = _model(args)
+    config = {**kv_cache_config(), "strategy": args.strategy}
+
+    def run(batch: int, new_tokens: int):
+        ids = torch.randint(3, model.config.vocab_size, (batch, args.prompt_tokens), device=args.device)
+        with kv_cache(model, batch, args.prompt_tokens + new_tokens, config) as cache_kwargs:
+            with torch.inference_mode():
+                # min_new_tokens: every row decodes the full length whatever the random model emits
+                model.generate(ids, attention_mask=torch.ones_like(ids), max_new_tokens=new_tokens,
+                               min_new_tokens=new_tokens, do_sample=False, pad_token_id=0, **cache_kwargs)
+
+    run(1, 4)  # warm-up: kernels and lazy imports outside the measurement
+    # The warm-up's static cache may have the measured shape: free it so the
+    # measured calls allocate their own and it shows in peak and cache MB
+    KV_CACHE_POOL.drop(model)
+    gc.collect()
+    if args.device == "cuda":
+        torch.cuda.empty_cache()
+    before = _reset_peak(args.device)
+    cache_before = KV_CACHE_STATS.live_bytes
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        run(args.batch, args.new_tokens)
+    elapsed = time.perf_counter() - start
+    fallbacks = [k for k in KV_CACHE_STATS.counts if k.startswith("fallback_")]
+    return {
+        "strategy": args.strategy,
+        "batch": args.batch,
+        "peak_mb": round(max(0.0, _peak(args.device) - before), 1),
+        "tokens_per_s": round(args.batch * args.new_tokens * args.repeats / elapsed, 1),
+        # Preallocated static cache held for this batch (allocated once, reused across calls)
+        "cache_mb": round((KV_CACHE_STATS.peak_bytes - cache_before) / 2**20, 1) if args.strategy == "static" else None,
+        "static_allocations": KV_CACHE_STATS.counts["static_allocations"],
+        "note": f"fell back to dynamic ({fallbacks[0][len('fallback_'):]})" if fallbacks else "",
+    }
+
+
+def run_point(args, strategy: str, batch: int) -> dict:
+    cmd = [sys.executable, "-m", "benchmarks.kv_cache", "--worker", "--strategy", strategy, "--batch", str(batch)]
+    for name in ("model", "device", "dtype", "hidden", "layers", "prompt_tokens", "new_tokens", "repeats"):
+        value = getattr(args, name)
+        if value is not None:
+            cmd += [f"--{name.replace('_', '-')}", str(value)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        error = (proc.stderr.strip().splitlines() or ["failed"])[-1]
+        return {"strategy": strategy, "batch": batch, "peak_mb": None, "tokens_per_s": None, "note": error[:60]}
+    return json.loads(lines[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KV-cache strategy benchmark: peak memory and tokens/s vs batch size")
+    parser.add_argument("--strategies", default="dynamic,static,quantized")
+    parser.add_argument("--batch-sizes", default="1,4,16")
+    parser.add_argument("--prompt-tokens", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=2, help="generate() calls per point (static reuses its cache)")
+    parser.add_argument("--model", help="local checkpoint (default: random Llama from --hidden/--layers)")
+    parser.add_argument("--hidden", type=int, default=512)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--device", choices=["cpu", "cuda"], default="cpu")
+    parser.add_argument("--dtype", default=None, help="default float32 on cpu, float16 on cuda")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--strategy", help=argparse.SUPPRESS)
+    parser.add_argument("--batch", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.dtype = args.dtype or ("float16" if args.device == "cuda" else "float32")
+
+    if args.worker:
+        print(json.dumps(worker(args)))
+        return
+    from agents.kv_cache import STRATEGIES
+    strategies = [s.strip() for s in args.strategies.split(",")]
+    unknown = [s for s in strategies if s not in STRATEGIES]
+    if unknown:
+        parser.error(f"unknown strategies {unknown}; choose from {', '.join(STRATEGIES)}")
+
+    print(f"📏 prompt {args.prompt_tokens} + {args.new_tokens} new tokens, {args.repeats} calls per point, "
+          f"{args.device}/{args.dtype}, model {args.model or f'random llama {args.hidden}x{args.layers}'}")
+    print(f"{'batch':>6} {'strategy':<10} {'peak MB':>9} {'cache MB':>9} {'tok/s':>9}  note")
+    results = []
+    for batch in (int(b) for b in args.batch_sizes.split(",")):
+        for strategy in strategies:
+            r = run_point(args, strategy, batch)
+            results.append(r)
+            peak = f"{r['peak_mb']:>9.1f}" if r["peak_mb"] is not None else f"{'-':>9}"
+            cache = f"{r['cache_mb']:>9.1f}" if r.get("cache_mb") is not None else f"{'-':>9}"
+            rate = f"{r['tokens_per_s']:>9.1f}" if r["tokens_per_s"] is not None else f"{'-':>9}"
+            print(f"{batch:>6} {strategy:<10} {peak} {cache} {rate}  {r['note']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Wrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/state_memory.py - Retained memory per request for workflow checkpoints
+#
+# Runs the real local LangGraph workflow with the model calls stubbed out and
+# measures, with tracemalloc, how many bytes stay allocated per completed
+# request under each checkpoint mode.
+#
+# Usage:
+#   python -m benchmarks.state_memory --requests 10000
+#   python -m benchmarks.state_memory --requests 2000 --modes compact
+
+import argparse
+import gc
+import os
+import random
+import time
+import tracemalloc
+
+CAPTION = (
+    "Stay hydrated, stay wavy! 🌊 Our {product} keeps drinks ice-cold for 24 hours, "
+    "from sunrise surf sessions to late beach bonfires.\n\n#EcoWave #Hydrate #GoGreen"
+)
+IMAGE = "Bright flat-lay photo of a {product} on a striped beach towel, golden hour, vibrant colors"
+FEEDBACK = "NEEDS_CHANGES: The claim about 24 hours of cooling needs a qualifier such as 'up to'."
+REVISIONS = "1. Say 'up to 24 hours'\n2. Keep the emoji\n3. Keep 3 hashtags"
+
+
+def _stub_chat(rng: random.Random, reject_rate: float):
+    """Stand-in for workflow.chat that returns realistic text without a model"""
+    def chat(llm, system_prompt, user_prompt, max_input_tokens=1500, budget=None, schema=None):
+        product = "reusable bottle #%d" % rng.randint(0, 999)
+        if system_prompt.startswith("You are a content compliance officer"):
+            return FEEDBACK if rng.random() < reject_rate else "APPROVED"
+        if system_prompt.startswith("You create concise revision lists"):
+            return REVISIONS
+        if "image prompt" in user_prompt.lower():
+            return IMAGE.format(product=product)
+        return CAPTION.format(product=product)
+    return chat
+
+
+def run(mode: str, requests: int, max_checkpoints: int, reject_rate: float, seed: int) -> dict:
+    os.environ["STATE_CHECKPOINTS"] = mode
+    os.environ["STATE_MAX_CHECKPOINTS"] = str(max_checkpoints)
+    from agents import workflow
+
+    workflow.chat = _stub_chat(random.Random(seed), reject_rate)
+    workflow._MODELS_LOADED = True
+    workflow._workflows.clear()
+    workflow.get_semantic_cache = lambda: None
+
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    graph = workflow.get_workflow()
+
+    iterations = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        result = workflow.generate_content(f"Reusable water bottle, batch {i}", "fun, eco-conscious",
+                                           "short caption with 3 hashtags")
+        iterations += result["iteration"]
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    saver = graph.checkpointer
+    checkpoints = sum(len(c) for ns in saver.storage.values() for c in ns.values())
+    return {
+        "mode": mode,
+        "requests": requests,
+        "avg_iterations": iterations / requests,
+        "bytes_per_request": (current - baseline) / requests,
+        "peak_mb": peak / 1e6,
+        "retained_checkpoints": checkpoints,
+        "retained_blobs": len(saver.blobs),
+        "requests_per_s": requests / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Workflow checkpoint memory benchmark")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--modes", default="full,compact")
+    parser.add_argument("--max-checkpoints", type=int, default=4)
+    parser.add_argument("--reject-rate", type=float, default=0.4,
+                        help="fraction of compliance checks that ask for a revision")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"📏 {args.requests} requests per mode, reject rate {args.reject_rate}")
+    print(f"{'mode':<8} {'iters':>6} {'bytes/req':>11} {'peak MB':>9} {'ckpts':>8} {'blobs':>8} {'req/s':>8}")
+    for mode in args.modes.split(","):
+        r = run(mode.strip(), args.requests, args.max_checkpoints, args.reject_rate, args.seed)
+        print(f"{r['mode']:<8} {r['avg_iterations']:>6.2f} {r['bytes_per_request']:>11,.0f} "
+              f"{r['peak_mb']:>9.1f} {r['retained_checkpoints']:>8} {r['retained_blobs']:>8} "
+              f"{r['requests_per_s']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,40 @@
 # main.py - FastAPI Backend for AI Social Media Generator
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional
-import uvicorn
+from typing import List, Literal, Optional
+import asyncio
+import json
 import logging
+import math
+import os
+import secrets
+import time
 from datetime import datetime
+from dotenv import load_dotenv
+
+# Load environment variables (MODEL_CACHE_DIR, WARMUP_*, ...)
+load_dotenv()
 
 # Import our AI workflow
-from agents.workflow import generate_content, load_models
+from agents.workflow import discard_resume, generate_content, load_models
+from agents.coalescing import SingleFlight, normalize_key
+from agents.cancellation import FlightTokens, default_deadline_s, watch_disconnect
+from agents.semantic_cache import semantic_cache_stats
+from agents.structured import structured_stats
+from agents.speculation import speculation_stats
+from agents.kv_cache import kv_cache_stats
+from agents.capture import capture_request, capture_stats, finish as finish_capture
+from agents.history import get_history, history_stats, ingest_ndjson, record_generation, valid_cursor
+from agents.routing import routing_stats
+from agents.context import context_stats
+from agents.convergence import convergence_stats
+from agents.adapters import adapter_stats
+from agents.residency import residency_stats
+from agents.profiling import list_profiles, profile_file, profiling_requested, profiling_stats
+from agents.scheduling import FairScheduler, RateLimitExceeded, scheduling_config
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -33,6 +58,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Identical in-flight generations share one workflow run
+generation_flight = SingleFlight()
+# Coalesced clients share one cancel token (latest deadline wins)
+flight_tokens = FlightTokens()
+
+# Per-tenant token buckets + weighted fair queue in front of the local models
+scheduler = FairScheduler(scheduling_config(default_concurrency=1))
+
 # ========== REQUEST/RESPONSE MODELS ========== #
 
 class ContentRequest(BaseModel):
@@ -52,6 +85,38 @@ class ContentRequest(BaseModel):
         description="Content style and format",
         example="short caption with 3-4 hashtags"
     )
+    num_variants: int = Field(
+        1,
+        ge=1,
+        le=5,
+        description="Number of ranked caption options to generate in one pass",
+        example=3
+    )
+    deadline_s: Optional[float] = Field(
+        None,
+        gt=0,
+        le=600,
+        description="Return the best result so far after this many seconds (default: REQUEST_DEADLINE_S)",
+        example=20
+    )
+    iteration_policy: Optional[Literal["fast", "balanced", "thorough", "fixed"]] = Field(
+        None,
+        description="Revision-round budget and early-exit policy (default: ITERATION_POLICY)",
+        example="balanced"
+    )
+    max_iterations: Optional[int] = Field(
+        None,
+        ge=1,
+        le=5,
+        description="Override the policy's maximum number of revision rounds",
+        example=3
+    )
+    priority: Optional[Literal["interactive", "batch"]] = Field(
+        None,
+        description="Scheduling lane; batch work yields to interactive requests between agent steps "
+                    "(BATCH_TENANTS always run as batch; others may opt down to batch)",
+        example="interactive"
+    )
 
     class Config:
         schema_extra = {
@@ -73,6 +138,11 @@ class ContentResponse(BaseModel):
     iteration: int
     elapsed_time: float
     generated_at: str
+    variants: Optional[List[dict]] = None
+    partial: bool = False
+    cancelled_reason: Optional[str] = None
+    profile_id: Optional[str] = None
+    stop_reason: Optional[str] = None
 
 
 class HealthResponse(BaseModel):
@@ -127,7 +197,7 @@ async def health_check():
 
 
 @app.post("/api/generate", response_model=ContentResponse)
-async def generate_social_content(request: ContentRequest):
+async def generate_social_content(request: ContentRequest, http_request: Request):
     """
     Generate AI-powered social media content
     
@@ -141,15 +211,87 @@ async def generate_social_content(request: ContentRequest):
     
     Returns generated caption, image prompt, and compliance status.
     """
+    tenant = scheduler.resolve_tenant(
+        http_request.headers.get("X-API-Key"),
+        http_request.client.host if http_request.client else None
+    )
+    try:
+        scheduler.check_rate(tenant)
+    except RateLimitExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail={
+                "success": False,
+                "error": "Rate limit exceeded",
+                "details": f"Retry in {e.retry_after:.1f}s"
+            },
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+    
+    started = time.monotonic()
+    priority = scheduler.resolve_priority(request.priority, tenant)
     try:
         logger.info(f"📝 Generating content for: {request.user_instruction[:50]}...")
         
-        # Call the AI workflow
-        result = generate_content(
-            user_instruction=request.user_instruction,
-            tone=request.tone,
-            style=request.style
-        )
+        # Call the AI workflow (off the event loop, deduplicated by request key)
+        # Profiled requests never share a run with unprofiled ones, nor interactive with batch
+        profile = profiling_requested(http_request.headers.get("X-Profile") if is_admin(http_request) else None)
+        key = normalize_key(request.user_instruction, request.tone, request.style, request.num_variants,
+                            request.iteration_policy, request.max_iterations, "profile" if profile else None,
+                            priority)
+        token = flight_tokens.join(key, request.deadline_s or default_deadline_s())
+        
+        async def run_generation():
+            resume = None
+            with capture_request("local", request.model_dump(), started) as capture:
+                try:
+                    # Batch runs hand their slot back between agent steps while interactive
+                    # requests wait, then queue again and resume from their checkpoint
+                    while True:
+                        async with scheduler.slot(tenant, priority):
+                            result = await asyncio.to_thread(
+                                generate_content,
+                                user_instruction=request.user_instruction,
+                                tone=request.tone,
+                                style=request.style,
+                                num_variants=request.num_variants,
+                                cancel_token=token,
+                                profile=profile,
+                                iteration_policy=request.iteration_policy,
+                                max_iterations=request.max_iterations,
+                                preempt=scheduler.preempt_check(priority),
+                                resume=resume
+                            )
+                        resume = result.get("resume")
+                        if resume is None:
+                            break
+                        scheduler.record_preemption(tenant, priority)
+                finally:
+                    if resume is not None:
+                        discard_resume(resume)
+                    flight_tokens.release(key, token)
+                finish_capture(capture, result)
+            record_generation("local", request.model_dump(), result)
+            return result
+        
+        # Stop generating for clients that hang up
+        watcher = asyncio.create_task(watch_disconnect(http_request, token))
+        try:
+            result = await generation_flight.run(key, run_generation)
+        finally:
+            watcher.cancel()
+        scheduler.record_latency(tenant, time.monotonic() - started, priority)
+        
+        if result.get("partial") and not result["reviewed_text"]:
+            logger.warning(f"⏱️ Generation cancelled before any content: {result['cancelled_reason']}")
+            raise HTTPException(
+                status_code=504,
+                detail={
+                    "success": False,
+                    "error": "Request cancelled before any content was generated",
+                    "details": result["cancelled_reason"]
+                }
+            )
         
         logger.info(f"✅ Content generated successfully in {result['elapsed_time']}s")
         
@@ -161,9 +303,16 @@ async def generate_social_content(request: ContentRequest):
             "compliance_feedback": result["compliance_feedback"],
             "iteration": result["iteration"],
             "elapsed_time": result["elapsed_time"],
-            "generated_at": datetime.now().isoformat()
+            "generated_at": datetime.now().isoformat(),
+            "variants": result.get("variants"),
+            "partial": result.get("partial", False),
+            "cancelled_reason": result.get("cancelled_reason"),
+            "profile_id": result.get("profile_id"),
+            "stop_reason": result.get("stop_reason")
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error generating content: {str(e)}")
         raise HTTPException(
@@ -180,39 +329,149 @@ async def generate_social_content(request: ContentRequest):
 async def models_status():
     """Check if AI models are loaded"""
     from agents.workflow import _MODELS_LOADED
+    from agents.warmup import WARMUP_STATUS, warmup_report
+    from agents.model_cache import load_timings_report
+    if _MODELS_LOADED:
+        status = "ready"
+    elif WARMUP_STATUS["state"] == "warming":
+        status = "warming"
+    else:
+        status = "loading"
     return {
         "models_loaded": _MODELS_LOADED,
-        "status": "ready" if _MODELS_LOADED else "loading",
+        "status": status,
+        **warmup_report(),
+        "model_loads": load_timings_report(),
         "timestamp": datetime.now().isoformat()
     }
 
 
+@app.get("/api/metrics")
+async def metrics():
+    """Runtime counters for the generation endpoint"""
+    return {
+        "coalescing": generation_flight.stats(),
+        "semantic_cache": semantic_cache_stats(),
+        "scheduler": scheduler.snapshot(),
+        "structured": structured_stats(),
+        "history": history_stats(),
+        "routing": routing_stats(),
+        "profiling": profiling_stats(),
+        "context": context_stats(),
+        "convergence": convergence_stats(),
+        "adapters": adapter_stats(),
+        "residency": residency_stats(),
+        "capture": capture_stats(),
+        "speculation": speculation_stats(),
+        "kv_cache": kv_cache_stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+@app.get("/api/history/export")
+async def export_history(http_request: Request, cursor: Optional[str] = None,
+                         limit: Optional[int] = Query(None, ge=1)):
+    """
+    Stream the generation log as NDJSON, oldest first. Every line carries a
+    "cursor"; pass the last one back to continue where the page ended.
+    Admin only: the log holds every client's prompts and outputs.
+    """
+    require_admin(http_request)
+    log = get_history()
+    if log is None:
+        raise HTTPException(status_code=404, detail={"success": False, "error": "Generation history is disabled"})
+    if not valid_cursor(cursor):
+        raise HTTPException(status_code=400, detail={"success": False, "error": "Invalid cursor"})
+    
+    def lines():
+        for next_cursor, record in log.iter_records(cursor, limit):
+            yield json.dumps({**record, "cursor": next_cursor}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/api/history/import")
+async def import_history(http_request: Request, append: bool = False):
+    """
+    Bulk-ingest exported NDJSON history to rebuild the semantic cache
+    (an empty body replays this server's own log). append=true also adds
+    the records to the log. Admin only: imported records are served from the
+    semantic cache without another compliance check.
+    """
+    require_admin(http_request)
+    counts = await ingest_ndjson(http_request.stream(), source="local", append=append)
+    logger.info(f"📥 History import: {counts}")
+    return {"success": True, **counts}
+
+
+# ========== ADMIN ========== #
+
+def is_admin(http_request: Request) -> bool:
+    """X-Admin-Key matches ADMIN_API_KEY; nobody is admin while it is unset"""
+    admin_key = os.getenv("ADMIN_API_KEY")
+    return bool(admin_key) and secrets.compare_digest(http_request.headers.get("X-Admin-Key", ""), admin_key)
+
+
+def require_admin(http_request: Request):
+    if not is_admin(http_request):
+        raise HTTPException(status_code=403, detail={"success": False, "error": "Admin key required"})
+
+
+@app.get("/api/admin/profiles")
+async def profiles(http_request: Request):
+    """Captured profiling sessions, newest first"""
+    require_admin(http_request)
+    return {"profiles": await asyncio.to_thread(list_profiles)}
+
+
+@app.get("/api/admin/profiles/{profile_id}/{filename}")
+async def profile_download(profile_id: str, filename: str, http_request: Request):
+    """
+    One file of a session: summary.json, stacks.folded (flamegraph.pl /
+    speedscope) or NNN-<call>.trace.json (chrome://tracing / Perfetto)
+    """
+    require_admin(http_request)
+    path = profile_file(profile_id, filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail={"success": False, "error": "Profile file not found"})
+    return FileResponse(path)
+
+
 # ========== ERROR HANDLERS ========== #
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     """Handle HTTP exceptions"""
-    return {
-        "success": False,
-        "error": exc.detail,
-        "status_code": exc.status_code
-    }
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={
+            "success": False,
+            "error": exc.detail,
+            "status_code": exc.status_code
+        },
+        headers=exc.headers
+    )
 
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
     """Handle general exceptions"""
     logger.error(f"Unhandled exception: {str(exc)}")
-    return {
-        "success": False,
-        "error": "Internal server error",
-        "details": str(exc)
-    }
+    return JSONResponse(
+        status_code=500,
+        content={
+            "success": False,
+            "error": "Internal server error",
+            "details": str(exc)
+        }
+    )
 
 
 # ========== MAIN ========== #
 
 if __name__ == "__main__":
+    import uvicorn
+    
     print("=" * 60)
     print("🚀 AI SOCIAL MEDIA CONTENT GENERATOR API")
     print("=" * 60)
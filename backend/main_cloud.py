@@ -4,19 +4,33 @@ Uses Hugging Face Inference API instead of local models
 Perfect for MacBooks with limited RAM/storage
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Literal, Optional
+import asyncio
+import json
 import logging
+import math
 import os
+import secrets
+import time
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
 # Import cloud-based workflow
-from agents.workflow_cloud import generate_content
+from agents.workflow_cloud import generate_content, resilience_stats
+from agents.coalescing import SingleFlight, normalize_key
+from agents.cancellation import FlightTokens, default_deadline_s, watch_disconnect
+from agents.semantic_cache import semantic_cache_stats
+from agents.structured import structured_stats
+from agents.speculation import speculation_stats
+from agents.capture import capture_request, capture_stats, finish as finish_capture
+from agents.history import get_history, history_stats, ingest_ndjson, record_generation, valid_cursor
+from agents.scheduling import FairScheduler, RateLimitExceeded, scheduling_config
 
 # Setup logging
 logging.basicConfig(
@@ -41,6 +55,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Identical in-flight generations share one workflow run
+generation_flight = SingleFlight()
+# Coalesced clients share one cancel token (latest deadline wins)
+flight_tokens = FlightTokens()
+
+# Per-tenant token buckets + weighted fair queue in front of the cloud endpoint
+scheduler = FairScheduler(scheduling_config(default_concurrency=4))
+
 # ========== REQUEST/RESPONSE MODELS ========== #
 
 class ContentRequest(BaseModel):
@@ -56,6 +78,25 @@ class ContentRequest(BaseModel):
         default="Short caption with hashtags",
         json_schema_extra={"example": "Short caption with 3-4 hashtags"}
     )
+    num_variants: int = Field(
+        default=1,
+        ge=1,
+        le=5,
+        json_schema_extra={"example": 3}
+    )
+    # Return the best result so far after this many seconds (default: REQUEST_DEADLINE_S)
+    deadline_s: Optional[float] = Field(
+        default=None,
+        gt=0,
+        le=600,
+        json_schema_extra={"example": 20}
+    )
+    # Scheduling lane: interactive requests are dispatched before batch ones
+    # (BATCH_TENANTS always run as batch; others may opt down to batch)
+    priority: Optional[Literal["interactive", "batch"]] = Field(
+        default=None,
+        json_schema_extra={"example": "interactive"}
+    )
 
     class Config:
         json_schema_extra = {
@@ -73,6 +114,7 @@ class ContentResponse(BaseModel):
     compliance_status: Optional[str] = None
     compliance_feedback: Optional[str] = None
     metadata: Optional[dict] = None
+    variants: Optional[List[dict]] = None
     error: Optional[str] = None
 
 class HealthResponse(BaseModel):
@@ -133,7 +175,7 @@ async def models_status():
     }
 
 @app.post("/api/generate", response_model=ContentResponse)
-async def generate_content_api(request: ContentRequest):
+async def generate_content_api(request: ContentRequest, http_request: Request):
     """
     Generate social media content using cloud-based AI agents
     
@@ -141,6 +183,21 @@ async def generate_content_api(request: ContentRequest):
     - **tone**: Desired tone (Professional, Casual, Fun, etc.)
     - **style**: Content style (Short caption, Story, etc.)
     """
+    tenant = scheduler.resolve_tenant(
+        http_request.headers.get("X-API-Key"),
+        http_request.client.host if http_request.client else None
+    )
+    try:
+        scheduler.check_rate(tenant)
+    except RateLimitExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded, retry in {e.retry_after:.1f}s",
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+    
+    started = time.monotonic()
+    priority = scheduler.resolve_priority(request.priority, tenant)
     try:
         logger.info(f"🚀 Generating content: {request.user_instruction[:50]}...")
         
@@ -152,14 +209,44 @@ async def generate_content_api(request: ContentRequest):
                 detail="Hugging Face API token not configured. Get free token from https://huggingface.co/settings/tokens"
             )
         
-        # Generate content using cloud models
-        result = generate_content(
-            user_instruction=request.user_instruction,
-            tone=request.tone,
-            style=request.style,
-            hf_token=hf_token
-        )
+        # Generate content using cloud models (off the event loop, deduplicated by request key)
+        key = normalize_key(request.user_instruction, request.tone, request.style, request.num_variants, priority)
+        token = flight_tokens.join(key, request.deadline_s or default_deadline_s())
         
+        async def run_generation():
+            with capture_request("cloud", request.model_dump(), started) as capture:
+                try:
+                    async with scheduler.slot(tenant, priority):
+                        result = await asyncio.to_thread(
+                            generate_content,
+                            user_instruction=request.user_instruction,
+                            tone=request.tone,
+                            style=request.style,
+                            hf_token=hf_token,
+                            num_variants=request.num_variants,
+                            cancel_token=token
+                        )
+                finally:
+                    flight_tokens.release(key, token)
+                finish_capture(capture, result)
+            if result.get("success"):
+                record_generation("cloud", request.model_dump(), result)
+            return result
+        
+        # Stop generating for clients that hang up
+        watcher = asyncio.create_task(watch_disconnect(http_request, token))
+        try:
+            result = await generation_flight.run(key, run_generation)
+        finally:
+            watcher.cancel()
+        scheduler.record_latency(tenant, time.monotonic() - started, priority)
+        
+        if token.cancelled and not result.get("content"):
+            logger.warning(f"⏱️ Generation cancelled before any content: {token.reason}")
+            raise HTTPException(
+                status_code=504,
+                detail=f"Request cancelled ({token.reason}) before any content was generated"
+            )
         if result.get("success"):
             logger.info("✅ Content generated successfully")
             return ContentResponse(**result)
@@ -179,22 +266,92 @@ async def generate_content_api(request: ContentRequest):
             detail=f"Internal server error: {str(e)}"
         )
 
+@app.get("/api/metrics")
+async def metrics():
+    """Runtime counters for the generation endpoint"""
+    return {
+        "coalescing": generation_flight.stats(),
+        "semantic_cache": semantic_cache_stats(),
+        "scheduler": scheduler.snapshot(),
+        "structured": structured_stats(),
+        "history": history_stats(),
+        "resilience": resilience_stats(),
+        "capture": capture_stats(),
+        "speculation": speculation_stats()
+    }
+
+@app.get("/api/history/export")
+async def export_history(http_request: Request, cursor: Optional[str] = None,
+                         limit: Optional[int] = Query(None, ge=1)):
+    """
+    Stream the generation log as NDJSON, oldest first. Every line carries a
+    "cursor"; pass the last one back to continue where the page ended.
+    Admin only: the log holds every client's prompts and outputs.
+    """
+    require_admin(http_request)
+    log = get_history()
+    if log is None:
+        raise HTTPException(status_code=404, detail="Generation history is disabled")
+    if not valid_cursor(cursor):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    def lines():
+        for next_cursor, record in log.iter_records(cursor, limit):
+            yield json.dumps({**record, "cursor": next_cursor}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/api/history/import")
+async def import_history(http_request: Request, append: bool = False):
+    """
+    Bulk-ingest exported NDJSON history to rebuild the semantic cache
+    (an empty body replays this server's own log). append=true also adds
+    the records to the log. Admin only: imported records are served from the
+    semantic cache without another compliance check.
+    """
+    require_admin(http_request)
+    counts = await ingest_ndjson(http_request.stream(), source="cloud", append=append)
+    logger.info(f"📥 History import: {counts}")
+    return {"success": True, **counts}
+
+
+# ========== ADMIN ========== #
+
+def is_admin(http_request: Request) -> bool:
+    """X-Admin-Key matches ADMIN_API_KEY; nobody is admin while it is unset"""
+    admin_key = os.getenv("ADMIN_API_KEY")
+    return bool(admin_key) and secrets.compare_digest(http_request.headers.get("X-Admin-Key", ""), admin_key)
+
+
+def require_admin(http_request: Request):
+    if not is_admin(http_request):
+        raise HTTPException(status_code=403, detail="Admin key required")
+
+
 # ========== ERROR HANDLERS ========== #
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
-    return {
-        "detail": exc.detail,
-        "status_code": exc.status_code
-    }
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={
+            "detail": exc.detail,
+            "status_code": exc.status_code
+        },
+        headers=exc.headers
+    )
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
     logger.error(f"Unhandled exception: {str(exc)}", exc_info=True)
-    return {
-        "detail": "Internal server error",
-        "error": str(exc)
-    }
+    return JSONResponse(
+        status_code=500,
+        content={
+            "detail": "Internal server error",
+            "error": str(exc)
+        }
+    )
 
 # ========== STARTUP ========== #
 
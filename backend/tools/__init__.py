@@ -0,0 +1 @@
+"""Developer tools (mock servers, probes, load tests)"""
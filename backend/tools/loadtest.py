@@ -0,0 +1,458 @@
+# tools/loadtest.py - HTTP load and soak test for main.py / main_cloud.py
+#
+# Usage (from backend/):
+#   python -m tools.loadtest --target cloud --pattern constant --rate 5 --duration 60
+#   python -m tools.loadtest --target local --pattern ramp --rate 1 --peak-rate 20 --duration 120
+#   python -m tools.loadtest --target local --pattern burst --rate 1 --burst-size 30 --burst-every 20 \
+#       --duration 3600 --json soak.json          # soak: watch the RSS slope
+#
+# The app runs in this process: local with stub LLMs (a fixed per-call latency,
+# or --model for a small real checkpoint), cloud against the mock inference
+# server. Requests go over a real socket through uvicorn (--transport http) or
+# straight into the ASGI app (--transport asgi, no uvicorn needed). Reports
+# latency percentiles and status codes per window, event-loop lag measured
+# inside the server's loop, and RSS over time with a leak estimate.
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import re
+import resource
+import socket
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+BRIEFS = [
+    ("Eco-friendly reusable water bottle", "fun, friendly, eco-conscious", "short caption with 3-4 hashtags"),
+    ("Launch of a budget fitness tracker", "energetic, motivational", "2 lines with 2 hashtags"),
+    ("Weekend discount at a family bakery", "warm, cozy", "short caption with 3 hashtags"),
+    ("New noise-cancelling headphones", "sleek, premium", "under 40 words with 2 hashtags"),
+    ("Community beach clean-up event", "inspiring, upbeat", "short caption with 4 hashtags"),
+]
+
+# Requests that must be rejected by validation (exercise the error handlers)
+MALFORMED = [
+    {"tone": "fun", "style": "short"},                                           # missing user_instruction
+    {"user_instruction": "x", "tone": "fun", "style": "short", "num_variants": 99},
+    {"user_instruction": "x", "tone": "fun", "style": "short", "deadline_s": -1},
+]
+
+
+# ========== STUB MODELS (local target) ========== #
+
+class StubTokenizer:
+    """Word-level tokenizer with just what chat() and prompt fitting use"""
+
+    eos_token_id = None
+
+    def __init__(self):
+        self._ids = {}
+        self._words = []
+        self._lock = threading.Lock()
+
+    def encode(self, text, add_special_tokens=True, **kwargs):
+        ids = []
+        for piece in re.findall(r"\S+|\s+", text):
+            with self._lock:
+                if piece not in self._ids:
+                    self._ids[piece] = len(self._words)
+                    self._words.append(piece)
+            ids.append(self._ids[piece])
+        return ids
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(self._words[i] for i in ids)
+
+    def num_special_tokens_to_add(self, pair=False):
+        return 0
+
+
+class StubPipeline:
+    """Stands in for a transformers text-generation pipeline: sleeps, then answers like the mock server"""
+
+    model = None
+
+    def __init__(self, latency_s: float, reject_rate: float):
+        self.tokenizer = StubTokenizer()
+        self.latency_s = latency_s
+        self.reject_rate = reject_rate
+
+    def _answer(self, prompt: str) -> str:
+        from tools.mock_inference_server import _completion_for
+        if "compliance" in prompt.lower() and random.random() < self.reject_rate:
+            return "NEEDS_CHANGES: The tone is too salesy."
+        return _completion_for(prompt)
+
+    def __call__(self, inputs, num_return_sequences=1, **kwargs):
+        time.sleep(self.latency_s * random.uniform(0.8, 1.2))
+        prompts = inputs if isinstance(inputs, list) else [inputs]
+        outputs = [[{"generated_text": self._answer(p)} for _ in range(num_return_sequences)] for p in prompts]
+        return outputs if isinstance(inputs, list) else outputs[0]
+
+
+class StubLLM:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+
+def install_local_models(args):
+    from agents import workflow
+    if args.model:
+        from benchmarks.fused_vs_two_stage import _local_llm
+        writer, small = _local_llm(args.model), _local_llm(args.model)
+    else:
+        writer = StubLLM(StubPipeline(args.stub_latency_ms / 1000, args.reject_rate))
+        small = StubLLM(StubPipeline(args.stub_latency_ms / 2000, args.reject_rate))
+    workflow.WRITER_LLM = workflow.COMPLIANCE_LLM = writer
+    workflow.REVIEWER_LLM = workflow.COORDINATOR_LLM = small
+    workflow._MODELS_LOADED = True
+
+
+def load_app(args):
+    """Import the target app with load-test friendly defaults (explicit env settings win)"""
+    os.environ.setdefault("RATE_LIMIT_RPS", "100000")
+    os.environ.setdefault("RATE_LIMIT_BURST", "100000")
+    # Only allow-listed API keys count as tenants
+    os.environ.setdefault("TENANT_API_KEYS", ",".join(f"loadtest-{i}" for i in range(args.tenants)))
+    os.environ.setdefault("SEMANTIC_CACHE_ENABLED", "false")
+    os.environ.setdefault("HISTORY_ENABLED", "false")
+    os.environ.setdefault("ROUTING_MODE", "direct")
+    os.environ.setdefault("OUTPUT_MODE", "text")
+    if args.target == "cloud":
+        from tools.mock_inference_server import FaultConfig, start_server
+        server, mock = start_server(faults=FaultConfig(fail_rate=args.fail_rate, token_delay_s=args.token_delay_ms / 1000))
+        os.environ["HF_ENDPOINT_URL"] = f"http://127.0.0.1:{server.server_port}"
+        os.environ.setdefault("HUGGINGFACE_API_TOKEN", "mock")
+        import main_cloud
+        return main_cloud.app, mock
+    install_local_models(args)
+    import main
+    return main.app, None
+
+
+# ========== ARRIVALS ========== #
+
+def arrivals(args):
+    """Send times in seconds from the start of the run"""
+    rng = random.Random(args.seed)
+
+    def gap(rate):
+        return rng.expovariate(rate) if args.poisson else 1.0 / rate
+
+    times = []
+    t = 0.0
+    while True:
+        rate = args.rate
+        if args.pattern == "ramp":
+            rate = args.rate + (args.peak_rate - args.rate) * t / args.duration
+        t += gap(max(rate, 1e-6))
+        if t >= args.duration:
+            break
+        times.append(t)
+    if args.pattern == "burst":
+        burst_at = args.burst_every
+        while burst_at < args.duration:
+            times.extend([burst_at] * args.burst_size)
+            burst_at += args.burst_every
+    return sorted(times)
+
+
+# ========== MEASUREMENT ========== #
+
+def rss_mb() -> float:
+    """Current RSS (peak RSS where /proc is unavailable)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def pct(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def slope_per_min(points):
+    """Least-squares slope of (seconds, value) points, per minute"""
+    if len(points) < 3:
+        return None
+    xs, ys = zip(*points)
+    mx, my = statistics.mean(xs), statistics.mean(ys)
+    var = sum((x - mx) ** 2 for x in xs)
+    return 60 * sum((x - mx) * (y - my) for x, y in points) / var if var else None
+
+
+class LoopLag:
+    """Runs inside the server's event loop: how late a short sleep wakes up is time the loop was blocked"""
+
+    def __init__(self, interval_s: float = 0.05):
+        self.interval_s = interval_s
+        self.samples = []
+        self._lock = threading.Lock()
+
+    async def probe(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(self.interval_s)
+            with self._lock:
+                self.samples.append(max(0.0, loop.time() - before - self.interval_s))
+
+    def drain(self):
+        with self._lock:
+            samples, self.samples = self.samples, []
+        return samples
+
+    def install(self, app):
+        async def start():
+            app.state.loop_lag_task = asyncio.create_task(self.probe())
+        app.router.on_startup.append(start)
+
+
+class Recorder:
+    def __init__(self):
+        self.results = []   # (finished_at, kind, status, latency_s)
+        self.window = []
+        self.in_flight = 0
+        self.shed = 0
+
+    def add(self, finished_at, kind, status, latency):
+        entry = (finished_at, kind, status, latency)
+        self.results.append(entry)
+        self.window.append(entry)
+
+
+# ========== DRIVER ========== #
+
+async def one_request(client, index, args, recorder, started):
+    kind = "malformed" if random.random() < args.bad_rate else "generate"
+    if kind == "malformed":
+        body = random.choice(MALFORMED)
+    else:
+        instruction, tone, style = BRIEFS[index % len(BRIEFS)]
+        if not args.repeat_briefs:
+            instruction = f"{instruction} (campaign #{index})"  # defeat coalescing and caches
+        body = {"user_instruction": instruction, "tone": tone, "style": style}
+        if args.num_variants > 1:
+            body["num_variants"] = args.num_variants
+    headers = {"X-API-Key": f"loadtest-{index % args.tenants}"}
+    recorder.in_flight += 1
+    t0 = time.perf_counter()
+    try:
+        response = await client.post("/api/generate", json=body, headers=headers, timeout=args.timeout)
+        status = str(response.status_code)
+    except Exception as e:
+        status = type(e).__name__
+    finally:
+        recorder.in_flight -= 1
+    recorder.add(time.perf_counter() - started, kind, status, time.perf_counter() - t0)
+
+
+def window_line(t, recorder, lag, rss):
+    window, recorder.window = recorder.window, []
+    ok = [lat for _, kind, status, lat in window if kind == "generate" and status == "200"]
+    errors = sum(1 for _, kind, status, _ in window if kind == "generate" and status != "200")
+    lag_max = max(lag) if lag else 0.0
+    p50, p95 = pct(ok, 0.5), pct(ok, 0.95)
+    return (f"t={t:7.1f}s done={len(window):5d} in_flight={recorder.in_flight:4d} "
+            f"p50={(p50 or 0):6.3f}s p95={(p95 or 0):6.3f}s errors={errors:4d} "
+            f"loop_lag_max={lag_max * 1000:7.1f}ms rss={rss:8.1f}MB")
+
+
+async def drive(app, args):
+    import httpx
+
+    lag = LoopLag()
+    lag.install(app)
+    server = None
+    if args.transport == "http":
+        import uvicorn
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            await asyncio.sleep(0.05)
+        client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}",
+                                   limits=httpx.Limits(max_connections=args.max_in_flight))
+        lifespan = None
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest")
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+
+    schedule = arrivals(args)
+    print(f"🚦 {args.target} via {args.transport}: {len(schedule)} requests over {args.duration:.0f}s "
+          f"({args.pattern}{', poisson' if args.poisson else ''})")
+    recorder = Recorder()
+    rss_points, lag_all, timeline = [], [], []
+    tasks = set()
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    start = loop.time()
+    next_report = args.report_every
+    tracemalloc_base = None
+
+    async def report_until_done():
+        nonlocal next_report, tracemalloc_base
+        while True:
+            await asyncio.sleep(min(args.rss_interval, args.report_every))
+            t = time.perf_counter() - started
+            rss = rss_mb()
+            rss_points.append((t, rss))
+            if tracemalloc_base is None and args.tracemalloc and t >= args.warmup:
+                tracemalloc_base = tracemalloc.take_snapshot()
+            if t >= next_report:
+                samples = lag.drain()
+                lag_all.extend(samples)
+                line = window_line(t, recorder, samples, rss)
+                timeline.append({"t": round(t, 1), "rss_mb": round(rss, 1), "in_flight": recorder.in_flight,
+                                 "loop_lag_max_ms": round(max(samples, default=0) * 1000, 1)})
+                print(line)
+                next_report += args.report_every
+
+    reporter = asyncio.create_task(report_until_done())
+    for index, offset in enumerate(schedule):
+        delay = start + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if recorder.in_flight >= args.max_in_flight:
+            recorder.shed += 1  # open loop: don't let a stalled server throttle the arrival rate
+            continue
+        task = asyncio.create_task(one_request(client, index, args, recorder, started))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks, timeout=args.timeout + 5)
+    reporter.cancel()
+    lag_all.extend(lag.drain())
+
+    metrics = {}
+    try:
+        metrics = (await client.get("/api/metrics", timeout=10)).json()
+    except Exception as e:
+        metrics = {"error": f"{type(e).__name__}: {e}"}
+    await client.aclose()
+    if lifespan is not None:
+        await lifespan.__aexit__(None, None, None)
+    if server is not None:
+        server.should_exit = True
+
+    return summarize(args, recorder, rss_points, lag_all, timeline, metrics, tracemalloc_base,
+                     time.perf_counter() - started)
+
+
+def summarize(args, recorder, rss_points, lag_all, timeline, metrics, tracemalloc_base, elapsed):
+    generate = [r for r in recorder.results if r[1] == "generate"]
+    ok = [lat for _, _, status, lat in generate if status == "200"]
+    statuses = {kind: dict(Counter(status for _, k, status, _ in recorder.results if k == kind))
+                for kind in ("generate", "malformed")}
+    soak = [(t, v) for t, v in rss_points if t >= args.warmup]
+    # Live checkpointers: one per in-flight cloud request is fine, a growing count is a leak
+    checkpointers = sum(1 for o in gc.get_objects() if type(o).__name__.endswith("MemorySaver"))
+    summary = {
+        "target": args.target,
+        "transport": args.transport,
+        "pattern": args.pattern,
+        "elapsed_s": round(elapsed, 1),
+        "sent": len(recorder.results),
+        "shed_client_side": recorder.shed,
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else None,
+        "error_rate": round(1 - len(ok) / len(generate), 4) if generate else None,
+        "status": statuses,
+        "latency_s": {f"p{int(q * 100)}": round(pct(ok, q), 4) if ok else None for q in (0.5, 0.9, 0.95, 0.99)},
+        "loop_lag_ms": {
+            "p99": round(pct(lag_all, 0.99) * 1000, 1) if lag_all else None,
+            "max": round(max(lag_all) * 1000, 1) if lag_all else None,
+        },
+        "rss_mb": {
+            "start": round(rss_points[0][1], 1) if rss_points else None,
+            "end": round(rss_points[-1][1], 1) if rss_points else None,
+            "max": round(max(v for _, v in rss_points), 1) if rss_points else None,
+            "slope_mb_per_min_after_warmup": round(s, 3) if (s := slope_per_min(soak)) is not None else None,
+        },
+        "live_checkpointers": checkpointers,
+        "app_metrics": metrics,
+        "timeline": timeline,
+    }
+    if tracemalloc_base is not None:
+        growth = tracemalloc.take_snapshot().compare_to(tracemalloc_base, "lineno")[:10]
+        summary["tracemalloc_top_growth"] = [str(stat) for stat in growth]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load / soak test for the generation API")
+    parser.add_argument("--target", choices=["local", "cloud"], default="cloud")
+    parser.add_argument("--transport", choices=["http", "asgi"], default="http",
+                        help="http = uvicorn on a local port, asgi = in-process (no uvicorn)")
+    parser.add_argument("--pattern", choices=["constant", "ramp", "burst"], default="constant")
+    parser.add_argument("--rate", type=float, default=2.0, help="requests/s (start rate for ramp, base rate for burst)")
+    parser.add_argument("--peak-rate", type=float, default=10.0, help="ramp: rate reached at the end")
+    parser.add_argument("--burst-size", type=int, default=20)
+    parser.add_argument("--burst-every", type=float, default=15.0, help="seconds between bursts")
+    parser.add_argument("--poisson", action="store_true", help="exponential inter-arrival times")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of arrivals")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="client-side cap; arrivals beyond it are shed")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request client timeout")
+    parser.add_argument("--tenants", type=int, default=8, help="distinct X-API-Key values")
+    parser.add_argument("--bad-rate", type=float, default=0.02, help="fraction of malformed requests")
+    parser.add_argument("--repeat-briefs", action="store_true", help="reuse briefs (exercises coalescing/caches)")
+    parser.add_argument("--num-variants", type=int, default=1)
+    parser.add_argument("--stub-latency-ms", type=float, default=200, help="local: writer stub latency per call")
+    parser.add_argument("--reject-rate", type=float, default=0.3, help="local: stub compliance NEEDS_CHANGES rate")
+    parser.add_argument("--model", help="local: small real checkpoint instead of stubs")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="cloud: mock server HTTP 500 rate")
+    parser.add_argument("--token-delay-ms", type=float, default=5, help="cloud: mock server per-token delay")
+    parser.add_argument("--report-every", type=float, default=5.0)
+    parser.add_argument("--rss-interval", type=float, default=1.0)
+    parser.add_argument("--warmup", type=float, default=10.0, help="seconds excluded from the RSS slope")
+    parser.add_argument("--tracemalloc", action="store_true", help="report the top allocation growth after warmup")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the summary (with timeline) to this file")
+    parser.add_argument("--max-error-rate", type=float, help="exit 1 if the generate error rate is higher")
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc.start(25)
+    app, mock = load_app(args)
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # one INFO line per request otherwise
+    summary = asyncio.run(drive(app, args))
+    if mock is not None:
+        summary["mock_server"] = dict(mock.counts)
+
+    print("\n📊 Summary")
+    for key in ("sent", "shed_client_side", "throughput_rps", "error_rate", "status", "latency_s",
+                "loop_lag_ms", "rss_mb", "live_checkpointers"):
+        print(f"  {key}: {summary[key]}")
+    for line in summary.get("tracemalloc_top_growth", []):
+        print(f"  📈 {line}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, default=str)
+        print(f"\n💾 Wrote {args.json}")
+
+    if args.max_error_rate is not None and (summary["error_rate"] or 0) > args.max_error_rate:
+        print(f"❌ Error rate {summary['error_rate']} above {args.max_error_rate}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# tools/mock_inference_server.py - Local TGI-compatible text-generation server with fault injection
+#
+# Usage:
+#   python -m tools.mock_inference_server --port 8080 --fail-rate 0.2 --slow-rate 0.1
+#   HF_ENDPOINT_URL=http://127.0.0.1:8080 HUGGINGFACE_API_TOKEN=mock python main_cloud.py
+#
+# Faults can be changed at runtime with POST /__faults (same keys as FaultConfig).
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED = {
+    "compliance": "APPROVED",
+    "image": "Bright flat-lay photo of a reusable water bottle on a beach towel, sunny, vibrant colors",
+    "default": "Stay hydrated, stay wavy! 🌊 Our reusable bottles keep drinks cold all day.\n\n#EcoWave #Hydrate #GoGreen",
+}
+
+
+@dataclass
+class FaultConfig:
+    fail_rate: float = 0.0      # fraction of requests answered with HTTP 500
+    slow_rate: float = 0.0      # fraction of requests delayed by slow_s
+    slow_s: float = 2.0
+    hang_rate: float = 0.0      # fraction of requests that stall for hang_s (client timeout)
+    hang_s: float = 60.0
+    down: bool = False          # answer everything with HTTP 503
+    token_delay_s: float = 0.01 # per streamed token
+
+
+class MockState:
+    def __init__(self, faults: FaultConfig):
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "failed": 0, "slow": 0, "hung": 0, "down": 0}
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] += 1
+
+
+def _json_for(schema: dict) -> str:
+    """Minimal document satisfying a TGI `grammar` JSON schema"""
+    doc = {}
+    for name, spec in schema.get("properties", {}).items():
+        if "enum" in spec:
+            doc[name] = spec["enum"][0]
+        elif spec.get("type") == "array":
+            doc[name] = re.findall(r"#\w+", CANNED["default"])[:spec.get("maxItems", 3)] if "tag" in name else []
+        elif "image" in name:
+            doc[name] = CANNED["image"]
+        else:
+            doc[name] = CANNED["default"].split("\n")[0]
+    return json.dumps(doc)
+
+
+def _completion_for(prompt: str) -> str:
+    lower = prompt.lower()
+    if "compliance" in lower:
+        # Batched checks list candidates as "[1]", "[2]", ...
+        numbers = re.findall(r"^\[(\d+)\]$", prompt, re.MULTILINE)
+        if numbers:
+            return "\n".join(f"{n}: {CANNED['compliance']}" for n in numbers)
+        return CANNED["compliance"]
+    if "image prompt" in lower:
+        return CANNED["image"]
+    return CANNED["default"]
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status: int, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/__stats":
+                return self._json(200, {"faults": asdict(state.faults), "counts": state.counts})
+            return self._json(200, {"status": "ok"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+
+            if self.path == "/__faults":
+                for key, value in payload.items():
+                    if hasattr(state.faults, key):
+                        setattr(state.faults, key, type(getattr(state.faults, key))(value))
+                return self._json(200, asdict(state.faults))
+
+            state.count("requests")
+            faults = state.faults
+            if faults.down:
+                state.count("down")
+                return self._json(503, {"error": "Service Unavailable"})
+            roll = random.random()
+            if roll < faults.fail_rate:
+                state.count("failed")
+                return self._json(500, {"error": "injected failure"})
+            if roll < faults.fail_rate + faults.hang_rate:
+                state.count("hung")
+                time.sleep(faults.hang_s)
+            elif roll < faults.fail_rate + faults.hang_rate + faults.slow_rate:
+                state.count("slow")
+                time.sleep(faults.slow_s)
+
+            params = payload.get("parameters") or {}
+            grammar = params.get("grammar")
+            if grammar and grammar.get("type") == "json":
+                text = _json_for(grammar["value"])
+            else:
+                text = _completion_for(payload.get("inputs", ""))
+            max_new = params.get("max_new_tokens") or 400
+            tokens = [(" " if i else "") + w for i, w in enumerate(text.split(" "))][:max_new]
+
+            try:
+                if payload.get("stream"):
+                    self._stream(tokens, faults.token_delay_s)
+                else:
+                    self._json(200, [{"generated_text": "".join(tokens), "details": None}])
+                state.count("ok")
+            except (BrokenPipeError, ConnectionResetError):
+                # Client hung up early (budget reached / hedge lost / timeout)
+                pass
+
+        def _stream(self, tokens, delay_s: float):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for i, tok in enumerate(tokens):
+                last = i == len(tokens) - 1
+                event = {
+                    "index": i + 1,
+                    "token": {"id": i, "text": tok, "logprob": -0.1, "special": False},
+                    "generated_text": "".join(tokens) if last else None,
+                    "details": None,
+                }
+                self.wfile.write(f"data:{json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(delay_s)
+
+    return Handler
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, faults: FaultConfig = None):
+    """Start the mock server on a background thread; returns (server, state)"""
+    state = MockState(faults or FaultConfig())
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fault-injecting mock inference server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    for field, default in asdict(FaultConfig()).items():
+        flag = "--" + field.replace("_", "-")
+        if isinstance(default, bool):
+            parser.add_argument(flag, action="store_true")
+        else:
+            parser.add_argument(flag, type=type(default), default=default)
+    args = parser.parse_args()
+
+    faults = FaultConfig(**{k: getattr(args, k) for k in asdict(FaultConfig())})
+    server, _ = start_server(args.host, args.port, faults)
+    print(f"🧪 Mock inference server on http://{args.host}:{server.server_port} ({faults})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# tools/replay.py - Replay captured /api/generate traffic against the current workflow
+#
+# Usage (from backend/):
+#   CAPTURE_ENABLED=true python main.py                       # record real traffic to ./captures
+#   python -m tools.replay ./captures --target local --json before.json
+#   python -m tools.replay ./captures --target local --speed 4 --baseline before.json --max-regression 0.2
+#   python -m tools.replay ./captures --target cloud --model-time recorded
+#
+# Every model call is answered from the capture, so what is measured is the
+# workflow around the models: graph steps, state handling, prompt building,
+# parsing and serialization. Requests start at their captured arrival times
+# (divided by --speed) and call generate_content directly, at most
+# --concurrency at a time like the server's inference slots. With
+# --model-time zero (default) calls return instantly and the run time of a
+# request is its orchestration overhead; with "recorded" each call takes as
+# long as it did in production, to reproduce the original contention.
+#
+# The report compares replayed overhead with the capture's (end-to-end
+# latency minus model time) and with a previous replay (--baseline), counts
+# how model calls were matched, and flags requests whose result differs from
+# the captured one (a behaviour change, not only a speed change).
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+from tools.loadtest import StubTokenizer, pct
+
+LOCAL_ARGS = ("user_instruction", "tone", "style", "num_variants", "iteration_policy", "max_iterations")
+CLOUD_ARGS = ("user_instruction", "tone", "style", "num_variants")
+
+
+# ========== REPLAY MODELS ========== #
+
+class ReplayPipeline:
+    """Tokenizer only: every generation is served from the capture before the pipeline is called"""
+
+    model = None
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def __call__(self, *args, **kwargs):
+        raise RuntimeError("replay reached the model; the call was not intercepted")
+
+
+class ReplayLLM:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+
+def fallback(role: str, count: int) -> list:
+    """Answer for a call the capture has no match for (counted as a miss)"""
+    return [0.0] * count if role == "margin" else ["[replay miss]"] * count
+
+
+def setup(args):
+    """Import the target workflow with replay-friendly defaults (explicit env settings win)"""
+    os.environ["CAPTURE_ENABLED"] = "false"
+    os.environ.setdefault("SEMANTIC_CACHE_ENABLED", "false")
+    os.environ.setdefault("HISTORY_ENABLED", "false")
+    if args.target == "cloud":
+        # Never contacted: every call is served from the capture
+        os.environ.setdefault("HF_ENDPOINT_URL", "http://127.0.0.1:9")
+        os.environ.setdefault("HUGGINGFACE_API_TOKEN", "replay")
+        from agents import workflow_cloud
+        return workflow_cloud.generate_content
+    from agents import workflow
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    else:
+        tokenizer = StubTokenizer()
+    llm = ReplayLLM(ReplayPipeline(tokenizer))
+    workflow.WRITER_LLM = workflow.REVIEWER_LLM = workflow.COMPLIANCE_LLM = workflow.COORDINATOR_LLM = llm
+    workflow._MODELS_LOADED = True
+    return workflow.generate_content
+
+
+# ========== DRIVER ========== #
+
+def replay_one(generate, record, args) -> dict:
+    from agents.capture import ReplaySession, replay_request, result_summary
+
+    request = record["request"]
+    names = CLOUD_ARGS if args.target == "cloud" else LOCAL_ARGS
+    kwargs = {name: request[name] for name in names if request.get(name) is not None}
+    session = ReplaySession(record["calls"], fallback, args.model_time)
+    started = time.perf_counter()
+    error = None
+    result = None
+    with replay_request(session):
+        try:
+            result = generate(**kwargs)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    run_s = time.perf_counter() - started
+    replayed = result_summary(result)
+    ok = result is not None and result.get("success", True)
+    return {
+        "id": record["id"],
+        "run_s": run_s,
+        "model_s": session.model_s,
+        "overhead_s": run_s - session.model_s,
+        "captured_overhead_s": record["latency_s"] - record["model_s"],
+        "matches": dict(session.matches),
+        "unused_calls": session.unused,
+        "diverged": ok and record.get("result") is not None and replayed != record["result"],
+        "error": error or (None if ok else (result or {}).get("error")),
+    }
+
+
+async def drive(generate, records, args) -> tuple:
+    slots = asyncio.Semaphore(args.concurrency)
+    t0 = records[0]["ts"]
+    start = time.monotonic()
+    outcomes = []
+
+    async def one(record):
+        await asyncio.sleep(max(0.0, (record["ts"] - t0) / args.speed - (time.monotonic() - start)))
+        arrived = time.monotonic()
+        async with slots:
+            outcome = await asyncio.to_thread(replay_one, generate, record, args)
+        outcome["latency_s"] = time.monotonic() - arrived
+        outcomes.append(outcome)
+        done = len(outcomes)
+        if done % args.report_every == 0 or done == len(records):
+            print(f"  {done}/{len(records)} replayed ({time.monotonic() - start:.1f}s)")
+
+    await asyncio.gather(*(one(record) for record in records))
+    return outcomes, time.monotonic() - start
+
+
+def percentiles(values) -> dict:
+    return {f"p{int(q * 100)}": round(pct(values, q), 4) if values else None for q in (0.5, 0.95, 0.99)}
+
+
+def summarize(args, records, outcomes, elapsed) -> dict:
+    matches = Counter()
+    for outcome in outcomes:
+        matches.update(outcome["matches"])
+    span = records[-1]["ts"] - records[0]["ts"]
+    return {
+        "target": args.target,
+        "capture": args.capture,
+        "requests": len(outcomes),
+        "speed": args.speed,
+        "model_time": args.model_time,
+        "elapsed_s": round(elapsed, 2),
+        "captured_span_s": round(span, 2),
+        "overhead_s": percentiles([o["overhead_s"] for o in outcomes]),
+        "latency_s": percentiles([o["latency_s"] for o in outcomes]),
+        "captured_overhead_s": percentiles([o["captured_overhead_s"] for o in outcomes]),
+        "calls": {**dict(matches), "unused": sum(o["unused_calls"] for o in outcomes)},
+        "diverged": [o["id"] for o in outcomes if o["diverged"]],
+        "errors": dict(Counter(o["error"] for o in outcomes if o["error"])),
+    }
+
+
+def compare(summary: dict, baseline: dict, max_regression: float) -> list:
+    """Overhead percentiles that grew by more than max_regression (a fraction) over the baseline"""
+    regressions = []
+    for q, now in summary["overhead_s"].items():
+        before = baseline["overhead_s"].get(q)
+        if now is None or not before:
+            continue
+        change = (now - before) / before
+        print(f"  overhead {q}: {before * 1000:.1f}ms -> {now * 1000:.1f}ms ({change:+.0%})")
+        if change > max_regression:
+            regressions.append(q)
+    return regressions
+
+
+def main():
+    from agents.capture import read_capture
+
+    parser = argparse.ArgumentParser(description="Replay captured generation traffic with recorded model outputs")
+    parser.add_argument("capture", help="capture directory (CAPTURE_PATH of the recording server)")
+    parser.add_argument("--target", choices=["local", "cloud"], default="local")
+    parser.add_argument("--speed", type=float, default=1.0, help="arrival-rate multiplier (2 = twice as fast)")
+    parser.add_argument("--model-time", choices=["zero", "recorded"], default="zero",
+                        help="zero = calls return instantly, recorded = each takes its captured latency")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("INFERENCE_CONCURRENCY", "0")) or None,
+                        help="generations at once (default INFERENCE_CONCURRENCY, else 1 local / 4 cloud)")
+    parser.add_argument("--tokenizer", help="local: tokenizer to fit prompts with (default: word-level stub)")
+    parser.add_argument("--limit", type=int, help="replay only the first N captured generations")
+    parser.add_argument("--include-errors", action="store_true", help="also replay generations that failed")
+    parser.add_argument("--report-every", type=int, default=10)
+    parser.add_argument("--json", help="write the summary to this file (usable as a later --baseline)")
+    parser.add_argument("--baseline", help="summary of an earlier replay to compare overhead against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="with --baseline: exit 1 if an overhead percentile grew by more than this fraction")
+    args = parser.parse_args()
+    args.concurrency = args.concurrency or (4 if args.target == "cloud" else 1)
+
+    records = [r for r in read_capture(args.capture, args.target, args.limit)
+               if args.include_errors or r["status"] == "ok"]
+    if not records:
+        print(f"❌ No {args.target} generations captured in {args.capture}")
+        sys.exit(1)
+    print(f"🎬 Replaying {len(records)} {args.target} generations at {args.speed}x "
+          f"(model time: {args.model_time}, concurrency {args.concurrency})")
+
+    generate = setup(args)
+    outcomes, elapsed = asyncio.run(drive(generate, records, args))
+    summary = summarize(args, records, outcomes, elapsed)
+
+    print("\n📊 Summary")
+    for key in ("requests", "elapsed_s", "captured_span_s", "overhead_s", "latency_s", "captured_overhead_s",
+                "calls", "errors"):
+        print(f"  {key}: {summary[key]}")
+    if summary["diverged"]:
+        print(f"  ⚠️  {len(summary['diverged'])} results differ from the capture: {summary['diverged'][:5]}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"\n💾 Wrote {args.json}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.max_regression)
+        if regressions:
+            print(f"❌ Overhead regressed beyond {args.max_regression:.0%} at {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# tools/resilience_probe.py - Drive the cloud client through injected faults
+#
+# Usage (from backend/):
+#   python -m tools.resilience_probe --calls 40
+#   python -m tools.resilience_probe --check      # assert the policy, exit 1 on failure
+#
+# Starts the mock inference server in-process and runs the writer client through
+# healthy, flaky, slow-tail, hung, outage and recovery phases, printing what the
+# timeout/retry/hedge/breaker policy did in each. With --check every phase also
+# asserts the behaviour it is there to show, so the probe can gate a change.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from agents.cancellation import CancelToken, RequestCancelled, use_token
+from tools.mock_inference_server import FaultConfig, start_server
+
+PHASES = [
+    ("healthy", dict()),
+    ("flaky", dict(fail_rate=0.3)),
+    ("slow tail", dict(slow_rate=0.1, slow_s=1.5)),
+    # Attempts time out well before the endpoint's read timeout, so they pile up abandoned
+    ("hung", dict(hang_rate=1.0, hang_s=5.0)),
+    ("outage", dict(down=True)),
+    ("recovery", dict()),
+]
+# Per-call attempt timeout in the hung phase (the socket timeout stays CLOUD_TIMEOUT_S)
+HUNG_TIMEOUT_S = 0.2
+
+
+def checks(name: str, outcomes: dict, delta: dict, client) -> list:
+    """(description, passed) pairs for what a phase must show"""
+    calls = sum(outcomes.values())
+    snapshot = client.snapshot()
+    if name in ("healthy", "recovery"):
+        return [
+            ("every call succeeds", outcomes["ok"] == calls),
+            ("breaker closed", snapshot["breaker"]["state"] == "closed"),
+        ]
+    if name == "flaky":
+        return [
+            ("failed attempts are retried", delta["retries"] > 0),
+            # Three attempts per call: a call only fails when all of them do (~3%)
+            ("retries absorb most failures", outcomes["ok"] >= 0.85 * calls),
+        ]
+    if name == "slow tail":
+        return [
+            ("slow attempts are hedged", delta["hedges"] > 0),
+            ("hedges win over slow primaries", delta["hedge_wins"] > 0),
+            ("every call succeeds", outcomes["ok"] == calls),
+        ]
+    if name == "hung":
+        return [
+            ("attempts time out", delta["timeouts"] > 0),
+            ("abandoned attempts stay within the cap", snapshot["abandoned_peak"] <= client.max_abandoned),
+            ("attempts wait, then fail, once the cap is reached", delta["saturated"] > 0),
+        ]
+    if name == "outage":
+        return [
+            ("no call succeeds", outcomes["ok"] == 0),
+            ("breaker opens and fails fast", outcomes["fast_fail"] > 0 and snapshot["breaker"]["state"] == "open"),
+        ]
+    return []
+
+
+def cancelled_trial(client, call) -> bool:
+    """A half-open probe cancelled by its request must not keep the breaker half-open"""
+    time.sleep(client.breaker.reset_timeout_s)
+    token = CancelToken()
+    token.attach(0.05)
+    with use_token(token):
+        try:
+            call()
+        except RequestCancelled:
+            pass
+    # The next call becomes the probe instead of failing fast
+    return client.breaker.allow()
+
+
+def settle(client, timeout_s: float = 10.0):
+    """Start a phase from a healthy client: no abandoned attempts left, breaker closed"""
+    deadline = time.monotonic() + timeout_s
+    while client.snapshot()["abandoned_in_flight"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    client.breaker.record_success()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exercise ResilientClient against injected faults")
+    parser.add_argument("--calls", type=int, default=40, help="calls per phase")
+    parser.add_argument("--check", action="store_true", help="assert each phase's behaviour; exit 1 on failure")
+    parser.add_argument("--seed", type=int, default=0, help="fault and jitter seed")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    server, mock = start_server(faults=FaultConfig(token_delay_s=0.002))
+    os.environ["HF_ENDPOINT_URL"] = f"http://127.0.0.1:{server.server_port}"
+    # Keep the probe quick: short timeout, small backoff, fast breaker reset
+    os.environ.setdefault("CLOUD_TIMEOUT_S", "1.0")
+    os.environ.setdefault("CLOUD_BACKOFF_BASE_S", "0.05")
+    os.environ.setdefault("CLOUD_BREAKER_RESET_S", "1.0")
+    os.environ.setdefault("CLOUD_HEDGE_MIN_SAMPLES", "10")
+    os.environ.setdefault("CLOUD_MAX_ABANDONED", "4")
+    # Five failed attempts in a row are too likely at a 30% failure rate
+    os.environ.setdefault("CLOUD_BREAKER_FAILURES", "8")
+
+    from agents.budgets import derive_budget
+    from agents.resilience import CircuitOpenError
+    from agents.workflow_cloud import complete, get_client
+
+    client = get_client("writer", "mock/model", "mock-token")
+    budget = derive_budget("writer", "short caption with 3-4 hashtags")
+    timeout_s = client.timeout_s
+    failed = []
+
+    for name, faults in PHASES:
+        mock.faults = FaultConfig(token_delay_s=0.002, **faults)
+        if name == "recovery":
+            # The endpoint is back but slow: the open breaker lets a trial through
+            # after its cool-down, and that trial's request is cancelled mid-call
+            mock.faults = FaultConfig(token_delay_s=0.002, hang_rate=1.0, hang_s=0.5)
+            released = cancelled_trial(client, lambda: complete(client, "Create an Instagram post", budget))
+            if args.check:
+                print(f"\n  {'✅' if released else '❌'} cancelled half-open trial frees the breaker")
+                if not released:
+                    failed.append("recovery: cancelled half-open trial frees the breaker")
+            # That allow() started the next trial; hand it to the phase's first call
+            client.breaker.release_trial()
+            mock.faults = FaultConfig(token_delay_s=0.002, **faults)
+        elif name != "outage":
+            # Outage follows the hung phase with its breaker still open
+            settle(client)
+        client.timeout_s = HUNG_TIMEOUT_S if name == "hung" else timeout_s
+        before = client.snapshot()
+        outcomes = {"ok": 0, "error": 0, "fast_fail": 0}
+        latencies = []
+        for _ in range(args.calls):
+            t0 = time.time()
+            try:
+                complete(client, "Create an Instagram post", budget)
+                outcomes["ok"] += 1
+            except CircuitOpenError:
+                outcomes["fast_fail"] += 1
+            except Exception:
+                outcomes["error"] += 1
+            latencies.append(time.time() - t0)
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        after = client.snapshot()
+        delta = {k: v - before[k] for k, v in after.items() if isinstance(v, int)}
+        print(f"\n▶ {name:10s} {outcomes}  p50={latencies[len(latencies) // 2]:.3f}s p95={p95:.3f}s")
+        print(f"  client: {after}")
+        if args.check:
+            for description, passed in checks(name, outcomes, delta, client):
+                print(f"  {'✅' if passed else '❌'} {description}")
+                if not passed:
+                    failed.append(f"{name}: {description}")
+
+    print(f"\n🧪 Mock server counts: {mock.counts}")
+    server.shutdown()
+    if failed:
+        print(f"\n❌ {len(failed)} resilience checks failed: {'; '.join(failed)}")
+        sys.exit(1)
+    if args.check:
+        print("\n✅ All resilience checks passed")
+
+
+if __name__ == "__main__":
+    main()